@@ -8,7 +8,7 @@ from django.contrib.contenttypes.models import ContentType
 from forms import ContentTypeForm
 
 from goflow.workflow.models import Process, Application, Transition
-from goflow.runtime.models import ProcessInstance, WorkItem
+from goflow.runtime.models import ProcessInstance, WorkItem, WorkItemConflict
 
 from django.db import models
 from django.contrib.auth.models import User
@@ -124,7 +124,10 @@ def default_app(request, id, template='goflow/default_app.html', redirect='../..
             #ob.comment = data['comment']
             #ob.save(workitem=workitem, submit_value=submit_value)
             
-            workitem.complete(request.user)
+            try:
+                workitem.complete(request.user)
+            except WorkItemConflict, v:
+                return HttpResponse(str(v), status=409)
             return HttpResponseRedirect(redirect)
     else:
         workitem = WorkItem.objects.get_safe(id, user=request.user)
@@ -241,7 +244,10 @@ def edit_model(request, id, form_class, cmp_attr=None,template=None, template_de
                     raise Exception(str(v))
                 instance.condition = submit_value
                 instance.save()
-                workitem.complete(request.user)
+                try:
+                    workitem.complete(request.user)
+                except WorkItemConflict, v:
+                    return HttpResponse(str(v), status=409)
                 return HttpResponseRedirect(redirect)
     else:
         form = form_class(instance=obj)
@@ -306,7 +312,10 @@ def view_application(request, id, template='goflow/view_application.html', redir
         if submit_value in ok_values:
             instance.condition = submit_value
             instance.save()
-            workitem.complete(request.user)
+            try:
+                workitem.complete(request.user)
+            except WorkItemConflict, v:
+                return HttpResponse(str(v), status=409)
             return HttpResponseRedirect(redirect)
         
     context = {  'object':obj,'instance':instance, 'workitem':workitem,
@@ -377,11 +386,7 @@ def override_app_params(activity, name, value):
     usage: param = _override_app_params(activity, 'param', param)
     '''
     try:
-        if not activity.app_param:
-            return value
-        dicparams = eval(activity.app_param)
-        if dicparams.has_key(name):
-            return dicparams[name]
+        return activity.get_app_params().get(name, value)
     except Exception, v:
         log.error('_override_app_params %s %s - %s', activity, name, v)
     return value
@@ -10,7 +10,8 @@ class ProcessInstanceAdmin(admin.ModelAdmin):
                                 'title', 'process', 'user',
                                 ('status', 'old_status'),
                                 'condition',
-                                ('object_id', 'content_type'))
+                                ('object_id', 'content_type'),
+                                ('parent_workitem', 'depth'))
                      }),
               )
 admin.site.register(ProcessInstance, ProcessInstanceAdmin)
@@ -36,3 +37,45 @@ class EventAdmin(admin.ModelAdmin):
     date_hierarchy = 'date'
     list_display = ('date', 'name', 'workitem')
 admin.site.register(Event, EventAdmin)
+
+
+class JoinStateAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'activity', 'workitem', 'arrivals', 'expected')
+    list_filter = ('activity',)
+admin.site.register(JoinState, JoinStateAdmin)
+
+
+class AutoTaskAdmin(admin.ModelAdmin):
+    date_hierarchy = 'date'
+    list_display = ('date', 'workitem', 'activity', 'status', 'worker', 'started', 'finished')
+    list_filter = ('status', 'activity', 'worker')
+admin.site.register(AutoTask, AutoTaskAdmin)
+
+
+class WorklistEntryAdmin(admin.ModelAdmin):
+    list_display = ('workitem', 'user', 'role', 'priority', 'status', 'enabled', 'autostart')
+    list_filter = ('status', 'role', 'user')
+admin.site.register(WorklistEntry, WorklistEntryAdmin)
+
+
+class ActivityStatsRollupAdmin(admin.ModelAdmin):
+    date_hierarchy = 'day'
+    list_display = ('day', 'activity', 'user', 'number', 'time_min', 'time_max')
+    list_filter = ('activity', 'user')
+    exclude = ('sketch',)
+admin.site.register(ActivityStatsRollup, ActivityStatsRollupAdmin)
+
+
+class ArchivedInstanceAdmin(admin.ModelAdmin):
+    date_hierarchy = 'archived'
+    list_display = ('instance_id', 'title', 'process', 'user', 'status', 'creationTime', 'archived')
+    list_filter = ('process',)
+    exclude = ('data',)
+admin.site.register(ArchivedInstance, ArchivedInstanceAdmin)
+
+
+class NotificationAdmin(admin.ModelAdmin):
+    date_hierarchy = 'date'
+    list_display = ('date', 'user', 'workitem', 'priority')
+    list_filter = ('user',)
+admin.site.register(Notification, NotificationAdmin)
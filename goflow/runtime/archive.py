@@ -0,0 +1,174 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Archive of completed process instances.
+
+Instances completed more than settings.WF_ARCHIVE_DAYS days ago (default
+90) are moved, with their subflow instances, workitems, events and many
+to many rows, into ArchivedInstance rows holding compressed JSON. Each
+chunk of instances is archived and deleted in its own transaction.
+
+purge_events() is the lighter alternative: it only deletes the old events
+of completed workitems. Archived instances are read with
+goflow.runtime.history.get_instance_history.
+
+Cycle time stats (goflow.runtime.reporting.update_activity_stats) need
+the events of a workitem until its completion is folded: run the stats
+job before archiving or purging.
+
+usage::
+
+    archive_instances(days=90)
+    purge_events(days=365)
+'''
+import base64
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import simplejson
+
+from models import ProcessInstance, WorkItem, Event, ArchivedInstance
+from models import ActivityStatusCount, ProcessStatusCount, counters_enabled
+from bulk import select_m2m_rows, chunks
+from goflow.workflow.logger import Log; log = Log('goflow.runtime.archive')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+INSTANCE_FIELDS = ('id', 'title', 'process', 'process__title', 'creationTime', 'user',
+                   'user__username', 'status', 'old_status', 'condition', 'parent_workitem',
+                   'depth', 'content_type', 'object_id')
+WORKITEM_FIELDS = ('id', 'date', 'user', 'user__username', 'instance', 'activity',
+                   'activity__title', 'workitem_from', 'blocked', 'priority', 'status')
+M2M_FIELDS = ('others_workitems_from', 'push_roles', 'pull_roles')
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+    raise TypeError(repr(value))
+
+def _date(value):
+    if value is None:
+        return None
+    return datetime.strptime(value, DATE_FORMAT)
+
+def dumps(data):
+    '''JSON, zlib compressed, base64 encoded.
+    '''
+    return base64.b64encode(zlib.compress(simplejson.dumps(data, default=_encode)))
+
+def loads(text):
+    return simplejson.loads(zlib.decompress(base64.b64decode(text)))
+
+
+def _archive_chunk(limit, chunk_size):
+    roots = [id for id, last in ProcessInstance.objects.filter(status='complete',
+                         parent_workitem__isnull=True).annotate(last=Max('workitems__date')).filter(
+                         last__lt=limit).order_by('id').values_list('id', 'last')[:chunk_size]]
+    if not roots:
+        return 0
+    # subflow instances go with their root instance
+    root_of = dict((id, id) for id in roots)
+    frontier = roots
+    while frontier:
+        children = []
+        for part in chunks(frontier):
+            children.extend(ProcessInstance.objects.filter(parent_workitem__instance__in=part
+                                                           ).values_list('id', 'parent_workitem__instance'))
+        for id, parent_id in children:
+            root_of[id] = root_of[parent_id]
+        frontier = [id for id, parent_id in children]
+    ids = sorted(root_of.keys())
+
+    instances, workitems = [], []
+    for part in chunks(ids):
+        instances.extend(ProcessInstance.objects.filter(id__in=part).values(*INSTANCE_FIELDS))
+        workitems.extend(WorkItem.objects.filter(instance__in=part).values(*WORKITEM_FIELDS))
+    workitems.sort(key=lambda wi: wi['id'])
+    by_id = {}
+    by_instance = dict((id, []) for id in ids)
+    for wi in workitems:
+        wi['events'] = []
+        for name in M2M_FIELDS:
+            wi[name] = []
+        by_id[wi['id']] = wi
+        by_instance[wi['instance']].append(wi)
+    for part in chunks(sorted(by_id.keys())):
+        # events of a workitem are in the same chunk: their order is kept
+        for workitem_id, date, name in Event.objects.filter(workitem__in=part).order_by(
+                                       'id').values_list('workitem', 'date', 'name'):
+            by_id[workitem_id]['events'].append((date, name))
+    for name in M2M_FIELDS:
+        for workitem_id, other_id in select_m2m_rows(WorkItem, name, by_id.keys()):
+            by_id[workitem_id][name].append(other_id)
+
+    for inst in instances:
+        ArchivedInstance.objects.create(instance_id=inst['id'], root_id=root_of[inst['id']],
+                                        title=inst['title'], process_id=inst['process'],
+                                        user_id=inst['user'], status=inst['status'],
+                                        creationTime=inst['creationTime'],
+                                        content_type_id=inst['content_type'],
+                                        object_id=inst['object_id'],
+                                        data=dumps({'instance':inst,
+                                                    'workitems':by_instance[inst['id']]}))
+    # cascades to workitems, events, many to many rows
+    for part in chunks(ids):
+        ProcessInstance.objects.filter(id__in=part).delete()
+
+    if counters_enabled():
+        for model, rows, owner in ((ActivityStatusCount, workitems, 'activity'),
+                                   (ProcessStatusCount, instances, 'process')):
+            counts = {}
+            for row in rows:
+                key = (row[owner], row['status'])
+                counts[key] = counts.get(key, 0) + 1
+            for (owner_id, status), n in counts.items():
+                model.objects.move(owner_id, status, None, n)
+    log.info('%d instances archived', len(ids))
+    return len(roots)
+_archive_chunk = transaction.commit_on_success(_archive_chunk)
+
+def archive_instances(days=None, chunk_size=100):
+    '''
+    archives the instances completed more than days ago.
+
+    @rtype: int
+    @return: number of root instances archived
+    '''
+    if days is None:
+        days = getattr(settings, 'WF_ARCHIVE_DAYS', 90)
+    limit = datetime.now() - timedelta(days=days)
+    total = 0
+    while True:
+        n = _archive_chunk(limit, chunk_size)
+        total += n
+        if n < chunk_size:
+            return total
+
+
+def _purge_chunk(limit, chunk_size):
+    ids = list(Event.objects.filter(date__lt=limit, workitem__status='complete').order_by(
+                                    'id').values_list('id', flat=True)[:chunk_size])
+    for part in chunks(ids):
+        Event.objects.filter(id__in=part).delete()
+    return len(ids)
+_purge_chunk = transaction.commit_on_success(_purge_chunk)
+
+def purge_events(days, chunk_size=1000):
+    '''
+    deletes the events of completed workitems older than days.
+
+    @rtype: int
+    @return: number of events deleted
+    '''
+    limit = datetime.now() - timedelta(days=days)
+    total = 0
+    while True:
+        n = _purge_chunk(limit, chunk_size)
+        total += n
+        if n < chunk_size:
+            return total
+
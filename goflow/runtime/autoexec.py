@@ -0,0 +1,95 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Out-of-request execution of auto activities.
+
+With settings.WF_AUTO_ASYNC = True, the engine only queues auto activity
+workitems (see AutoTask); they are run by workers of this module, e.g.
+with the management command::
+
+    python manage.py goflow_autoworkers --workers=4
+
+settings:
+
+WF_AUTO_ASYNC
+    queue auto activities instead of running them in the request (default False)
+WF_AUTO_CONCURRENCY
+    max running tasks per activity, keyed by activity id or title, e.g.
+    {'checkstatus': 2} (default: no limit)
+WF_AUTO_STALE
+    seconds after which the concurrency slot of a task left running by a
+    dead worker is freed (default 3600, see AutoTaskManager.claim)
+'''
+import threading
+
+from django.db import connection
+
+from models import AutoTask
+from goflow.workflow.logger import Log; log = Log('goflow.runtime.autoexec')
+
+
+def run_pending(worker='main', max_tasks=None, limits=None):
+    '''
+    runs queued tasks until the queue is empty (or max_tasks are run).
+    
+    @rtype: int
+    @return: number of tasks run
+    '''
+    count = 0
+    while max_tasks is None or count < max_tasks:
+        task = AutoTask.objects.claim(worker=worker, limits=limits)
+        if task is None:
+            break
+        task.run()
+        count += 1
+    return count
+
+
+class WorkerPool(object):
+    """A pool of threads running queued auto activities.
+    
+    usage::
+    
+        pool = WorkerPool(workers=4)
+        pool.start()
+        ...
+        pool.stop()
+    """
+    def __init__(self, workers=2, poll=1.0, name='worker', limits=None):
+        self.workers = workers
+        self.poll = poll
+        self.name = name
+        self.limits = limits
+        self.threads = []
+        self._stop = threading.Event()
+
+    def _run(self, worker):
+        log.info('auto worker %s started', worker)
+        try:
+            while not self._stop.isSet():
+                try:
+                    if not run_pending(worker=worker, max_tasks=100, limits=self.limits):
+                        self._stop.wait(self.poll)
+                except Exception, v:
+                    log.error('auto worker %s: %s', worker, v)
+                    self._stop.wait(self.poll)
+        finally:
+            connection.close()
+        log.info('auto worker %s stopped', worker)
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, args=('%s-%d' % (self.name, i),))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+
+    def is_alive(self):
+        return len([t for t in self.threads if t.isAlive()]) > 0
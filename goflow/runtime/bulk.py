@@ -0,0 +1,113 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Set-based inserts for the runtime tables.
+
+Rows are written with one executemany() per table; model save() methods
+and signals are bypassed, so callers are responsible for any bookkeeping
+done there. Lists of ids are queried IN_SIZE at a time (see chunks).
+'''
+from datetime import datetime
+from django.db import connection
+
+# ids per IN list: SQLite accepts at most 999 parameters per query
+IN_SIZE = 500
+
+
+def _prep(value):
+    if isinstance(value, datetime):
+        return connection.ops.value_to_db_datetime(value)
+    return value
+
+def insert_rows(model, fields, rows):
+    '''
+    inserts rows in the table of a model.
+
+    :type model: Model class
+    :type fields: sequence of field names (ForeignKey fields by name, not column)
+    :type rows: sequence of value tuples, in fields order
+    '''
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    columns = [model._meta.get_field(name).column for name in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(model._meta.db_table),
+                ', '.join([qn(c) for c in columns]),
+                ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    cursor.executemany(sql, [tuple([_prep(v) for v in row]) for row in rows])
+
+def insert_m2m_rows(model, name, pairs):
+    '''
+    inserts rows in the table of a many to many field.
+
+    :type model: Model class
+    :type name: name of the ManyToManyField
+    :type pairs: sequence of (model id, related id)
+    '''
+    if not pairs:
+        return
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(name)
+    sql = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+                qn(field.m2m_db_table()),
+                qn(field.m2m_column_name()),
+                qn(field.m2m_reverse_name()))
+    cursor = connection.cursor()
+    cursor.executemany(sql, list(pairs))
+
+def chunks(values, size=IN_SIZE):
+    '''
+    splits values into lists of at most size items, for IN lists.
+    '''
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def select_m2m_rows(model, name, ids):
+    '''
+    returns the (model id, related id) rows of a many to many field for
+    the given model ids.
+    '''
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(name)
+    sql = 'SELECT %s, %s FROM %s WHERE %s IN (%%s)' % (
+                qn(field.m2m_column_name()),
+                qn(field.m2m_reverse_name()),
+                qn(field.m2m_db_table()),
+                qn(field.m2m_column_name()))
+    cursor = connection.cursor()
+    rows = []
+    for part in chunks(ids):
+        cursor.execute(sql % ', '.join(['%s'] * len(part)), part)
+        rows.extend(cursor.fetchall())
+    return rows
+
+def add_seconds_sql(column, seconds):
+    '''
+    returns the SQL expression of a datetime column plus a number of
+    seconds, None if the database engine is not known.
+    '''
+    engine = connection.settings_dict['ENGINE'].split('.')[-1]
+    seconds = int(seconds)
+    if engine == 'sqlite3':
+        # datetime() drops the fraction of the seconds: appended back
+        return "datetime(%s, '%+d seconds') || substr(%s, 20)" % (column, seconds, column)
+    if engine in ('postgresql', 'postgresql_psycopg2'):
+        return "%s + interval '%d seconds'" % (column, seconds)
+    if engine == 'mysql':
+        return '%s + INTERVAL %d SECOND' % (column, seconds)
+    if engine == 'oracle':
+        return "%s + NUMTODSINTERVAL(%d, 'SECOND')" % (column, seconds)
+    return None
+
+def max_id(model):
+    '''
+    returns the highest primary key of a table (0 if empty).
+
+    Rows inserted afterwards are read back with filter(id__gt=max_id).
+    '''
+    ids = model._default_manager.order_by('-id').values_list('id', flat=True)[:1]
+    if ids:
+        return ids[0]
+    return 0
@@ -0,0 +1,102 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Buffered Event writes.
+
+Inside an event buffer, Event.objects.record() collects rows in memory;
+they are written with one bulk insert when the outermost buffer exits.
+Buffers are per thread and nest: inner buffers join the outer one.
+
+usage::
+
+    with buffered_events():
+        workitem.activate(user)
+        workitem.complete(user)
+
+    @buffer_events
+    def my_view(request, id):
+        ...
+
+Use the buffer inside the transaction (e.g. within TransactionMiddleware or
+commit_on_success) so that events are written before the commit.
+'''
+import sys
+import threading
+from datetime import datetime
+
+from django.db.models import get_model
+
+from bulk import insert_rows
+from goflow.workflow.logger import Log; log = Log('goflow.runtime.events')
+
+_local = threading.local()
+
+
+class EventBuffer(object):
+    """Event rows waiting to be written.
+    """
+    def __init__(self):
+        self.rows = []
+
+    def add(self, name, workitem):
+        self.rows.append((datetime.now(), name, workitem.id))
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        insert_rows(get_model('runtime', 'Event'), ('date', 'name', 'workitem'), rows)
+        return len(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def current_buffer():
+    '''returns the active EventBuffer of the thread, or None.
+    '''
+    return getattr(_local, 'buffer', None)
+
+
+class buffered_events(object):
+    """Context manager opening an event buffer.
+    """
+    def __enter__(self):
+        self.owner = current_buffer() is None
+        if self.owner:
+            _local.buffer = EventBuffer()
+        return _local.buffer
+
+    def __exit__(self, type, value, traceback):
+        if not self.owner:
+            return False
+        buffer = _local.buffer
+        del _local.buffer
+        if type is None:
+            buffer.flush()
+        else:
+            # keep the history of what was done before the error
+            try:
+                buffer.flush()
+            except Exception, v:
+                log.error('events lost (%d): %s', len(buffer), v)
+        return False
+
+
+def buffer_events(func):
+    '''decorator running a function (view, engine method) in an event buffer.
+    '''
+    def wrapper(*args, **kwargs):
+        context = buffered_events()
+        context.__enter__()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            context.__exit__(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            context.__exit__(None, None, None)
+            return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__dict__.update(func.__dict__)
+    return wrapper
@@ -0,0 +1,186 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+History of a process instance as a DAG of workitems.
+
+The workitems of an instance, their events, activities, users and
+lineage (workitem_from, others_workitems_from, subflow instances) are
+loaded with five queries, whatever the number of workitems. Archived
+instances (see goflow.runtime.archive) give the same structure, without
+subflow edges.
+
+usage::
+
+    history = get_instance_history(instance_id)
+    for node in history.nodes:
+        node.activity, node.user, node.parents
+    simplejson.dumps(history.as_dict(), default=...)
+'''
+from goflow.workflow.models import Process
+from goflow.workflow.graph import get_activity_graph
+from models import ProcessInstance, WorkItem, Event, ArchivedInstance
+from archive import INSTANCE_FIELDS, WORKITEM_FIELDS, loads, _date
+from bulk import select_m2m_rows
+
+
+class HistoryNode(object):
+    """A workitem of the history.
+
+    parents are the ids of the workitems it comes from (workitem_from,
+    then others_workitems_from for and-joins), children the ids of the
+    workitems coming from it, subflows the instances it started.
+    """
+    def __init__(self, data, history):
+        self.history = history
+        self.id = data['id']
+        self.date = data['date']
+        self.activity = data['activity__title']
+        self.activity_id = data['activity']
+        self.user = data['user__username']
+        self.user_id = data['user']
+        self.status = data['status']
+        self.priority = data['priority']
+        self.blocked = data['blocked']
+        self.events = data['events']
+        self.parents = []
+        if data['workitem_from']:
+            self.parents.append(data['workitem_from'])
+        self.parents.extend([id for id in data['others_workitems_from'] if id not in self.parents])
+        self.children = []
+        self.subflows = []
+
+    def get_status_display(self):
+        return dict(WorkItem.STATUS_CHOICES).get(self.status, self.status)
+
+    def as_dict(self):
+        return {'id':self.id, 'activity':self.activity, 'activity_id':self.activity_id,
+                'user':self.user, 'status':self.status, 'priority':self.priority,
+                'blocked':self.blocked, 'date':self.date, 'events':self.events,
+                'parents':self.parents, 'children':self.children,
+                'subflows':[s['id'] for s in self.subflows]}
+
+    def __unicode__(self):
+        return u'%s-%s-%s' % (self.history.title, self.activity, self.id)
+
+
+def _join_edge(activity_id, from_activity_id):
+    '''
+    False for the reverse rows of the and-joins recorded while
+    others_workitems_from was symmetrical: the join activity is entered
+    from the activity of the other workitem.
+    '''
+    try:
+        graph = get_activity_graph(activity_id)
+    except (IndexError, KeyError, Process.DoesNotExist):
+        # definition deleted: kept as recorded
+        return True
+    return from_activity_id in [t.input_id for t in graph.incoming(activity_id)]
+
+
+class InstanceHistory(object):
+    """Workitems of an instance (nodes, by id) and their lineage edges.
+
+    edges are (from id, to id, kind) tuples, kind being 'flow'
+    (workitem_from) or 'join' (others_workitems_from); subflow instances
+    are dicts (id, title, status, parent_workitem) in subflows.
+    """
+    def __init__(self, instance, workitems, subflows=(), archived=False):
+        self.id = instance['id']
+        self.title = instance['title']
+        self.process = instance['process__title']
+        self.user = instance['user__username']
+        self.status = instance['status']
+        self.creationTime = instance['creationTime']
+        self.parent_workitem_id = instance['parent_workitem']
+        self.archived = archived
+        activities = dict((data['id'], data['activity']) for data in workitems)
+        for data in workitems:
+            data['others_workitems_from'] = [id for id in data['others_workitems_from']
+                                             if id not in activities or
+                                             _join_edge(data['activity'], activities[id])]
+        self.nodes = [HistoryNode(data, self) for data in workitems]
+        self.by_id = dict((node.id, node) for node in self.nodes)
+        self.edges = []
+        for data, node in zip(workitems, self.nodes):
+            for id in node.parents:
+                kind = (id == data['workitem_from']) and 'flow' or 'join'
+                self.edges.append((id, node.id, kind))
+                if id in self.by_id:
+                    self.by_id[id].children.append(node.id)
+        self.subflows = list(subflows)
+        for subflow in self.subflows:
+            node = self.by_id.get(subflow['parent_workitem'])
+            if node is not None:
+                node.subflows.append(subflow)
+
+    # template compatibility with ProcessInstance
+    workitems = property(lambda self: self.nodes)
+
+    def roots(self):
+        '''nodes without parent in the instance.
+        '''
+        return [node for node in self.nodes if not [id for id in node.parents if id in self.by_id]]
+
+    def get_status_display(self):
+        return dict(ProcessInstance.STATUS_CHOICES).get(self.status, self.status)
+
+    def as_dict(self):
+        '''JSON-ready structure (dates are left as datetime).
+        '''
+        return {'id':self.id, 'title':self.title, 'process':self.process, 'user':self.user,
+                'status':self.status, 'creationTime':self.creationTime,
+                'parent_workitem':self.parent_workitem_id, 'archived':self.archived,
+                'nodes':[node.as_dict() for node in self.nodes],
+                'edges':self.edges, 'subflows':self.subflows}
+
+    def __unicode__(self):
+        return self.title
+
+
+def load_history(instance_id):
+    '''
+    returns the InstanceHistory of a live instance (5 queries).
+
+    raises ProcessInstance.DoesNotExist
+
+    @rtype: InstanceHistory
+    '''
+    try:
+        instance = ProcessInstance.objects.filter(id=instance_id).values(*INSTANCE_FIELDS)[0]
+    except IndexError:
+        raise ProcessInstance.DoesNotExist('instance %s' % instance_id)
+    workitems = list(WorkItem.objects.filter(instance=instance_id).values(
+                                             *WORKITEM_FIELDS).order_by('id'))
+    by_id = {}
+    for wi in workitems:
+        wi['events'] = []
+        wi['others_workitems_from'] = []
+        by_id[wi['id']] = wi
+    for workitem_id, date, name in Event.objects.filter(workitem__instance=instance_id).order_by(
+                                   'id').values_list('workitem', 'date', 'name'):
+        by_id[workitem_id]['events'].append((date, name))
+    for workitem_id, other_id in select_m2m_rows(WorkItem, 'others_workitems_from', by_id.keys()):
+        by_id[workitem_id]['others_workitems_from'].append(other_id)
+    subflows = ProcessInstance.objects.filter(parent_workitem__instance=instance_id).order_by(
+                                              'id').values('id', 'title', 'status', 'parent_workitem')
+    return InstanceHistory(instance, workitems, subflows)
+
+def get_instance_history(instance_id):
+    '''
+    returns the InstanceHistory of an instance, live or archived.
+
+    raises ArchivedInstance.DoesNotExist if the instance is unknown.
+
+    @rtype: InstanceHistory
+    '''
+    try:
+        return load_history(instance_id)
+    except ProcessInstance.DoesNotExist:
+        pass
+    data = loads(ArchivedInstance.objects.get(instance_id=instance_id).data)
+    instance = data['instance']
+    instance['creationTime'] = _date(instance['creationTime'])
+    for wi in data['workitems']:
+        wi['date'] = _date(wi['date'])
+        wi['events'] = [(_date(date), name) for date, name in wi['events']]
+    return InstanceHistory(instance, data['workitems'], archived=True)
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from goflow.runtime.archive import archive_instances, purge_events
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+            help='age in days (default: settings.WF_ARCHIVE_DAYS or 90)'),
+        make_option('--chunk', type='int', dest='chunk', default=None,
+            help='instances (or events) per transaction'),
+        make_option('--purge-events', action='store_true', dest='purge_events', default=False,
+            help='only delete the old events of completed workitems'),
+    )
+    help = 'Moves completed instances into the archive table, or purges old events.'
+
+    def handle(self, *args, **options):
+        if options['purge_events']:
+            if options['days'] is None:
+                options['days'] = 365
+            n = purge_events(options['days'], options['chunk'] or 1000)
+            print '%d events purged' % n
+        else:
+            n = archive_instances(options['days'], options['chunk'] or 100)
+            print '%d instances archived' % n
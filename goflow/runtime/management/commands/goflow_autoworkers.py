@@ -0,0 +1,41 @@
+import os
+import socket
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from goflow.workflow import handlers
+from goflow.runtime.models import AutoTask
+from goflow.runtime.autoexec import WorkerPool, run_pending
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=2,
+            help='number of worker threads'),
+        make_option('--poll', type='float', dest='poll', default=1.0,
+            help='delay in seconds between two polls of an empty queue'),
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='run the queued tasks then exit'),
+        make_option('--requeue', type='int', dest='requeue', default=3600,
+            help='requeue tasks running for more than this number of seconds'),
+    )
+    help = 'Runs the queued auto activities (settings.WF_AUTO_ASYNC).'
+
+    def handle(self, *args, **options):
+        # worker names hold the concurrency slots: unique in the cluster
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+        # the tasks find their auto application handlers resolved
+        handlers.load()
+        AutoTask.objects.requeue_stale(options['requeue'])
+        if options['once']:
+            print '%d tasks run' % run_pending(worker=name)
+            return
+        pool = WorkerPool(workers=options['workers'], poll=options['poll'], name=name)
+        pool.start()
+        try:
+            while pool.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pool.stop()
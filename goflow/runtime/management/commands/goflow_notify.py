@@ -0,0 +1,23 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from goflow.runtime.outbox import send_notifications
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', type='int', dest='loop', default=0,
+            help='run every LOOP seconds instead of once'),
+        make_option('--batch', type='int', dest='batch', default=100,
+            help='users per transaction'),
+    )
+    help = 'Sends the pending notifications, one digest per user.'
+
+    def handle(self, *args, **options):
+        while True:
+            send_notifications(batch_size=options['batch'])
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
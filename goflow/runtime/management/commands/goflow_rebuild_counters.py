@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from goflow.runtime.reporting import rebuild_counters
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the status counters (settings.WF_STATUS_COUNTERS) from the runtime tables.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        rebuild_counters()
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from goflow.runtime.models import WorklistEntry
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the worklist index from the open workitems.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        print '%d workitems indexed' % WorklistEntry.objects.rebuild()
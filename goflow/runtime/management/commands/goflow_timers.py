@@ -0,0 +1,23 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from goflow.runtime.timers import run_timers
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', type='int', dest='loop', default=0,
+            help='run every LOOP seconds instead of once'),
+        make_option('--batch', type='int', dest='batch', default=100,
+            help='workitems loaded per transaction'),
+    )
+    help = 'Forwards the workitems whose time_out transitions are due.'
+
+    def handle(self, *args, **options):
+        while True:
+            run_timers(batch_size=options['batch'])
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
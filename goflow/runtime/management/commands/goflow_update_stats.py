@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from goflow.runtime.reporting import update_activity_stats, rebuild_activity_stats
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', type='int', dest='loop', default=0,
+            help='run every LOOP seconds instead of once'),
+        make_option('--batch', type='int', dest='batch', default=1000,
+            help='completed workitems folded per transaction'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='rebuild the rollups from the whole event history'),
+    )
+    help = 'Folds the cycle times of completed workitems into the activity stats rollups.'
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rebuild_activity_stats(options['batch'])
+        while True:
+            update_activity_stats(options['batch'])
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,225 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Engine metrics.
+
+Counters and histograms labelled by process and activity, kept in memory
+by the server process. Engine operations (start, activate, complete,
+forward, get_destinations, exec_auto_application, exec_push_application)
+are measured when settings.WF_METRICS is True; otherwise the hooks only
+test a flag.
+
+For each operation::
+
+    goflow_<operation>_total{process, activity, result}   calls (result: ok, error)
+    goflow_<operation>_seconds{process, activity}         latency histogram
+    goflow_<operation>_queries{process, activity}         DB queries histogram
+                                                          (settings.DEBUG only)
+
+usage::
+
+    snapshot()      # dict
+    exposition()    # text format, served by goflow.runtime.views.metrics
+
+    @measure('my_operation')
+    def my_method(workitem):
+        ...
+'''
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from goflow.workflow.graph import get_activity_graph
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """Bucketed distribution of observed values.
+    """
+    def __init__(self, buckets):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''[(upper bound, number of values <= bound)], the last bound is '+Inf'.
+        '''
+        result, total = [], 0
+        for bound, n in zip(self.bounds + ('+Inf',), self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+class Registry(object):
+    """Thread-safe store of counters and histograms.
+
+    labels are tuples of (name, value) pairs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), n=1):
+        key = (name, tuple(labels))
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + n
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, labels=(), buckets=SECONDS_BUCKETS):
+        key = (name, tuple(labels))
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters.clear()
+            self.histograms.clear()
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        '''
+        returns {'counters': {name: [(labels dict, value)]},
+                 'histograms': {name: [(labels dict, {'count', 'sum', 'buckets'})]}}
+        '''
+        self.lock.acquire()
+        try:
+            counters, histograms = {}, {}
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, []).append((dict(labels), value))
+            for (name, labels), h in self.histograms.items():
+                histograms.setdefault(name, []).append((dict(labels), {
+                        'count':h.count, 'sum':h.sum, 'buckets':h.cumulative()}))
+            return {'counters':counters, 'histograms':histograms}
+        finally:
+            self.lock.release()
+
+    def exposition(self):
+        '''returns the metrics in the prometheus text format.
+        '''
+        lines = []
+        snap = self.snapshot()
+        for name in sorted(snap['counters']):
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in snap['counters'][name]:
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+        for name in sorted(snap['histograms']):
+            lines.append('# TYPE %s histogram' % name)
+            for labels, h in snap['histograms'][name]:
+                for bound, n in h['buckets']:
+                    lines.append('%s_bucket%s %d' % (name, _labels(labels, le=bound), n))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), h['sum']))
+                lines.append('%s_count%s %d' % (name, _labels(labels), h['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, unicode(labels[k]).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k in sorted(labels)])
+
+
+registry = Registry()
+_enabled = None
+
+def enabled():
+    '''metrics are collected if settings.WF_METRICS is True (see enable).
+    '''
+    global _enabled
+    if _enabled is None:
+        _enabled = getattr(settings, 'WF_METRICS', False)
+    return _enabled
+
+def enable(flag=True):
+    '''turns the collection on or off, overriding settings.WF_METRICS.
+    '''
+    global _enabled
+    _enabled = flag
+
+def snapshot():
+    return registry.snapshot()
+
+def exposition():
+    return registry.exposition()
+
+def inc(name, labels=(), n=1):
+    if enabled():
+        registry.inc(name, labels, n)
+
+def observe(name, value, labels=(), buckets=SECONDS_BUCKETS):
+    if enabled():
+        registry.observe(name, value, labels, buckets)
+
+
+def workitem_labels(workitem, *args, **kwargs):
+    '''process and activity labels of a WorkItem method (no query).
+    '''
+    graph = get_activity_graph(workitem.activity_id)
+    return (('process', graph.title), ('activity', graph.activity(workitem.activity_id).title))
+
+def start_labels(manager, process_name, *args, **kwargs):
+    '''process label of ProcessInstanceManager.start.
+    '''
+    return (('process', process_name),)
+
+
+def measure(name, labels=workitem_labels):
+    '''
+    decorator measuring calls, latency and DB queries of an operation.
+
+    labels is called with the arguments of the measured function and
+    returns the labels, e.g. workitem_labels for WorkItem methods.
+    '''
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            queries = len(connection.queries)
+            start = time.time()
+            result = 'error'
+            try:
+                value = func(*args, **kwargs)
+                result = 'ok'
+                return value
+            finally:
+                elapsed = time.time() - start
+                try:
+                    l = labels(*args, **kwargs)
+                except Exception:
+                    l = ()
+                registry.inc('goflow_%s_total' % name, l + (('result', result),))
+                registry.observe('goflow_%s_seconds' % name, elapsed, l)
+                if settings.DEBUG:
+                    # connection.queries is only filled in debug mode
+                    registry.observe('goflow_%s_queries' % name, len(connection.queries) - queries,
+                                     l, QUERIES_BUCKETS)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
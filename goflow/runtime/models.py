@@ -1,25 +1,66 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.db import models, transaction, connection, router, IntegrityError
 from django.contrib.auth.models import Group, User
 from goflow.workflow.models import Process, Activity, Transition, UserProfile
-from goflow.workflow.notification import send_mail
+from goflow.workflow.graph import get_graph, get_graph_by_title, get_activity_graph
+from goflow.workflow.conditions import get_condition
+from goflow.workflow.authcache import get_user_roles
+from goflow.workflow.handlers import get_auto_handler
+from bulk import insert_rows, insert_m2m_rows, max_id, chunks, add_seconds_sql
+from events import current_buffer, buffer_events
+from metrics import measure, start_labels
+from sketch import QuantileSketch
+from versions import touch_worklists, touch_all, touch_requests
 from datetime import timedelta, datetime
-from django.core.urlresolvers import resolve
 from django.core.mail import mail_admins
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.db.models import Q, F, signals
 
 from goflow.workflow.logger import Log; log = Log('goflow.runtime.managers')
 from django.conf import settings
 
 from goflow.workflow.decorators import allow_tags
 
+
+class WorkItemConflict(Exception):
+    '''A workitem was modified by another request since it was read.
+    '''
+    pass
+
+
 class ProcessInstanceManager(models.Manager):
     '''Custom model manager for ProcessInstance
     '''
+    REQUEST_FIELDS = (('id', 'id'), ('title', 'title'), ('process', 'process__title'),
+                      ('status', 'status'), ('creationTime', 'creationTime'))
+    
+    def requests(self, user, after=None, limit=50):
+        '''
+        Returns a page of the instances started by a user (subflows
+        excluded), most recent first, as dicts.
+        
+        :type user: User
+        :type after: string
+        :param after: cursor returned with the previous page
+        :type limit: int
+        :rtype: ([dict], string)
+        :return: the instances and the cursor of the next page (None on the last page)
+        '''
+        query = self.filter(user=user, parent_workitem__isnull=True)
+        if after:
+            query = query.filter(id__lt=int(after))
+        rows = list(query.order_by('-id').values(*[f for k, f in self.REQUEST_FIELDS])[:limit + 1])
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = str(rows[-1]['id'])
+        return [dict((k, row[f]) for k, f in self.REQUEST_FIELDS) for row in rows], cursor
    
+    @measure('start', start_labels)
+    @buffer_events
     def start(self, process_name, user, item, title=None, priority=0):
         '''
         Returns a workitem given the name of a preexisting enabled Process 
@@ -48,7 +89,10 @@ class ProcessInstanceManager(models.Manager):
 
         '''
         
-        process = Process.objects.get(title=process_name, enabled=True)
+        graph = get_graph_by_title(process_name)
+        if not graph.enabled:
+            raise Process.DoesNotExist('process %s disabled.' % process_name)
+        process = graph.process
         if priority == 0: priority = process.priority
             
         if not title or (title=='instance'):
@@ -58,41 +102,128 @@ class ProcessInstanceManager(models.Manager):
         instance.set_status('running')
         
         workitem = WorkItem.objects.create(instance=instance, user=user, 
-                                           activity=process.begin, priority=priority)
-        log.event('created by ' + user.username, workitem)
-        log('process:', process_name, 'user:', user.username, 'item:', item)
+                                           activity=graph.begin, priority=priority)
+        Event.objects.record('created by %s' % user.username, workitem)
+        log.info('process %s started by %s', process_name, user.username, extra=log.ids(workitem))
     
-        if process.begin.kind == 'dummy':
-            log('routing activity', process.begin.title, 'workitem:', workitem)
+        if graph.begin.kind == 'dummy':
+            log.debug('routing activity %s', graph.begin.title, extra=log.ids(workitem))
             auto_user = User.objects.get(username=settings.WF_USER_AUTO)
             workitem.activate(actor=auto_user)
             workitem.complete(actor=auto_user)
             return workitem
         
-        if process.begin.autostart:
-            log('run auto activity', process.begin.title, 'workitem:', workitem)
-            auto_user = User.objects.get(username=settings.WF_USER_AUTO)
-            workitem.activate(actor=auto_user)
-    
-            if workitem.exec_auto_application():
-                log('workitem.exec_auto_application:', workitem)
-                workitem.complete(actor=auto_user)
+        if graph.begin.autostart:
+            if getattr(settings, 'WF_AUTO_ASYNC', False):
+                AutoTask.objects.enqueue(workitem)
+                return workitem
+            log.info('run auto activity %s', graph.begin.title, extra=log.ids(workitem))
+            if workitem.run_auto_activity():
+                log.debug('workitem.exec_auto_application done', extra=log.ids(workitem))
             return workitem
 
-        if process.begin.push_application:
+        if graph.begin.push_application:
             target_user = workitem.exec_push_application()
-            log('application pushed to user', target_user.username)
+            log.info('application pushed to user %s', target_user.username, extra=log.ids(workitem))
             workitem.user = target_user
             workitem.save()
-            log.event('assigned to '+target_user.username, workitem)
+            Event.objects.record('assigned to %s' % target_user.username, workitem)
             #notify_if_needed(user=target_user)
         else:
             # set pull roles; useful (in activity too)?
-            workitem.pull_roles = workitem.activity.roles.all()
+            workitem.pull_roles = graph.roles(graph.begin)
             workitem.save()
             #notify_if_needed(roles=workitem.pull_roles)
         
         return workitem
+    
+    @transaction.commit_on_success
+    def start_many(self, process_name, user, items, title=None, priority=0):
+        '''
+        Starts one instance per item, in a single transaction.
+        
+        Instances, initial workitems, pull roles and creation events are
+        written with bulk inserts. Begin activities that must be routed
+        (dummy, autostart or push application) are started item by item
+        with start().
+        
+        :type process_name: string
+        :param process_name: a name of a process. e.g. 'leave'
+        :type user: User
+        :param user: the user starting the instances
+        :type items: sequence
+        :param items: objects attached to the new instances (one instance each)
+        :type: title: string
+        :param title: title of the new instances (optional)
+        :type: priority: integer
+        :param priority: default priority (optional)
+        :rtype: [int]
+        :return: ids of the initial workitems, in items order
+        
+        usage::
+            
+            ids = ProcessInstance.objects.start_many('leave', admin, LeaveRequest.objects.all())
+        
+        '''
+        graph = get_graph_by_title(process_name)
+        if not graph.enabled:
+            raise Process.DoesNotExist('process %s disabled.' % process_name)
+        process, begin = graph.process, graph.begin
+        if priority == 0: priority = process.priority
+        items = list(items)
+        
+        if begin.kind == 'dummy' or begin.autostart or begin.push_application:
+            return [self.start(process_name, user, item, title, priority).id for item in items]
+        
+        keys = []
+        for item in items:
+            keys.append((ContentType.objects.get_for_model(item).id, item.pk))
+        if len(set(keys)) != len(keys):
+            raise Exception('start_many: an item is given more than once.')
+        
+        now = datetime.now()
+        last_instance = max_id(ProcessInstance)
+        rows = []
+        for item, (ctype_id, object_id) in zip(items, keys):
+            if not title or (title=='instance'):
+                inst_title = '%s %s' % (process_name, str(item))
+            else:
+                inst_title = title
+            rows.append((inst_title, process.id, now, user.id, 'running', 'initiated',
+                         ctype_id, object_id, 0))
+        insert_rows(ProcessInstance, ('title', 'process', 'creationTime', 'user',
+                                      'status', 'old_status', 'content_type', 'object_id',
+                                      'depth'), rows)
+        instance_ids = dict(((ctype_id, object_id), id) for id, ctype_id, object_id in
+                            ProcessInstance.objects.filter(id__gt=last_instance, process=process,
+                                                           user=user).values_list(
+                                                           'id', 'content_type', 'object_id'))
+        
+        last_workitem = max_id(WorkItem)
+        due_time = WorkItem(activity=begin, status='inactive').get_due_time(now)
+        insert_rows(WorkItem, ('date', 'user', 'instance', 'activity', 'blocked', 'priority', 'status',
+                               'version', 'due_time'),
+                    [(now, user.id, instance_ids[key], begin.id, False, priority, 'inactive', 0, due_time)
+                     for key in keys])
+        workitem_ids = dict((instance_id, id) for id, instance_id in
+                            WorkItem.objects.filter(id__gt=last_workitem, activity=begin,
+                                                    instance__id__gt=last_instance).values_list(
+                                                    'id', 'instance'))
+        ids = [workitem_ids[instance_ids[key]] for key in keys]
+        
+        insert_m2m_rows(WorkItem, 'pull_roles',
+                        [(id, role_id) for id in ids for role_id in graph.role_ids(begin)])
+        name = 'created by %s' % user.username
+        insert_rows(Event, ('date', 'name', 'workitem'), [(now, name, id) for id in ids])
+        insert_rows(WorklistEntry, WorklistEntry.COLUMNS,
+                    [(user.id, None, id, priority, 'inactive', True, False, now) for id in ids])
+        touch_worklists([(user.id, None)])
+        touch_requests(user.id)
+        if counters_enabled():
+            ProcessStatusCount.objects.move(process.id, None, 'running', len(ids))
+            ActivityStatusCount.objects.move(begin.id, None, 'inactive', len(ids))
+        log.info('process %s: %d instances started by %s', process_name, len(ids), user.username)
+        return ids
 
 
 class ProcessInstance(models.Model):
@@ -156,6 +287,9 @@ class ProcessInstance(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='initiated')
     old_status = models.CharField(max_length=10, choices=STATUS_CHOICES, null=True, blank=True)
     condition = models.CharField(max_length=50, null=True, blank=True)
+    # subflows run in child instances
+    parent_workitem = models.ForeignKey('WorkItem', related_name='subflow_instances', null=True, blank=True)
+    depth = models.IntegerField(default=0)
     
     # refactoring
     content_type = models.ForeignKey(ContentType)
@@ -165,6 +299,18 @@ class ProcessInstance(models.Model):
     # add new ProcessInstanceManager
     objects = ProcessInstanceManager()
     
+    def __init__(self, *args, **kwargs):
+        models.Model.__init__(self, *args, **kwargs)
+        # status known by the status counters
+        self._saved_status = self.pk and self.status or None
+    
+    def save(self, *args, **kwargs):
+        models.Model.save(self, *args, **kwargs)
+        if counters_enabled():
+            ProcessStatusCount.objects.move(self.process_id, self._saved_status, self.status)
+        self._saved_status = self.status
+        touch_requests(self.user_id)
+    
     def wfobject(self):
         return self.content_object
     
@@ -221,10 +367,14 @@ class WorkItemManager(models.Manager):
         return workitem
 
     def list_safe(self, user=None, username=None, queryset='qs_default', activity=None, status=None,
-                      notstatus=('blocked','suspended','fallout','complete'), noauto=True):
+                      notstatus=('blocked','suspended','fallout','complete'), noauto=True, after=None):
         """
         Retrieve list of workitems (in order to display a task list for example).
         
+        Own workitems, workitems pullable by one of the user roles and
+        workitems pullable by anybody are selected with one query, ordered by
+        priority (highest first), date and id.
+        
         :type user: User
         :param user: filter on instance of django.contrib.auth.models.User (default=all) 
         :type username: string
@@ -239,108 +389,124 @@ class WorkItemManager(models.Manager):
         :param notstatus: list of status to exclude (default: [blocked, suspended, fallout, complete])
         :type noauto: bool
         :param noauto: if True (default) auto activities are excluded.
+        :type after: WorkItem or tuple
+        :param after: keyset cursor: only workitems ranked after this one
+                      (a workitem or a (priority, date, id) tuple)
+        :rtype: QuerySet
+        :return: a lazy queryset; slice it for limit/offset pagination,
+                 iterate over .iterator() to stream it.
         
         usage::
         
             workitems = WorkItem.objects.list_safe(user=me, notstatus='complete', noauto=True)
+            page = WorkItem.objects.list_safe(user=me)[:20]
+            next_page = WorkItem.objects.list_safe(user=me, after=page[19])[:20]
         
         """
         if queryset == 'qs_default': queryset = WorkItem.objects
         if status: notstatus = []
         
-        groups = Group.objects.all()
+        # workitems pullable by anybody
+        query = Q(pull_roles__isnull=True, user__isnull=True)
         if user:
-            query = queryset.filter(user=user, activity__process__enabled=True).order_by('-priority')
-            groups = user.groups.all()
+            query |= Q(user=user)
+            query |= Q(pull_roles__in=user.groups.all(), user__isnull=True)
+        elif username:
+            query |= Q(user__username=username)
+            query |= Q(pull_roles__in=Group.objects.filter(user__username=username), user__isnull=True)
         else:
-            if username:
-                query = queryset.filter(
-                        user__username=username, 
-                        activity__process__enabled=True
-                ).order_by('-priority')
-                groups = User.objects.get(username=username).groups.all()
-            else:
-                query = None
-        if query:
-            if status:
-                query = query.filter(status=status)
-            
-            if notstatus:
-                for s in notstatus: 
-                    query = query.exclude(status=s)
-            
-            if noauto:
-                query = query.exclude(activity__autostart=True)
-            
-            if activity:
-                #TODO: this is not used...??
-                sq = query.filter(activity=activity)
-            
-            query = list(query)
-        else:
-            query = []
+            # workitems pullable by any role
+            query |= Q(pull_roles__isnull=False, user__isnull=True)
         
-        # search pullable workitems
-        for role in groups:
-            pullables = queryset.filter(pull_roles=role, activity__process__enabled=True).order_by('-priority')
-            if status:
-                pullables = pullables.filter(status=status)
-            
-            if notstatus:
-                for s in notstatus:
-                    pullables = pullables.exclude(status=s)
-            
-            if noauto:
-                pullables = pullables.exclude(activity__autostart=True)
-            
-            if activity:
-                pullables = pullables.filter(activity=activity)
-            
-            if user:
-                pullables = pullables.filter(user__isnull=True) # tricky
-                pullables = pullables.exclude(user=user)
-                query.extend(list(pullables))
-            
-            if username:
-                pullables = pullables.exclude(user__username=username)
-            
-            log.debug('pullables workitems role %s: %s', role, str(pullables))
-            query.extend(list(pullables))
-        
-        # search workitems pullable by anybody
-        pullables = queryset.filter(pull_roles__isnull=True,
-                                    activity__process__enabled=True,
-                                    user__isnull=True).order_by('-priority')
+        query = queryset.filter(query, activity__process__enabled=True)
         if status:
-            pullables = pullables.filter(status=status)
+            query = query.filter(status=status)
         if notstatus:
-            for s in notstatus:
-                pullables = pullables.exclude(status=s)
+            if isinstance(notstatus, basestring): notstatus = (notstatus,)
+            query = query.exclude(status__in=notstatus)
         if noauto:
-            pullables = pullables.exclude(activity__autostart=True)
+            query = query.exclude(activity__autostart=True)
         if activity:
-            pullables = pullables.filter(activity=activity)
-        if pullables.count() > 0:
-            log.debug('anybody\'s workitems: %s', str(pullables))
-            query.extend(list(pullables))
+            query = query.filter(activity=activity)
+        if after is not None:
+            if isinstance(after, WorkItem):
+                after = (after.priority, after.date, after.id)
+            priority, date, id = after
+            query = query.filter(Q(priority__lt=priority) |
+                                 Q(priority=priority, date__gt=date) |
+                                 Q(priority=priority, date=date, id__gt=id))
+        return query.distinct().order_by('-priority', 'date', 'id')
+    
+    def worklist(self, user, **kwargs):
+        '''
+        Retrieve the worklist of a user from the worklist index
+        (see WorklistEntryManager.worklist for parameters).
         
-        return query
+        usage::
+        
+            workitems = WorkItem.objects.worklist(request.user)
+        
+        '''
+        return WorklistEntry.objects.worklist(user, **kwargs)
     
-    def notify_if_needed(self, user=None, roles=None):
-        ''' notify user if conditions are fullfilled
+    def claim_next(self, user, process=None, activity=None, scan=20):
         '''
-        if user:
-            workitems = self.list_safe(user=user, notstatus='complete', noauto=True)
-            UserProfile.objects.get_or_create(user=user)
-            profile = user.get_profile()
-            if len(workitems) >= profile.nb_wi_notif:
+        Activates for the user the first inactive workitem of their worklist
+        (highest priority, then oldest), and returns it.
+        
+        Candidates are read from the worklist index; each is taken with the
+        version checked update of WorkItem.save, so concurrent claimers get
+        distinct workitems: a claimer losing a race goes on with the next
+        candidate. Candidates the user may no longer take (stale index) are
+        skipped. At most scan candidates are tried. Other errors are raised:
+        the transaction may be aborted.
+        
+        :type user: User
+        :type process: Process
+        :param process: only workitems of this process (optional)
+        :type activity: Activity
+        :param activity: only workitems of this activity (optional)
+        :rtype: WorkItem
+        :return: the activated workitem, or None if none could be taken
+        
+        usage::
+        
+            workitem = WorkItem.objects.claim_next(request.user)
+        
+        '''
+        entries = WorklistEntry.objects._entries(user, noauto=True, status='inactive', notstatus=None)
+        if process: entries = entries.filter(workitem__activity__process=process)
+        if activity: entries = entries.filter(workitem__activity=activity)
+        seen = set()
+        while len(seen) < scan:
+            candidates = entries
+            if seen:
+                candidates = candidates.exclude(workitem__in=seen)
+            candidates = list(candidates.select_related('workitem').order_by(
+                                         '-priority', 'date', 'workitem')[:scan - len(seen)])
+            if not candidates:
+                return None
+            for entry in candidates:
+                if entry.workitem_id in seen:
+                    continue
+                seen.add(entry.workitem_id)
+                workitem = entry.workitem
+                # checked here: _check would make the workitem fall out
+                if workitem.status != 'inactive' or not workitem.check_user(user):
+                    continue
                 try:
-                    if profile.check_notif_to_send():
-                        send_mail(workitems=workitems, user=user, subject='message', template='mail.txt')
-                        profile.notif_sent()
-                        log.info('notification sent to %s' % user.username)
-                except Exception, v:
-                    log.error('sendmail error: %s' % v)
+                    workitem.activate(user)
+                except WorkItemConflict:
+                    # taken by another claimer; its entries are no longer inactive
+                    continue
+                return workitem
+        return None
+    
+    def notify_if_needed(self, user=None, roles=None, workitem=None):
+        ''' queues a notification for the user (see goflow.runtime.outbox)
+        '''
+        if user:
+            Notification.objects.enqueue(user, workitem)
         return
 
 
@@ -364,16 +530,24 @@ class WorkItem(models.Model):
     instance = models.ForeignKey(ProcessInstance, related_name='workitems')
     activity = models.ForeignKey(Activity, related_name='workitems')
     workitem_from = models.ForeignKey('self', related_name='workitems_to', null=True, blank=True)
-    others_workitems_from = models.ManyToManyField('self', related_name='others_workitems_to', null=True, blank=True)
+    # and-joins: the joined workitem comes from these workitems too
+    others_workitems_from = models.ManyToManyField('self', related_name='others_workitems_to',
+                                                   symmetrical=False, null=True, blank=True)
     push_roles = models.ManyToManyField(Group, related_name='push_workitems', null=True, blank=True)
     pull_roles = models.ManyToManyField(Group, related_name='pull_workitems', null=True, blank=True)
     blocked = models.BooleanField(default=False)
-    priority = models.IntegerField(default=0)
+    priority = models.IntegerField(default=0, db_index=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='inactive')
+    due_time = models.DateTimeField(null=True, blank=True, db_index=True, editable=False,
+                                    help_text='time_out transitions are due (see goflow.runtime.timers)')
+    # incremented by each save (optimistic concurrency control)
+    version = models.IntegerField(default=0, editable=False)
 
     objects = WorkItemManager()
     
-    def forward(self, timeout_forwarding=False, subflow_workitem=None):
+    @measure('forward')
+    @buffer_events
+    def forward(self, timeout_forwarding=False, subflow_workitem=None, destinations=None):
         # forward_workitem(workitem, path=None, timeout_forwarding=False, subflow_workitem=None):
         '''
         Convenience procedure to forwards workitems to valid destination activities.
@@ -384,26 +558,30 @@ class WorkItem(models.Model):
         @param timeoutForwarding:
         @type: subflow_workitem: WorkItem
         @param subflow_workitem: a workitem associated with a subflow ???
+        @type destinations: [Activity]
+        @param destinations: destinations already evaluated (default: get_destinations)
         
         '''
-        log.info(u'forward_workitem %s', self.__unicode__())
+        log.info('forward_workitem %s', self.pk, extra=log.ids(self))
         if not timeout_forwarding:
             if self.status != 'complete':
                 return
         if self.has_workitems_to() and not subflow_workitem:
-            log.debug('forward_workitem canceled for %s: ' 
-                       'workitem.has_workitems_to()', self.__unicode__())
+            log.debug('forward_workitem canceled for %s: '
+                      'workitem.has_workitems_to()', self.pk, extra=log.ids(self))
             return
         
         if timeout_forwarding:
-            log.info('timeout forwarding')
-            Event.objects.create(name='timeout', workitem=self)
+            log.info('timeout forwarding', extra=log.ids(self))
+            Event.objects.record('timeout', workitem=self)
         
-        for destination in self.get_destinations(timeout_forwarding):
+        if destinations is None:
+            destinations = self.get_destinations(timeout_forwarding)
+        for destination in destinations:
             self._forward_workitem_to_activity(destination)
             if self.activity.split_mode == 'xor': break
 
-    def _forward_workitem_to_activity(self, target_activity):
+    def _forward_workitem_to_activity(self, target_activity, instance=None):
         '''
         Passes the process instance embedded in the given workitem 
         to a new workitem that is associated with the destination activity.
@@ -411,78 +589,95 @@ class WorkItem(models.Model):
         @type target_activity: Activity
         @param target_activity: the activity instance to which the workitem 
                                 should be forwarded
+        @type instance: ProcessInstance
+        @param instance: instance of the new workitem (default: same instance;
+                         a child instance for subflows)
         @rtype: WorkItem
         @return: a workitem that has been passed on to the next 
                  activity (and next user)
         '''
-        instance = self.instance
-        # search a blocked workitem first
-        qwi = WorkItem.objects.filter(instance=instance, activity=target_activity, status='blocked')
-        if qwi.count() == 0:
-            wi = WorkItem.objects.create(instance=instance, activity=target_activity,
-                                         user=None, priority=self.priority)
-            created = True
-            log.info('forwarded to %s', target_activity.title)
-            Event.objects.create(name='creation by %s' % self.user.username, workitem=wi)
-            Event.objects.create(name='forwarded to %s' % target_activity.title, workitem=self)
-            wi.workitem_from = self
-        else:
-            created = False
-            wi = qwi[0]
-        
-        if target_activity.join_mode == 'and':
-            nb_input_transitions = target_activity.nb_input_transitions()
-            if nb_input_transitions > 1:
-                if created:
-                    # first worktem: block it
-                    wi.block()
-                    return    
-                else:
-                    wi.others_workitems_from.add(self)
-                    if wi.others_workitems_from.all().count() + 1 < nb_input_transitions:
-                        # keep blocked
-                        return
-                    else:
-                        # check if the join is OK
-                        if wi.check_join():
-                            wi.status = 'inactive'
-                            wi.save()
-                            log.info('activity %s: workitem %s unblocked', target_activity.title, str(wi))
-                        else:
-                            return
+        if instance is None:
+            instance = self.instance
+        graph = get_activity_graph(target_activity)
+        nb_input_transitions = graph.nb_input_transitions(target_activity)
+        if target_activity.join_mode == 'and' and nb_input_transitions > 1:
+            wi = JoinState.objects.arrive(self, target_activity, nb_input_transitions, instance)
+            if wi is None:
+                # keep blocked
+                return
+            # check if the join is OK
+            if not wi.check_join():
+                return
+            wi.status = 'inactive'
+            # indexed below, once its user or pull roles are known
+            wi.save(index=False)
+            log.info('activity %s: workitem %s unblocked', target_activity.title, wi.pk, extra=log.ids(wi))
         else:
-            if not created:
+            # search a blocked workitem first
+            qwi = WorkItem.objects.filter(instance=instance, activity=target_activity,
+                                          status='blocked')
+            if qwi.count() == 0:
+                wi = self._create_workitem(target_activity, instance)
+            elif target_activity.join_mode != 'and':
                 # join_mode='and'
                 log.error('activity %s: join_mode must be and', target_activity.title)
+                wi = qwi[0]
                 self.fall_out()
                 wi.fall_out()
                 return
+            else:
+                wi = qwi[0]
         
         if target_activity.autostart:
-            log.info('run auto activity %s workitem %s', target_activity.title, str(wi))
-            try:
-                auto_user = User.objects.get(username=settings.WF_USER_AUTO)
-            except Exception:
-                error = 'a user named %s (settings.WF_USER_AUTO) must be defined for auto activities'
-                raise Exception(error % settings.WF_USER_AUTO)
-            wi.activate(actor=auto_user)
-            if wi.exec_auto_application():
-                wi.complete(actor=auto_user)
+            if getattr(settings, 'WF_AUTO_ASYNC', False):
+                # run later by goflow.runtime.autoexec workers
+                wi.index()
+                AutoTask.objects.enqueue(wi)
+                return wi
+            log.info('run auto activity %s workitem %s', target_activity.title, wi.pk, extra=log.ids(wi))
+            wi.run_auto_activity()
             return wi
         
         if target_activity.push_application:
             target_user = wi.exec_push_application()
-            log.info('application pushed to user %s', target_user.username)
+            log.info('application pushed to user %s', target_user.username, extra=log.ids(wi))
             wi.user = target_user
             wi.save()
-            Event.objects.create(name='assigned to %s' % target_user.username, workitem=wi)
-            WorkItem.objects.notify_if_needed(user=target_user)
+            Event.objects.record('assigned to %s' % target_user.username, workitem=wi)
+            Notification.objects.enqueue(target_user, wi)
         else:
-            wi.pull_roles = wi.activity.roles.all()
+            wi.pull_roles = graph.roles(target_activity)
             wi.save()
-            WorkItem.objects.notify_if_needed(roles=wi.pull_roles)
         return wi
     
+    def _create_workitem(self, target_activity, instance=None):
+        '''
+        creates the workitem following this one in target_activity.
+        '''
+        wi = self._new_workitem(target_activity, instance)
+        self._record_forward(wi, target_activity)
+        return wi
+    
+    def _new_workitem(self, target_activity, instance=None, status='inactive'):
+        # indexed by the caller, once its user or pull roles are known
+        wi = WorkItem(instance=instance or self.instance, activity=target_activity,
+                      user=None, priority=self.priority, workitem_from=self, status=status)
+        wi.save(index=False)
+        return wi
+    
+    def _record_forward(self, wi, target_activity):
+        log.info('forwarded to %s', target_activity.title, extra=log.ids(self))
+        Event.objects.record('creation by %s' % self.user.username, workitem=wi)
+        Event.objects.record('forwarded to %s' % target_activity.title, workitem=self)
+    
+    def discard(self):
+        '''
+        deletes a workitem that was never used (no event, no successor).
+        '''
+        WorkItem.objects.filter(pk=self.pk).delete()
+        if counters_enabled():
+            ActivityStatusCount.objects.move(self.activity_id, self._saved_status, None)
+    
     def check_join(self):
         log.warning('workitem check_join NYI- useful ?')
         return True
@@ -496,8 +691,9 @@ class WorkItem(models.Model):
         if type(status)==type(''):
             status = (status,)
             
-        if not self.activity.process.enabled:
-            error = 'process %s disabled.' % self.activity.process.title
+        graph = get_activity_graph(self.activity_id)
+        if not graph.enabled:
+            error = 'process %s disabled.' % graph.title
             log.error('workitem._check: %s' % error)
             raise Exception(error)
             
@@ -514,6 +710,7 @@ class WorkItem(models.Model):
             raise Exception(error)
         return
     
+    @measure('get_destinations')
     def get_destinations(self, timeout_forwarding=False):
         #get_destinations(workitem, path=None, timeout_forwarding=False):
         '''
@@ -526,9 +723,10 @@ class WorkItem(models.Model):
         @rtype: [Activity]
         @return: list of destination activities.
         '''
-        transitions = Transition.objects.filter(input=self.activity)
+        transitions = get_activity_graph(self.activity_id).outgoing(self.activity_id)
         if timeout_forwarding:
-            transitions = transitions.filter(condition__contains='workitem.time_out')
+            transitions = [t for t in transitions
+                           if t.condition and 'workitem.time_out' in t.condition]
         destinations = []
         for t in transitions:
             if self.eval_transition_condition(t):
@@ -539,38 +737,21 @@ class WorkItem(models.Model):
         '''
         evaluate the condition of a transition
         '''
-        if not transition.condition:
-            return True
-        instance = self.instance
-        wfobject = instance.wfobject()
-        log.debug('eval_transition_condition %s - %s', 
-            transition.condition, instance.condition)
-        try:
-            result = eval(transition.condition)
-            
-            # boolean expr
-            if type(result) == type(True):
-                log.debug('eval_transition_condition boolean %s', str(result))
-                return result
-            if type(result) == type(''):
-                log.debug('eval_transition_condition cmp instance.condition %s', str(instance.condition==result))
-                return (instance.condition==result)
-        except Exception, v:
-            log.debug('eval_transition_condition [%s]: %s', transition.condition, v)
-            return (instance.condition==transition.condition)
-            #log.error('eval_transition_condition [%s]: %s', transition.condition, v)
-        return False
+        condition = get_condition(transition)
+        result = condition.evaluate(self, transition)
+        log.debug('eval_transition_condition %s [%s]: %s',
+                  condition.kind, transition.condition, result, extra=log.ids(self))
+        return result
     
+    @measure('exec_push_application')
     def exec_push_application(self):
         '''
         Execute push application in workitem
         '''
         if not self.activity.process.enabled:
             raise Exception('process %s disabled.' % self.activity.process.title)
-        params = self.activity.pushapp_param
         try:
-            if params: kwargs = eval(params)
-            else: kwargs = {}
+            kwargs = self.activity.get_pushapp_params()
             result = self.activity.push_application.execute(self, **kwargs)
         except Exception, v:
             log.error('exec_push_application %s', v)
@@ -578,6 +759,7 @@ class WorkItem(models.Model):
             self.fall_out()
         return result
     
+    @measure('exec_auto_application')
     def exec_auto_application(self):
         '''
         creates a test auto application for activities that don't yet have applications
@@ -590,16 +772,33 @@ class WorkItem(models.Model):
             if not self.activity.application:
                 return self.default_auto_app()
             
-            func, args, kwargs = resolve(self.activity.application.get_app_url())
-            params = self.activity.app_param
+            func, kwargs = get_auto_handler(self.activity.application.url)
+            kwargs = kwargs.copy()
             # params values defined in activity override those defined in urls.py
-            if params:
-                params = eval('{'+params.lstrip('{').rstrip('}')+'}')
-                kwargs.update(params)
+            kwargs.update(self.activity.get_app_params())
             func(workitem=self , **kwargs)
             return True
         except Exception, v:
-            log.error('execution wi %s:%s', self, v)
+            log.error('execution wi %s:%s', self.pk, v, extra=log.ids(self))
+        return False
+    
+    def run_auto_activity(self):
+        '''
+        activates the workitem as settings.WF_USER_AUTO, runs its auto
+        application and completes it if the application succeeded.
+        
+        @rtype: bool
+        @return: True if the workitem was completed
+        '''
+        try:
+            auto_user = User.objects.get(username=settings.WF_USER_AUTO)
+        except Exception:
+            error = 'a user named %s (settings.WF_USER_AUTO) must be defined for auto activities'
+            raise Exception(error % settings.WF_USER_AUTO)
+        self.activate(actor=auto_user)
+        if self.exec_auto_application():
+            self.complete(actor=auto_user)
+            return True
         return False
     
     def default_auto_app(self):
@@ -614,6 +813,8 @@ class WorkItem(models.Model):
         obj.save()
         return True
     
+    @measure('activate')
+    @buffer_events
     def activate(self, actor):
         '''
         changes workitem status to 'active' and logs event, activator
@@ -621,16 +822,18 @@ class WorkItem(models.Model):
         '''
         self._check(actor, ('inactive', 'active'))
         if self.status == 'active':
-            log.warning('activate_workitem actor %s workitem %s already active', 
-                        actor.username, str(self))
+            log.warning('activate_workitem actor %s workitem %s already active',
+                        actor.username, self.pk, extra=log.ids(self))
             return
         self.status = 'active'
         self.user = actor
         self.save()
-        log.info('activate_workitem actor %s workitem %s', 
-                 actor.username, str(self))
-        Event.objects.create(name='activated by %s' % actor.username, workitem=self)
+        log.info('activate_workitem actor %s workitem %s',
+                 actor.username, self.pk, extra=log.ids(self))
+        Event.objects.record('activated by %s' % actor.username, workitem=self)
     
+    @measure('complete')
+    @buffer_events
     def complete(self, actor):
         '''
         changes status of workitem to 'complete' and logs event
@@ -639,46 +842,45 @@ class WorkItem(models.Model):
         self.status = 'complete'
         self.user = actor
         self.save()
-        log.info('complete_workitem actor %s workitem %s', actor.username, str(self))
-        Event.objects.create(name='completed by %s' % actor.username, workitem=self)
+        log.info('complete_workitem actor %s workitem %s', actor.username, self.pk, extra=log.ids(self))
+        Event.objects.record('completed by %s' % actor.username, workitem=self)
         
         if self.activity.autofinish:
             log.debug('activity autofinish: forward')
             self.forward()
         
         # if end activity, instance is complete
-        if self.instance.process.end == self.activity:
-            log.info('activity end process %s' % self.instance.process.title)
-            # first test subflow
-            lwi = WorkItem.objects.filter(activity__subflow=self.instance.process,
-                                          status='blocked',
-                                          instance=self.instance)
-            if lwi.count() > 0:
-                log.info('parent process for subflow %s' % self.instance.process.title)
-                workitem0 = lwi[0]
-                workitem0.instance.process = workitem0.activity.process
-                workitem0.instance.save()
-                log.info('process change for instance %s' % workitem0.instance.title)
+        graph = get_activity_graph(self.activity_id)
+        if graph.end and graph.end.id == self.activity_id:
+            log.info('activity end process %s', graph.title, extra=log.ids(self))
+            self.instance.set_status('complete')
+            # subflow: back to the parent instance
+            if self.instance.parent_workitem_id:
+                log.info('parent process for subflow %s', graph.title, extra=log.ids(self))
+                workitem0 = WorkItem.objects.get(pk=self.instance.parent_workitem_id)
                 workitem0.status = 'complete'
                 workitem0.save()
                 workitem0.forward(subflow_workitem=self)
-            else:
-                self.instance.set_status('complete')
     
     def start_subflow(self, actor=None):
         '''
-        starts subflow and blocks passed in workitem
+        starts subflow in a child instance and blocks passed in workitem
         '''
         if not actor: actor = self.user
-        subflow_begin_activity = self.activity.subflow.begin
-        instance = self.instance
-        instance.process = self.activity.subflow
-        instance.save()
+        activity = get_activity_graph(self.activity_id).activity(self.activity_id)
+        subgraph = get_graph(activity.subflow_id)
+        parent = self.instance
+        instance = ProcessInstance.objects.create(process=subgraph.process, user=parent.user,
+                                                  title='%s (%s)' % (parent.title, subgraph.title),
+                                                  status='running', old_status='initiated',
+                                                  content_type_id=parent.content_type_id,
+                                                  object_id=parent.object_id,
+                                                  parent_workitem=self, depth=parent.depth + 1)
         self.status = 'blocked'
         self.blocked = True
         self.save()
         
-        sub_workitem = self._forward_workitem_to_activity(subflow_begin_activity)
+        sub_workitem = self._forward_workitem_to_activity(subgraph.begin, instance)
         return sub_workitem
     
     def eval_condition(self, transition):
@@ -702,22 +904,16 @@ class WorkItem(models.Model):
         
         For dummy activities, returns always True
         """
-        if self.activity.kind == 'dummy':
+        graph = get_activity_graph(self.activity_id)
+        if graph.activity(self.activity_id).kind == 'dummy':
             return True
         
-        if user and self.user and self.user != user:
+        if user and self.user_id and self.user_id != user.id:
             return False
-        ugroups = user.groups.all()
-        agroups = self.activity.roles.all()
-        authorized = False
-        if agroups and len(agroups) > 0:
-            for g in ugroups:
-                if g in agroups:
-                    authorized = True
-                    break
-        else:
-            authorized = True
-        return authorized
+        role_ids = graph.role_ids(self.activity_id)
+        if not role_ids:
+            return True
+        return len(role_ids & get_user_roles(user).group_ids) > 0
             
     def set_user(self, user, commit=True):
         """affect user if he has a role authorized for activity.
@@ -741,22 +937,19 @@ class WorkItem(models.Model):
         and this group's name must be the same as the process title.
         '''
         if self.user.has_perm("workitem.can_change_priority"):
-            lst = self.user.groups.filter(name=self.instance.process.title)
-            if lst.count()==0 or \
-               (lst[0].permissions.filter(codename='can_change_priority').count() == 0):
-                return False
-            return True
+            title = get_activity_graph(self.activity_id).title
+            return get_user_roles(self.user).has_group_perm(title, 'can_change_priority')
         return False
     
     def block(self):
         self.status = 'blocked'
         self.save()
-        Event.objects.create(name='blocked', workitem=self)
+        Event.objects.record('blocked', workitem=self)
     
     def fall_out(self):
         self.status = 'fallout'
         self.save()
-        Event.objects.create(name='fallout', workitem=self)
+        Event.objects.record('fallout', workitem=self)
         if not settings.DEBUG:
             mail_admins(subject='workflow workitem %s fall out' % str(self.pk),
                     message=u'''
@@ -803,6 +996,75 @@ instance: %s
         now = datetime.now()
         return (now > (self.date + tdelta))
     
+    def __init__(self, *args, **kwargs):
+        models.Model.__init__(self, *args, **kwargs)
+        # status known by the status counters
+        self._saved_status = self.pk and self.status or None
+        # worklist entries, as of the last index (None: unknown)
+        self._indexed = self.pk and self._index_key() or None
+    
+    def save(self, *args, **kwargs):
+        '''
+        saves the workitem if it was not modified since it was read: the row
+        is updated only if its version is still self.version.
+        
+        raises WorkItemConflict otherwise.
+        
+        The worklist entries are refreshed (see index), unless index=False.
+        '''
+        index = kwargs.pop('index', True)
+        self.due_time = self.get_due_time(datetime.now())
+        if self.pk is None or kwargs.get('force_insert') or (args and args[0]):
+            models.Model.save(self, *args, **kwargs)
+        else:
+            self._save_version(kwargs.get('using'))
+        if index:
+            self.index()
+        if counters_enabled():
+            ActivityStatusCount.objects.move(self.activity_id, self._saved_status, self.status)
+        self._saved_status = self.status
+    
+    def _index_key(self):
+        return (self.status, self.user_id, self.priority, self.activity_id)
+    
+    def index(self):
+        '''
+        refreshes the worklist entries of the workitem if its status, user,
+        priority or pull roles changed since the last refresh.
+        '''
+        key = self._index_key()
+        if key != self._indexed:
+            WorklistEntry.objects.refresh(self)
+            self._indexed = key
+    
+    def _save_version(self, using=None):
+        # the signals are sent as by Model.save_base
+        using = using or router.db_for_write(WorkItem, instance=self)
+        signals.pre_save.send(sender=WorkItem, instance=self, raw=False, using=using)
+        values = {}
+        for field in self._meta.local_fields:
+            if not field.primary_key:
+                values[field.name] = field.pre_save(self, False)
+        values['version'] = self.version + 1
+        if not WorkItem.objects.using(using).filter(pk=self.pk, version=self.version).update(**values):
+            raise WorkItemConflict('workitem %d was modified by another request.' % self.pk)
+        self.version += 1
+        self._state.db = using
+        signals.post_save.send(sender=WorkItem, instance=self, created=False, raw=False,
+                               using=using)
+    
+    def get_due_time(self, date):
+        '''
+        returns the time the time_out transitions of the activity are due,
+        given the last modification date of the workitem (None if no timer).
+        '''
+        if self.status in ('complete', 'fallout'):
+            return None
+        delay = get_activity_graph(self.activity_id).timeout(self.activity_id)
+        if delay is None:
+            return None
+        return date + timedelta(seconds=delay)
+    
     @allow_tags
     def events_list(self):
         '''provide html link to events for a workitem in admin change list.
@@ -817,6 +1079,347 @@ instance: %s
             ("can_change_priority", "Can change priority"),
         )
 
+class JoinStateManager(models.Manager):
+    '''Custom model manager for JoinState
+    '''
+    def arrive(self, workitem, activity, expected, instance=None):
+        '''
+        Registers the arrival of a branch at an AND join.
+        
+        Each branch increments the arrival counter of the join state with
+        an update: the update locks the row and sees the committed state
+        even under REPEATABLE READ, so that concurrent completions are
+        counted once each and the count read back after it is current.
+        
+        When there is no state (first branch, or first branch of a new round
+        once the last one deleted the state), the branch creates the blocked
+        workitem, then the state holding it: the state is never seen without
+        its workitem. A branch losing the race to create the state discards
+        its workitem and counts its arrival on the winner's state.
+        
+        :type workitem: WorkItem
+        :param workitem: the completed workitem of the arriving branch
+        :type activity: Activity
+        :param activity: the join activity
+        :type expected: int
+        :param expected: number of branches to wait for
+        :type instance: ProcessInstance
+        :param instance: instance of the join (default: workitem.instance)
+        :rtype: WorkItem
+        :return: the joined workitem when the last branch arrives, None otherwise
+        '''
+        if instance is None:
+            instance = workitem.instance
+        while not self.filter(instance=instance, activity=activity).update(
+                                                    arrivals=F('arrivals') + 1):
+            # first workitem: blocked until the last branch arrives
+            wi = workitem._new_workitem(activity, instance, status='blocked')
+            sid = transaction.savepoint()
+            try:
+                self.create(instance=instance, activity=activity, expected=expected,
+                            arrivals=1, workitem=wi)
+            except IntegrityError:
+                # another branch created the state meanwhile: count on it
+                transaction.savepoint_rollback(sid)
+                wi.discard()
+                continue
+            transaction.savepoint_commit(sid)
+            wi.index()
+            workitem._record_forward(wi, activity)
+            Event.objects.record('blocked', workitem=wi)
+            return None
+        
+        # our own write is visible to this read, and the row is locked
+        state = self.get(instance=instance, activity=activity)
+        wi = WorkItem.objects.get(pk=state.workitem_id)
+        wi.others_workitems_from.add(workitem)
+        if state.arrivals < state.expected:
+            return None
+        # the join may be reached again (loops)
+        self.filter(pk=state.pk).delete()
+        return wi
+
+
+class JoinState(models.Model):
+    """Progress of an AND join for a process instance.
+    
+    The row lives while branches are arriving at the join activity;
+    it holds the blocked workitem and the arrival counter.
+    """
+    instance = models.ForeignKey(ProcessInstance, related_name='join_states')
+    activity = models.ForeignKey(Activity, related_name='join_states')
+    workitem = models.ForeignKey(WorkItem, related_name='join_states', null=True, blank=True)
+    arrivals = models.IntegerField(default=0)
+    expected = models.IntegerField()
+    
+    objects = JoinStateManager()
+    
+    def __unicode__(self):
+        return u'%s: %d/%d' % (self.activity.title, self.arrivals, self.expected)
+    
+    class Meta:
+        unique_together = (("instance", "activity"),)
+
+
+class AutoTaskManager(models.Manager):
+    '''Custom model manager for AutoTask
+    '''
+    def enqueue(self, workitem):
+        '''
+        queues an auto activity workitem for goflow.runtime.autoexec workers.
+        '''
+        log.info('auto activity workitem %s queued', workitem.pk, extra=log.ids(workitem))
+        return self.create(workitem=workitem, activity_id=workitem.activity_id)
+    
+    def claim(self, worker='', limits=None, scan=20):
+        '''
+        Claims the oldest queued task and marks it running.
+        
+        The claim is a conditional update, so that concurrent workers never
+        run the same task. An activity with a concurrency limit of n has n
+        slots, TimerLease rows taken with a conditional update before the
+        claim: no more than n of its tasks run at once, whatever the number
+        of workers. A slot is held by the claiming worker (see
+        AutoTask.holder), so a worker losing the claim of a task releases
+        its own slot, never the winner's. Slots are released when the task
+        ends (see AutoTask.run) and expire after settings.WF_AUTO_STALE
+        seconds (default 3600).
+        
+        :type worker: string
+        :param worker: name of the claiming worker, unique among the workers
+        :type limits: dict
+        :param limits: max running tasks per activity, keyed by activity id
+                       or activity title (default: settings.WF_AUTO_CONCURRENCY)
+        :type scan: int
+        :param scan: number of queued tasks examined
+        :rtype: AutoTask
+        :return: the claimed task, or None
+        '''
+        if limits is None:
+            limits = getattr(settings, 'WF_AUTO_CONCURRENCY', {})
+        for task in self.filter(status='queued').order_by('id')[:scan]:
+            task.worker = worker
+            limit = None
+            if limits:
+                title = get_activity_graph(task.activity_id).activity(task.activity_id).title
+                limit = limits.get(task.activity_id, limits.get(title))
+            if limit and not self._take_slot(task, limit):
+                continue
+            now = datetime.now()
+            if self.filter(pk=task.pk, status='queued').update(status='running', started=now,
+                                                               worker=worker):
+                task.status, task.started = 'running', now
+                return task
+            if limit:
+                task.release_slot()
+        return None
+    
+    def _take_slot(self, task, limit):
+        seconds = getattr(settings, 'WF_AUTO_STALE', 3600)
+        for i in range(limit):
+            if TimerLease.objects.acquire('auto.%d.%d' % (task.activity_id, i), task.holder(), seconds):
+                return True
+        return False
+    
+    def requeue_stale(self, seconds=3600):
+        '''
+        requeues tasks left running by a dead worker.
+        '''
+        limit = datetime.now() - timedelta(seconds=seconds)
+        stale = list(self.filter(status='running', started__lt=limit))
+        count = 0
+        for task in stale:
+            task.release_slot()
+        for part in chunks([task.pk for task in stale]):
+            count += self.filter(pk__in=part, status='running').update(status='queued')
+        return count
+
+
+class AutoTask(models.Model):
+    """An auto activity workitem waiting to be run outside of the request.
+    
+    Tasks are queued when settings.WF_AUTO_ASYNC is True;
+    see goflow.runtime.autoexec.
+    """
+    STATUS_CHOICES = (
+                      ('queued', 'queued'),
+                      ('running', 'running'),
+                      ('done', 'done'),
+                      ('failed', 'failed'),
+                      )
+    workitem = models.ForeignKey(WorkItem, related_name='auto_tasks')
+    activity = models.ForeignKey(Activity, related_name='auto_tasks')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued', db_index=True)
+    date = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=50, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    
+    objects = AutoTaskManager()
+    
+    @transaction.commit_on_success
+    def run(self):
+        '''
+        runs the auto activity of a claimed task.
+        
+        @rtype: bool
+        @return: True if the workitem was completed
+        '''
+        try:
+            done = self.workitem.run_auto_activity()
+            if not done:
+                self.error = 'auto application failed (see log)'
+        except Exception, v:
+            log.error('auto task %d: %s', self.pk, v)
+            done = False
+            self.error = str(v)
+        self.status = done and 'done' or 'failed'
+        self.finished = datetime.now()
+        self.save()
+        self.release_slot()
+        return done
+    
+    def holder(self):
+        '''holder of the concurrency slot of the task: its worker and the task
+        (see AutoTaskManager.claim).'''
+        return '%s:%d' % (self.worker or '', self.pk)
+    
+    def release_slot(self):
+        TimerLease.objects.filter(name__startswith='auto.%d.' % self.activity_id,
+                                  holder=self.holder()).update(expires=datetime.now())
+    
+    def __unicode__(self):
+        return u'%s (%s)' % (str(self.workitem_id), self.status)
+
+
+class TimerLeaseManager(models.Manager):
+    '''Custom model manager for TimerLease
+    '''
+    def acquire(self, name, holder, seconds):
+        '''
+        takes or renews the lease if it is free, expired or already ours.
+        
+        @rtype: bool
+        @return: True if the lease is held by holder
+        '''
+        now = datetime.now()
+        expires = now + timedelta(seconds=seconds)
+        if self.filter(Q(holder=holder) | Q(expires__lt=now), name=name).update(
+                                                    holder=holder, expires=expires):
+            return True
+        lease, created = self.get_or_create(name=name, defaults={'holder':holder,
+                                                                 'expires':expires})
+        return created
+    
+    def release(self, name, holder):
+        self.filter(name=name, holder=holder).update(expires=datetime.now())
+
+
+class TimerLease(models.Model):
+    """A lease electing the server that fires timers in a cluster; also
+    the concurrency slots of auto activities (see AutoTaskManager.claim).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    holder = models.CharField(max_length=100)
+    expires = models.DateTimeField()
+    
+    objects = TimerLeaseManager()
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.name, self.holder)
+
+
+def counters_enabled():
+    '''status counters are maintained if settings.WF_STATUS_COUNTERS is True.
+    '''
+    return getattr(settings, 'WF_STATUS_COUNTERS', False)
+
+
+class StatusCounterManager(models.Manager):
+    '''Custom model manager for ActivityStatusCount and ProcessStatusCount
+    '''
+    def __init__(self, owner):
+        models.Manager.__init__(self)
+        # name of the ForeignKey to the counted activity/process
+        self.owner = owner
+    
+    def move(self, owner_id, old_status, new_status, n=1):
+        '''
+        moves n objects from a status to another; old_status is None for
+        new objects.
+        '''
+        if old_status == new_status:
+            return
+        if old_status:
+            self.filter(**{self.owner:owner_id, 'status':old_status}).update(count=F('count') - n)
+        if new_status:
+            if self.filter(**{self.owner:owner_id, 'status':new_status}).update(count=F('count') + n):
+                return
+            counter, created = self.get_or_create(defaults={self.owner + '_id':owner_id, 'count':n},
+                                                  **{self.owner + '__id':owner_id, 'status':new_status})
+            if not created:
+                self.filter(pk=counter.pk).update(count=F('count') + n)
+    
+    def rebuild(self, counts):
+        '''
+        replaces the counters by counts: {owner id: {status: count}}.
+        '''
+        self.all().delete()
+        for owner_id, statuses in counts.items():
+            for status, count in statuses.items():
+                self.create(**{self.owner + '_id':owner_id, 'status':status, 'count':count})
+
+
+class ActivityStatusCount(models.Model):
+    """Number of workitems of an activity in a status.
+    
+    Maintained by WorkItem.save when settings.WF_STATUS_COUNTERS is True.
+    """
+    activity = models.ForeignKey(Activity, related_name='status_counts')
+    status = models.CharField(max_length=10, choices=WorkItem.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+    
+    objects = StatusCounterManager('activity')
+    
+    class Meta:
+        unique_together = (("activity", "status"),)
+
+
+class ProcessStatusCount(models.Model):
+    """Number of instances of a process in a status.
+    
+    Maintained by ProcessInstance.save when settings.WF_STATUS_COUNTERS is True.
+    """
+    process = models.ForeignKey(Process, related_name='status_counts')
+    status = models.CharField(max_length=10, choices=ProcessInstance.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+    
+    objects = StatusCounterManager('process')
+    
+    class Meta:
+        unique_together = (("process", "status"),)
+
+
+class EventManager(models.Manager):
+    '''Custom model manager for Event
+    '''
+    def record(self, name, workitem):
+        '''
+        Records an event; the row is buffered if an event buffer is open
+        (see goflow.runtime.events), written immediately otherwise.
+        
+        usage::
+        
+            Event.objects.record('activated by %s' % user.username, workitem)
+        
+        '''
+        buffer = current_buffer()
+        if buffer is None:
+            return self.create(name=name, workitem=workitem)
+        buffer.add(name, workitem)
+
+
 class Event(models.Model):
     """Event are changes that happens on workitems.
     """
@@ -824,6 +1427,323 @@ class Event(models.Model):
     name = models.CharField(max_length=50)
     workitem = models.ForeignKey(WorkItem, related_name='events')
     
+    objects = EventManager()
+    
     def __unicode__(self):
         return self.name
 
+
+class StatsWatermark(models.Model):
+    """Last Event id folded into a rollup table, and the lower ids that
+    were not committed yet when it moved (rescanned by the next runs).
+    """
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.IntegerField(default=0)
+    # 'id:time' items separated by spaces (time: when the id was found missing)
+    pending = models.TextField(blank=True, default='')
+    
+    def __unicode__(self):
+        return u'%s: %d' % (self.name, self.last_id)
+
+
+class ActivityStatsRollupManager(models.Manager):
+    '''Custom model manager for ActivityStatsRollup
+    '''
+    def merge(self, activity_id, user_id, day, sketch):
+        '''
+        adds the durations of a QuantileSketch to the rollup of
+        (activity, user, day).
+        '''
+        rows = list(self.filter(activity__id=activity_id, user__id=user_id, day=day)[:1])
+        if rows:
+            rollup = rows[0]
+            sketch = QuantileSketch.loads(rollup.sketch).merge(sketch)
+        else:
+            rollup = self.model(activity_id=activity_id, user_id=user_id, day=day)
+        rollup.number = sketch.count
+        rollup.time_total = sketch.sum
+        rollup.time_min = sketch.min
+        rollup.time_max = sketch.max
+        rollup.sketch = sketch.dumps()
+        rollup.save()
+        return rollup
+
+
+class ActivityStatsRollup(models.Model):
+    """Cycle times (seconds) of the workitems of an activity completed by a user in a day.
+    
+    The sketch field holds a serialized QuantileSketch (see goflow.runtime.sketch);
+    rows are updated by goflow.runtime.reporting.update_activity_stats.
+    """
+    activity = models.ForeignKey(Activity, related_name='stats_rollups')
+    user = models.ForeignKey(User, related_name='activity_stats_rollups', null=True, blank=True)
+    day = models.DateField(db_index=True)
+    number = models.IntegerField(default=0)
+    time_total = models.FloatField(default=0)
+    time_min = models.FloatField(null=True)
+    time_max = models.FloatField(null=True)
+    sketch = models.TextField()
+    
+    objects = ActivityStatsRollupManager()
+    
+    class Meta:
+        unique_together = (("activity", "user", "day"),)
+    
+    def __unicode__(self):
+        return u'%s %s %s' % (self.activity.title, self.day, self.user)
+
+
+class WorklistEntryManager(models.Manager):
+    '''Custom model manager for WorklistEntry
+    '''
+    def refresh(self, workitem):
+        '''
+        rebuilds the index entries of a workitem (called by WorkItem.index).
+        '''
+        targets = list(self.filter(workitem=workitem).values_list('user', 'role'))
+        self.filter(workitem=workitem).delete()
+        if workitem.status != 'complete':
+            rows = self.rows(workitem)
+            insert_rows(WorklistEntry, WorklistEntry.COLUMNS, rows)
+            targets.extend([row[:2] for row in rows])
+        touch_worklists(targets)
+    
+    def rebuild(self):
+        '''
+        rebuilds the whole index from the workitems (e.g. after an upgrade).
+        
+        @rtype: int
+        @return: number of indexed workitems
+        '''
+        self.all().delete()
+        count = 0
+        for workitem in WorkItem.objects.exclude(status='complete').iterator():
+            insert_rows(WorklistEntry, WorklistEntry.COLUMNS, self.rows(workitem))
+            count += 1
+        touch_all()
+        return count
+    
+    def rows(self, workitem, role_ids=None):
+        '''
+        returns the index rows of a workitem, in WorklistEntry.COLUMNS order.
+        '''
+        graph = get_activity_graph(workitem.activity_id)
+        activity = graph.activity(workitem.activity_id)
+        values = (workitem.id, workitem.priority, workitem.status, graph.enabled,
+                  activity.autostart, workitem.date)
+        if workitem.user_id:
+            return [(workitem.user_id, None) + values]
+        if role_ids is None:
+            role_ids = workitem.pull_roles.values_list('id', flat=True)
+        if not role_ids:
+            # pullable by anybody
+            return [(None, None) + values]
+        return [(None, role_id) + values for role_id in role_ids]
+    
+    def worklist(self, user, noauto=True, status=None,
+                 notstatus=('blocked','suspended','fallout','complete')):
+        '''
+        Retrieve the workitems of a user (own items, items pullable by one
+        of their roles or by anybody) with one query on the index.
+        
+        :type user: User
+        :param user: an instance of django.contrib.auth.models.User
+        :type noauto: bool
+        :param noauto: if True (default) auto activities are excluded.
+        :type status: string
+        :param status: filter on status (default=all) 
+        :type notstatus: string or tuple
+        :param notstatus: list of status to exclude (default: [blocked, suspended, fallout, complete])
+        :rtype: [WorkItem]
+        :return: workitems ordered by priority
+        '''
+        entries = self._entries(user, noauto, status, notstatus)
+        entries = entries.select_related('workitem__activity__process', 'workitem__instance',
+                                         'workitem__user').order_by('-priority', 'date', 'workitem')
+        workitems, seen = [], set()
+        for entry in entries:
+            if entry.workitem_id not in seen:
+                seen.add(entry.workitem_id)
+                workitems.append(entry.workitem)
+        return workitems
+    
+    def _entries(self, user, noauto, status, notstatus):
+        entries = self.filter(Q(user=user) |
+                              Q(user__isnull=True, role__in=get_user_roles(user).group_ids) |
+                              Q(user__isnull=True, role__isnull=True),
+                              enabled=True)
+        if status:
+            entries = entries.filter(status=status)
+        elif notstatus:
+            if isinstance(notstatus, basestring): notstatus = (notstatus,)
+            entries = entries.exclude(status__in=notstatus)
+        if noauto:
+            entries = entries.filter(autostart=False)
+        return entries
+    
+    PAGE_FIELDS = (('id', 'workitem'), ('priority', 'priority'), ('status', 'status'),
+                   ('date', 'date'), ('activity', 'workitem__activity__title'),
+                   ('process', 'workitem__activity__process__title'),
+                   ('instance', 'workitem__instance'), ('title', 'workitem__instance__title'),
+                   ('user', 'workitem__user__username'))
+    CURSOR_DATE = '%Y%m%dT%H%M%S.%f'
+    
+    def page(self, user, after=None, limit=50, noauto=True, status=None,
+             notstatus=('blocked','suspended','fallout','complete')):
+        '''
+        Returns a page of the worklist of a user as dicts, with keyset
+        pagination on (priority, date, workitem id): one query per page,
+        whatever its position.
+        
+        :type user: User
+        :type after: string
+        :param after: cursor returned with the previous page
+        :type limit: int
+        :rtype: ([dict], string)
+        :return: the workitems and the cursor of the next page (None on the last page)
+        
+        other parameters: see worklist.
+        '''
+        entries = self._entries(user, noauto, status, notstatus)
+        if after:
+            priority, date, id = after.split('_')
+            priority, id = int(priority), int(id)
+            date = datetime.strptime(date, self.CURSOR_DATE)
+            entries = entries.filter(Q(priority__lt=priority) |
+                                     Q(priority=priority, date__gt=date) |
+                                     Q(priority=priority, date=date, workitem__gt=id))
+        # one row per workitem: the selected fields do not depend on the user or role
+        rows = list(entries.values(*[f for k, f in self.PAGE_FIELDS]).distinct().order_by(
+                                   '-priority', 'date', 'workitem')[:limit + 1])
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            cursor = '%d_%s_%d' % (last['priority'], last['date'].strftime(self.CURSOR_DATE),
+                                   last['workitem'])
+        return [dict((k, row[f]) for k, f in self.PAGE_FIELDS) for row in rows], cursor
+
+
+class WorklistEntry(models.Model):
+    """Denormalized worklist index.
+    
+    One row per open workitem and per person able to take it: its user,
+    or each of its pull roles, or nobody in particular (user and role
+    empty: pullable by anybody). Rows are rebuilt by WorkItem.save.
+    """
+    COLUMNS = ('user', 'role', 'workitem', 'priority', 'status', 'enabled', 'autostart', 'date')
+    user = models.ForeignKey(User, related_name='worklist_entries', null=True, blank=True)
+    role = models.ForeignKey(Group, related_name='worklist_entries', null=True, blank=True)
+    workitem = models.ForeignKey(WorkItem, related_name='worklist_entries')
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=WorkItem.STATUS_CHOICES)
+    enabled = models.BooleanField(default=True)
+    autostart = models.BooleanField(default=False)
+    date = models.DateTimeField()
+    
+    objects = WorklistEntryManager()
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.user_id or self.role_id or '*', self.workitem_id)
+    
+    class Meta:
+        verbose_name_plural = 'Worklist entries'
+
+
+class ArchivedInstance(models.Model):
+    """A completed process instance moved out of the runtime tables.
+    
+    data holds the instance, its workitems, their events and many to many
+    rows as compressed JSON (see goflow.runtime.archive). Subflow instances
+    are archived with their root instance (root_id).
+    """
+    instance_id = models.IntegerField(unique=True)
+    root_id = models.IntegerField(db_index=True)
+    title = models.CharField(max_length=100)
+    process = models.ForeignKey(Process, related_name='archived_instances', null=True, blank=True)
+    user = models.ForeignKey(User, related_name='archived_instances', null=True, blank=True)
+    status = models.CharField(max_length=10, choices=ProcessInstance.STATUS_CHOICES)
+    creationTime = models.DateTimeField()
+    archived = models.DateTimeField(auto_now_add=True)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    data = models.TextField()
+    
+    def __unicode__(self):
+        return self.title
+
+
+class NotificationManager(models.Manager):
+    '''Custom model manager for Notification
+    '''
+    def enqueue(self, user, workitem=None):
+        '''
+        records that the user has a new item; the mail is sent later by
+        goflow.runtime.outbox.send_notifications.
+        '''
+        return self.create(user=user, workitem=workitem,
+                           priority=workitem and workitem.priority or 0)
+
+
+class Notification(models.Model):
+    """Outbox entry: a user has new workitems to be notified of.
+    """
+    user = models.ForeignKey(User, related_name='notifications')
+    workitem = models.ForeignKey(WorkItem, related_name='notifications', null=True, blank=True)
+    priority = models.IntegerField(default=0)
+    date = models.DateTimeField(auto_now_add=True)
+    
+    objects = NotificationManager()
+    
+    def __unicode__(self):
+        return u'%s: %s' % (self.user.username, self.workitem_id)
+
+
+def _process_saved(sender, instance, **kwargs):
+    WorklistEntry.objects.filter(workitem__activity__process=instance).update(enabled=instance.enabled)
+    touch_all()
+
+def _reset_timers(activity_id):
+    # timers of the workitems waiting in an activity: the delay is the same
+    # for all, so one update (or one per date if the database is not known)
+    waiting = WorkItem.objects.filter(activity=activity_id).exclude(status__in=('complete', 'fallout'))
+    delay = get_activity_graph(activity_id).timeout(activity_id)
+    if delay is None:
+        waiting.update(due_time=None)
+        return
+    qn = connection.ops.quote_name
+    column = lambda name: qn(WorkItem._meta.get_field(name).column)
+    expression = add_seconds_sql(column('date'), delay)
+    if expression is None:
+        for date in waiting.values_list('date', flat=True).distinct().order_by():
+            waiting.filter(date=date).update(due_time=date + timedelta(seconds=delay))
+        return
+    sql = 'UPDATE %s SET %s = %s WHERE %s = %%s AND %s NOT IN (%%s, %%s)' % (
+                qn(WorkItem._meta.db_table), column('due_time'), expression,
+                column('activity'), column('status'))
+    connection.cursor().execute(sql, [activity_id, 'complete', 'fallout'])
+    transaction.commit_unless_managed()
+
+def _transition_saved(sender, instance, **kwargs):
+    # only a time_out transition leaving or entering an activity changes
+    # its timers: other edits (description...) leave the workitems alone
+    old, new = instance._saved_timer, (instance.input_id, instance.timeout)
+    instance._saved_timer = new
+    if old == new:
+        return
+    for activity_id in set([a for a, timeout in (old, new) if timeout is not None]):
+        _reset_timers(activity_id)
+
+def _pull_roles_changed(sender, instance, reverse=False, **kwargs):
+    # the entries are refreshed by the next WorkItem.save
+    if not reverse:
+        instance._indexed = None
+
+def _activity_saved(sender, instance, **kwargs):
+    WorklistEntry.objects.filter(workitem__activity=instance).update(autostart=instance.autostart)
+    touch_all()
+
+signals.post_save.connect(_process_saved, sender=Process)
+signals.post_save.connect(_activity_saved, sender=Activity)
+signals.post_save.connect(_transition_saved, sender=Transition)
+signals.m2m_changed.connect(_pull_roles_changed, sender=WorkItem.pull_roles.through)
@@ -0,0 +1,94 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Notification outbox.
+
+The engine only records Notification rows ("user X has new items");
+send_notifications() groups them per user and sends one digest per user,
+according to the user profile:
+
+- notified: no mail at all if False
+- nb_wi_notif: minimum number of items waiting in the worklist
+- notif_delay: minimum number of days between two mails
+- urgent_priority: an item with at least this priority is sent without
+  waiting for the delay or the number of items
+
+All the mails of a batch go through one connection of the email backend.
+
+usage::
+
+    send_notifications()
+'''
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import get_model
+
+from goflow.workflow.models import UserProfile
+from goflow.workflow.notification import render_mail
+from models import WorkItem, Notification
+from bulk import chunks
+from goflow.workflow.logger import Log; log = Log('goflow.runtime.outbox')
+
+
+def _send_batch(user_ids, subject, template):
+    entries = {}
+    for id, user_id, priority in Notification.objects.filter(user__in=user_ids).values_list(
+                                                           'id', 'user', 'priority'):
+        entries.setdefault(user_id, []).append((id, priority))
+    # settings.AUTH_PROFILE_MODULE: workflow.userprofile or a model with the same fields
+    profile_model = get_model(*settings.AUTH_PROFILE_MODULE.split('.'))
+    profiles = dict((p.user_id, p) for p in profile_model._default_manager.filter(
+                                                user__in=entries.keys()).select_related('user'))
+    messages, done, sent = [], [], []
+    for user_id, pending in entries.items():
+        profile = profiles.get(user_id)
+        if profile is None:
+            user = User.objects.get(pk=user_id)
+            UserProfile.objects.get_or_create(user=user)
+            profile = user.get_profile()
+        user = profile.user
+        urgent = max([priority for id, priority in pending]) >= profile.urgent_priority
+        if profile.notified and user.email and not urgent and not profile.check_notif_to_send():
+            # wait for the delay; entries are kept
+            continue
+        done.extend([id for id, priority in pending])
+        if not profile.notified or not user.email:
+            continue
+        workitems = WorkItem.objects.worklist(user, noauto=True)
+        if len(workitems) < profile.nb_wi_notif and not urgent:
+            continue
+        # the profile is reached by user.get_profile() in templates
+        user._profile_cache = profile
+        messages.append(render_mail(workitems=workitems, user=user,
+                                    subject=subject, template=template))
+        sent.append(profile)
+    if messages:
+        get_connection().send_messages(messages)
+        for profile in sent:
+            profile.notif_sent()
+            log.info('notification sent to %s', profile.user.username)
+    for part in chunks(done):
+        Notification.objects.filter(id__in=part).delete()
+    return len(messages)
+_send_batch = transaction.commit_on_success(_send_batch)
+
+def send_notifications(batch_size=100, subject='message', template='mail.txt'):
+    '''
+    sends the digests of the users having notifications.
+
+    Each batch of batch_size users is sent in one transaction: the entries
+    are kept if the backend fails.
+
+    @rtype: int
+    @return: number of mails sent
+    '''
+    user_ids = list(Notification.objects.values_list('user', flat=True).distinct().order_by('user'))
+    total = 0
+    for i in range(0, len(user_ids), batch_size):
+        try:
+            total += _send_batch(user_ids[i:i + batch_size], subject, template)
+        except Exception, v:
+            log.error('sendmail error: %s', v)
+    return total
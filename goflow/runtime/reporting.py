@@ -1,6 +1,230 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
-from models import WorkItem, ProcessInstance
+'''
+Process and activity state reports.
+
+Counts come from one GROUP BY query over (activity or process, status),
+or from the status counter tables when settings.WF_STATUS_COUNTERS is True.
+
+usage::
+
+    states = activity_states(process)
+    for activity in process.activities.all():
+        print activity.title, states[activity.id].active
+
+Cycle times are folded incrementally into daily rollups, then merged::
+
+    update_activity_stats()
+    stats = ActivityStats(activity, year=2010, month=3)
+    print stats.number, stats.time_mean, stats.p95
+'''
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+
+from goflow.workflow.models import Activity, Process
+from models import WorkItem, ProcessInstance, ActivityStatusCount, ProcessStatusCount, counters_enabled
+from models import Event, StatsWatermark, ActivityStatsRollup
+from sketch import QuantileSketch
+from bulk import chunks
+
+
+def _group_counts(queryset, owner):
+    '''
+    returns {owner id: {status: count}} for a queryset of workitems
+    (owner='activity') or instances (owner='process').
+    '''
+    counts = {}
+    for id, status, n in queryset.values(owner, 'status').annotate(
+                         n=Count('id')).values_list(owner, 'status', 'n').order_by():
+        counts.setdefault(id, {})[status] = n
+    return counts
+
+def _counter_counts(queryset, owner):
+    counts = {}
+    for id, status, n in queryset.values_list(owner, 'status', 'count'):
+        counts.setdefault(id, {})[status] = n
+    return counts
+
+def activity_status_counts(process=None, activity=None):
+    '''
+    returns {activity id: {status: number of workitems}}.
+    '''
+    if counters_enabled():
+        qs = ActivityStatusCount.objects.all()
+    else:
+        qs = WorkItem.objects.all()
+    if process: qs = qs.filter(activity__process=process)
+    if activity: qs = qs.filter(activity=activity)
+    if counters_enabled():
+        return _counter_counts(qs, 'activity')
+    return _group_counts(qs, 'activity')
+
+def process_status_counts(process=None):
+    '''
+    returns {process id: {status: number of instances}}.
+    '''
+    if counters_enabled():
+        qs = ProcessStatusCount.objects.all()
+    else:
+        qs = ProcessInstance.objects.all()
+    if process: qs = qs.filter(process=process)
+    if counters_enabled():
+        return _counter_counts(qs, 'process')
+    return _group_counts(qs, 'process')
+
+def activity_states(process):
+    '''
+    returns {activity id: ActivityState} for all activities of a process.
+    '''
+    counts = activity_status_counts(process=process)
+    return dict((a.id, ActivityState(a, counts.get(a.id, {})))
+                for a in Activity.objects.filter(process=process))
+
+def process_states():
+    '''
+    returns {process id: ProcessState} for all processes.
+    '''
+    counts = process_status_counts()
+    return dict((p.id, ProcessState(p, counts.get(p.id, {}))) for p in Process.objects.all())
+
+def rebuild_counters():
+    '''
+    rebuilds the status counter tables from the runtime tables.
+    '''
+    ActivityStatusCount.objects.rebuild(_group_counts(WorkItem.objects.all(), 'activity'))
+    ProcessStatusCount.objects.rebuild(_group_counts(ProcessInstance.objects.all(), 'process'))
+
+def _accuracy():
+    return getattr(settings, 'WF_STATS_ACCURACY', 0.01)
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def _load_pending(data):
+    pending = {}
+    for item in data.split():
+        id, stamp = item.split(':')
+        pending[int(id)] = float(stamp)
+    return pending
+
+def _dump_pending(pending):
+    return ' '.join(['%d:%d' % item for item in sorted(pending.items())])
+
+def _rescan_seconds():
+    return getattr(settings, 'WF_STATS_RESCAN', 3600)
+
+def _rescan(pending, done):
+    '''
+    folds the pending events committed since the last run, and forgets
+    those missing for more than settings.WF_STATS_RESCAN seconds (default
+    3600): rolled back or deleted.
+    '''
+    for part in chunks(sorted(pending)):
+        for id, name, workitem_id, when in Event.objects.filter(id__in=part).values_list(
+                                          'id', 'name', 'workitem', 'date'):
+            del pending[id]
+            if name.startswith('completed by'):
+                done.append((id, workitem_id, when))
+    horizon = time.time() - _rescan_seconds()
+    for id, stamp in pending.items():
+        if stamp < horizon:
+            del pending[id]
+
+def _fold_batch(batch_size, limit):
+    mark, created = StatsWatermark.objects.get_or_create(name='activity_stats')
+    done = []
+    for id, workitem_id, when in Event.objects.filter(id__gt=mark.last_id,
+                                  name__startswith='completed by').order_by('id').values_list(
+                                  'id', 'workitem', 'date')[:batch_size]:
+        # recent events may belong to transactions that are still running
+        if when >= limit:
+            break
+        done.append((id, workitem_id, when))
+    count = len(done)
+    last_id = done and done[-1][0] or mark.last_id
+    pending = _load_pending(mark.pending)
+    if done:
+        # lower ids of transactions still running are not visible yet;
+        # ids below an event older than the rescan horizon are not waited for
+        horizon = datetime.now() - timedelta(seconds=_rescan_seconds())
+        seen, first = set(), mark.last_id + 1
+        for id, when in Event.objects.filter(id__gt=mark.last_id, id__lte=last_id).values_list(
+                                             'id', 'date'):
+            seen.add(id)
+            if when < horizon:
+                first = max(first, id)
+        now = time.time()
+        for id in xrange(first, last_id):
+            if id not in seen:
+                pending[id] = now
+    _rescan(pending, done)
+    data = _dump_pending(pending)
+    if last_id == mark.last_id and data == mark.pending:
+        return 0
+    # the watermark row serializes concurrent runs
+    if not StatsWatermark.objects.filter(pk=mark.pk, last_id=mark.last_id, pending=mark.pending).update(
+                                                            last_id=last_id, pending=data):
+        return 0
+    if not done:
+        return 0
+    started, owners = {}, {}
+    for ids in chunks(set([workitem_id for id, workitem_id, when in done])):
+        started.update(Event.objects.filter(workitem__in=ids).values('workitem').annotate(
+                       start=Min('date')).values_list('workitem', 'start').order_by())
+        owners.update((id, (activity_id, user_id)) for id, activity_id, user_id in
+                      WorkItem.objects.filter(id__in=ids).values_list('id', 'activity', 'user'))
+    sketches = {}
+    for id, workitem_id, when in done:
+        if workitem_id not in owners:
+            continue
+        key = owners[workitem_id] + (when.date(),)
+        if key not in sketches:
+            sketches[key] = QuantileSketch(_accuracy())
+        sketches[key].add(_seconds(when - started.get(workitem_id, when)))
+    for (activity_id, user_id, day), sketch in sketches.items():
+        ActivityStatsRollup.objects.merge(activity_id, user_id, day, sketch)
+    return count
+_fold_batch = transaction.commit_on_success(_fold_batch)
+
+def update_activity_stats(batch_size=1000):
+    '''
+    folds the workitems completed since the last run into the daily
+    cycle time rollups (ActivityStatsRollup).
+    
+    The cycle time of a workitem runs from its first event to its
+    'completed by' event. Completions more recent than
+    settings.WF_STATS_SETTLE seconds (default 60) are left for the next run;
+    lower event ids missing when the watermark moves (transactions not
+    committed yet) are rescanned by the next runs (see _rescan).
+    
+    @rtype: int
+    @return: number of workitems folded
+    '''
+    limit = datetime.now() - timedelta(seconds=getattr(settings, 'WF_STATS_SETTLE', 60))
+    total = 0
+    while True:
+        n = _fold_batch(batch_size, limit)
+        total += n
+        if n < batch_size:
+            return total
+
+def rebuild_activity_stats(batch_size=1000):
+    '''
+    rebuilds the cycle time rollups from the whole event history.
+    '''
+    ActivityStatsRollup.objects.all().delete()
+    StatsWatermark.objects.filter(name='activity_stats').delete()
+    return update_activity_stats(batch_size)
+
 
 class ActivityState:
     blocked = 0
@@ -10,14 +234,12 @@ class ActivityState:
     fallout = 0
     complete = 0
     total = 0
-    def __init__(self, activity):
-        wis = WorkItems.objects.filter(activity=activity)
-        self.total = wis.count()
-        self.blocked = wis.filter(status='blocked').count()
-        self.inactive = wis.filter(status='inactive').count()
-        self.active = wis.filter(status='active').count()
-        self.fallout = wis.filter(status='fallout').count()
-        self.complete = wis.filter(status='complete').count()
+    def __init__(self, activity, counts=None):
+        if counts is None:
+            counts = activity_status_counts(activity=activity).get(activity.id, {})
+        for status, n in counts.items():
+            setattr(self, status, n)
+        self.total = sum(counts.values())
 
 class ProcessState:
     initiated = 0
@@ -27,20 +249,49 @@ class ProcessState:
     terminated = 0
     suspended = 0
     total = 0
-    def __init__(self, process):
-        insts = ProcessInstance.objects.filter(process=process)
-        self.total = insts.count()
-        self.initiated = insts.filter(status='initiated').count()
-        self.running = insts.filter(status='running').count()
-        self.active = insts.filter(status='active').count()
-        self.complete = insts.filter(status='complete').count()
-        self.terminated = insts.filter(status='terminated').count()
-        self.suspended = insts.filter(status='suspended').count()
+    def __init__(self, process, counts=None):
+        if counts is None:
+            counts = process_status_counts(process=process).get(process.id, {})
+        for status, n in counts.items():
+            setattr(self, status, n)
+        self.total = sum(counts.values())
 
 class ActivityStats:
+    """Cycle times (seconds) of the completed workitems of an activity.
+    
+    Merges the rollups maintained by update_activity_stats, optionally
+    restricted to a user, a year/month/day or a (start, end) interval
+    (day granularity).
+    """
     number = 0
     time_min = None
     time_max = None
     time_mean = None
+    p50 = None
+    p95 = None
+    p99 = None
     def __init__(self, activity, user=None, year=None, month=None, day=None, datetime_interval=None):
-        pass
+        qs = ActivityStatsRollup.objects.filter(activity=activity)
+        if user: qs = qs.filter(user=user)
+        if year: qs = qs.filter(day__year=year)
+        if month: qs = qs.filter(day__month=month)
+        if day: qs = qs.filter(day__day=day)
+        if datetime_interval:
+            start, end = datetime_interval
+            qs = qs.filter(day__range=(_day(start), _day(end)))
+        self.sketch = QuantileSketch(_accuracy())
+        for data in qs.values_list('sketch', flat=True):
+            self.sketch.merge(QuantileSketch.loads(data))
+        self.number = self.sketch.count
+        if self.number:
+            self.time_min = self.sketch.min
+            self.time_max = self.sketch.max
+            self.time_mean = self.sketch.mean()
+            self.p50 = self.quantile(0.5)
+            self.p95 = self.quantile(0.95)
+            self.p99 = self.quantile(0.99)
+    
+    def quantile(self, q):
+        '''estimated q-quantile of the cycle times (0 <= q <= 1).
+        '''
+        return self.sketch.quantile(q)
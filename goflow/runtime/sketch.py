@@ -0,0 +1,100 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Mergeable quantile sketch for durations.
+
+Values are counted in logarithmic buckets, so that any quantile is
+estimated with a bounded relative error (1% by default). Two sketches
+built with the same accuracy are merged by adding their buckets, which
+lets daily, per-user rollups be combined without the raw data.
+
+usage::
+
+    s = QuantileSketch()
+    for d in durations:
+        s.add(d)
+    s.merge(other)
+    p95 = s.quantile(0.95)
+'''
+import math
+
+from django.utils import simplejson
+
+
+class QuantileSketch(object):
+    """Log-bucketed histogram of non negative values.
+    """
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def add(self, value, n=1):
+        if value <= 0:
+            value = 0
+            self.zeros += n
+        else:
+            i = self._index(value)
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.count += n
+        self.sum += value * n
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if other.accuracy != self.accuracy:
+            raise ValueError('sketches with different accuracies cannot be merged')
+        for i, n in other.buckets.items():
+            self.buckets[i] = self.buckets.get(i, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min: self.min = other.min
+        if self.max is None or other.max > self.max: self.max = other.max
+        return self
+
+    def quantile(self, q):
+        '''returns the estimated q-quantile (0 <= q <= 1), None if empty.
+        '''
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets.keys()):
+            seen += self.buckets[i]
+            if rank < seen:
+                value = 2 * self.gamma ** i / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def dumps(self):
+        return simplejson.dumps({'a':self.accuracy, 'z':self.zeros, 'n':self.count,
+                                 's':self.sum, 'min':self.min, 'max':self.max,
+                                 'b':dict((str(i), n) for i, n in self.buckets.items())})
+
+    def loads(cls, data):
+        d = simplejson.loads(data)
+        sketch = cls(d['a'])
+        sketch.zeros, sketch.count, sketch.sum = d['z'], d['n'], d['s']
+        sketch.min, sketch.max = d['min'], d['max']
+        sketch.buckets = dict((int(i), n) for i, n in d['b'].items())
+        return sketch
+    loads = classmethod(loads)
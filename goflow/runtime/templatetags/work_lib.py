@@ -35,7 +35,7 @@ def mywork(user):
                                   my_data_dictionary,
                                   context_instance=RequestContext(request))
     '''
-    workitems = WorkItem.objects.list_safe(user=user, noauto=True)
+    workitems = WorkItem.objects.worklist(user, noauto=True)
     return {'workitems':workitems}
 mywork = register.inclusion_tag("goflow/workitems.html")(mywork)
 
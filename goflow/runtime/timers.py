@@ -0,0 +1,110 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Timer service for time_out transitions.
+
+Transitions with a ``workitem.time_out(delay, unit)`` condition are parsed
+when saved (Transition.timeout); each workitem waiting in their input
+activity stores the time they are due (WorkItem.due_time, indexed).
+The scheduler only loads due workitems, in batches; a workitem whose
+time_out transitions all evaluate False keeps its timer, retried by the
+next pass.
+
+usage::
+
+    python manage.py goflow_timers --loop=60
+
+settings:
+
+WF_TIMER_CLUSTER
+    if True, a lease (TimerLease) ensures that a single server fires
+    timers (default False)
+WF_TIMER_LEASE
+    lease duration in seconds (default 300)
+'''
+import os
+import socket
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+
+from models import WorkItem, TimerLease
+from goflow.workflow.logger import Log; log = Log('goflow.runtime.timers')
+
+LEASE_NAME = 'goflow.timers'
+
+
+@transaction.commit_on_success
+def _fire_batch(now, batch_size, after=None):
+    '''
+    fires the due timers following the (due_time, id) cursor after.
+    
+    @return: (number of workitems processed, cursor of the last one)
+    '''
+    due = WorkItem.objects.filter(due_time__lte=now).exclude(status__in=('complete', 'fallout'))
+    if after is not None:
+        due = due.filter(Q(due_time__gt=after[0]) | Q(due_time=after[0], id__gt=after[1]))
+    batch = list(due.order_by('due_time', 'id')[:batch_size])
+    for wi in batch:
+        try:
+            destinations = wi.get_destinations(timeout_forwarding=True)
+        except Exception, v:
+            log.error('timeout conditions of workitem %d: %s', wi.pk, v)
+            continue
+        if not destinations:
+            # no time_out transition fired: the timer is kept
+            continue
+        # fired once: a later save of the workitem sets the next due time;
+        # the version check skips workitems changed since they were read
+        if not WorkItem.objects.filter(pk=wi.pk, version=wi.version).update(
+                                       due_time=None, version=F('version') + 1):
+            continue
+        wi.version += 1
+        try:
+            wi.forward(timeout_forwarding=True, destinations=destinations)
+        except Exception, v:
+            log.error('timeout forwarding workitem %d: %s', wi.pk, v)
+    if not batch:
+        return 0, after
+    return len(batch), (batch[-1].due_time, batch[-1].pk)
+
+
+def fire_due_timers(now=None, batch_size=100):
+    '''
+    forwards the workitems whose time_out transitions are due.
+    
+    @rtype: int
+    @return: number of workitems processed
+    '''
+    if now is None:
+        now = datetime.now()
+    count = 0
+    cursor = None
+    while True:
+        n, cursor = _fire_batch(now, batch_size, cursor)
+        count += n
+        if n < batch_size:
+            break
+    if count:
+        log.info('%d timers fired', count)
+    return count
+
+
+def run_timers(holder=None, batch_size=100):
+    '''
+    fires due timers; in cluster mode (settings.WF_TIMER_CLUSTER), only
+    if this server holds the timer lease.
+    
+    @rtype: int
+    @return: number of workitems processed, None if the lease is held elsewhere
+    '''
+    if not getattr(settings, 'WF_TIMER_CLUSTER', False):
+        return fire_due_timers(batch_size=batch_size)
+    if holder is None:
+        holder = '%s:%d' % (socket.gethostname(), os.getpid())
+    if not TimerLease.objects.acquire(LEASE_NAME, holder, getattr(settings, 'WF_TIMER_LEASE', 300)):
+        log.debug('timer lease held by another server')
+        return None
+    return fire_due_timers(batch_size=batch_size)
@@ -0,0 +1,123 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Versions of the worklists and request lists, for conditional GETs.
+
+A version is a timestamp kept in the django cache (settings.WF_LIST_VERSION_TIMEOUT
+seconds, default one day) and bumped when the list may have changed:
+worklist entries of a user, of a role or pullable by anybody
+(WorklistEntryManager.refresh), process definitions (all worklists),
+instances started by a user (request list). The version of a user
+worklist combines the versions of the user, of their roles, of anybody
+and of all worklists: no query is needed to tell a poller nothing
+changed.
+
+Versions are bumped before the transaction commits: a list read just
+before the commit may be stale. Views only send validators for versions
+older than settings.WF_LIST_SETTLE seconds (default 2).
+
+The cache must be shared by all the server processes (memcached, database
+cache...): with a per-process cache, such as the locmem:// default, a
+bump in one process is not seen by the others, which would answer 304
+with stale lists. Views send no validators then (see enabled), unless
+settings.WF_LIST_VERSIONS is True (single process servers).
+
+usage::
+
+    etag, stamp = worklist_version(request.user)
+'''
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends import locmem, dummy
+
+from goflow.workflow.authcache import get_user_roles
+
+ALL_KEY = 'goflow.worklist.all'
+ANY_KEY = 'goflow.worklist.any'
+
+
+def enabled():
+    '''
+    True if the versions may be used as validators: settings.WF_LIST_VERSIONS,
+    by default True unless the cache is local to the process (locmem, dummy).
+    '''
+    forced = getattr(settings, 'WF_LIST_VERSIONS', None)
+    if forced is not None:
+        return forced
+    return not isinstance(cache, (locmem.CacheClass, dummy.CacheClass))
+
+def _timeout():
+    return getattr(settings, 'WF_LIST_VERSION_TIMEOUT', 24 * 3600)
+
+def worklist_key(user_id=None, role_id=None):
+    '''cache key of the worklist entries of a user, of a role, or of anybody (both None).
+    '''
+    if user_id:
+        return 'goflow.worklist.u%d' % user_id
+    if role_id:
+        return 'goflow.worklist.r%d' % role_id
+    return ANY_KEY
+
+def requests_key(user_id):
+    return 'goflow.requests.u%d' % user_id
+
+
+def touch(keys):
+    '''bumps the versions of the keys.
+    '''
+    now = time.time()
+    for key in set(keys):
+        cache.set(key, now, _timeout())
+
+def touch_worklists(targets):
+    '''bumps the versions of (user id, role id) worklist entry targets.
+    '''
+    touch([worklist_key(user_id, role_id) for user_id, role_id in targets])
+
+def touch_all():
+    '''bumps the version of all worklists.
+    '''
+    touch([ALL_KEY])
+
+def touch_requests(user_id):
+    touch([requests_key(user_id)])
+
+
+def version(keys, salt=''):
+    '''
+    returns the combined version of the keys.
+
+    Missing keys (never bumped, or evicted) start now.
+
+    @rtype: (str, float)
+    @return: etag, timestamp of the last change
+    '''
+    values = cache.get_many(keys)
+    now = time.time()
+    for key in keys:
+        if values.get(key) is None:
+            cache.add(key, now, _timeout())
+            values[key] = cache.get(key) or now
+    stamps = [values[key] for key in keys]
+    etag = hashlib.md5('%s:%s' % (salt, ','.join(['%r' % s for s in stamps]))).hexdigest()
+    return etag, max(stamps)
+
+def worklist_version(user):
+    '''version of the worklist of a user (see version).
+    '''
+    keys = [ALL_KEY, ANY_KEY, worklist_key(user.id)]
+    keys.extend([worklist_key(role_id=id) for id in sorted(get_user_roles(user).group_ids)])
+    return version(keys, 'w%d' % user.id)
+
+def requests_version(user):
+    '''version of the request list of a user (see version).
+    '''
+    return version([requests_key(user.id)], 'r%d' % user.id)
+
+def settled(stamp):
+    '''True if the version is old enough to be used as a validator.
+    '''
+    return time.time() - stamp >= getattr(settings, 'WF_LIST_SETTLE', 2)
@@ -2,10 +2,22 @@
 # -*- coding: utf-8 -*-
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect
-from models import ProcessInstance, WorkItem
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
+from django.views.decorators.http import condition
+from models import ProcessInstance, WorkItem, WorkItemConflict, WorklistEntry
+from goflow.workflow.models import Process
+from events import buffer_events
+import metrics as engine_metrics
+from history import get_instance_history
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
+from versions import worklist_version, requests_version, settled, enabled as versions_enabled
+from datetime import datetime
+import hashlib
 
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.models import User
 
 
 @login_required
@@ -18,31 +30,156 @@ def mywork(request, template='goflow/mywork.html'):
     template
         default:'goflow/mywork.html'
     '''
-    workitems = WorkItem.objects.list_safe(user=request.user, noauto=True)
+    workitems = WorkItem.objects.worklist(request.user, noauto=True)
     return render_to_response(template, {'workitems':workitems},
                               context_instance=RequestContext(request))
 
 @login_required
 def otherswork(request, template='goflow/otherswork.html'):
     worker = request.GET['worker']
-    workitems = WorkItem.objects.list_safe(username=worker, noauto=False)
+    workitems = WorkItem.objects.worklist(User.objects.get(username=worker), noauto=False)
     return render_to_response(template, {'worker':worker, 'workitems':workitems},
                               context_instance=RequestContext(request))
 
 @login_required
 def instancehistory(request, template='goflow/instancehistory.html'):
     id = int(request.GET['id'])
-    inst = ProcessInstance.objects.get(pk=id)
-    return render_to_response(template, {'instance':inst},
+    history = get_instance_history(id)
+    return render_to_response(template, {'instance':history, 'workitems':history.nodes},
                               context_instance=RequestContext(request))
 
+@login_required
+def instancehistory_json(request):
+    '''
+    history DAG of an instance in JSON (see goflow.runtime.history).
+    
+    parameters:
+    
+    id
+        instance id (GET)
+    '''
+    history = get_instance_history(int(request.GET['id']))
+    return HttpResponse(simplejson.dumps(history.as_dict(), cls=DjangoJSONEncoder),
+                        mimetype='application/json')
+
+@staff_member_required
+def metrics(request):
+    '''
+    engine metrics in the prometheus text format (see goflow.runtime.metrics).
+    '''
+    return HttpResponse(engine_metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+# largest page of the JSON lists
+MAX_PAGE = 200
+
+def _json_response(data):
+    return HttpResponse(simplejson.dumps(data, cls=DjangoJSONEncoder), mimetype='application/json')
+
+def _page_params(request):
+    '''
+    after and limit GET parameters of the JSON lists, limit clamped to
+    1..MAX_PAGE; raises ValueError if limit is not an integer.
+    '''
+    limit = int(request.GET.get('limit', 50))
+    return request.GET.get('after') or None, max(1, min(limit, MAX_PAGE))
+
+def _worker(request):
+    '''user whose worklist is listed: GET parameter worker, or the current user.'''
+    if not hasattr(request, '_goflow_worker'):
+        username = request.GET.get('worker')
+        request._goflow_worker = username and User.objects.get(username=username) or request.user
+    return request._goflow_worker
+
+def _validators(request, version_func, user):
+    '''
+    (etag, last modified) of a page of a list, from the list version
+    (see goflow.runtime.versions); None while the version settles, or if
+    the versions are not shared by the server processes.
+    '''
+    if not hasattr(request, '_goflow_validators'):
+        validators = None
+        if versions_enabled():
+            etag, stamp = version_func(user)
+            if settled(stamp):
+                # one etag per page
+                validators = (hashlib.md5('%s %s' % (etag, request.get_full_path())).hexdigest(),
+                              datetime.utcfromtimestamp(stamp))
+        request._goflow_validators = validators
+    return request._goflow_validators
+
+def _worklist_etag(request):
+    validators = _validators(request, worklist_version, _worker(request))
+    return validators and validators[0]
+
+def _worklist_modified(request):
+    validators = _validators(request, worklist_version, _worker(request))
+    return validators and validators[1]
+
+def _requests_etag(request):
+    validators = _validators(request, requests_version, request.user)
+    return validators and validators[0]
+
+def _requests_modified(request):
+    validators = _validators(request, requests_version, request.user)
+    return validators and validators[1]
+
+@login_required
+@condition(etag_func=_worklist_etag, last_modified_func=_worklist_modified)
+def worklist_json(request):
+    '''
+    a page of a worklist in JSON: {"items": [...], "next": cursor}.
+    
+    Unchanged pages are answered 304 without querying the worklist, when
+    the list versions are kept in a shared cache (see goflow.runtime.versions).
+    
+    parameters (GET):
+    
+    worker
+        username (default: current user)
+    after
+        cursor of the page, from the previous response
+    limit
+        page size (default 50, at most MAX_PAGE)
+    
+    Invalid parameters are answered 400.
+    '''
+    try:
+        after, limit = _page_params(request)
+    except ValueError:
+        return HttpResponseBadRequest('invalid limit: %s' % request.GET.get('limit'))
+    try:
+        items, cursor = WorklistEntry.objects.page(_worker(request), after=after, limit=limit)
+    except ValueError:
+        return HttpResponseBadRequest('invalid cursor: %s' % after)
+    return _json_response({'items':items, 'next':cursor})
+
+@login_required
+@condition(etag_func=_requests_etag, last_modified_func=_requests_modified)
+def myrequests_json(request):
+    '''
+    a page of the instances started by the current user in JSON:
+    {"items": [...], "next": cursor}.
+    
+    parameters (GET): after, limit (see worklist_json)
+    '''
+    try:
+        after, limit = _page_params(request)
+    except ValueError:
+        return HttpResponseBadRequest('invalid limit: %s' % request.GET.get('limit'))
+    try:
+        items, cursor = ProcessInstance.objects.requests(request.user, after=after, limit=limit)
+    except ValueError:
+        return HttpResponseBadRequest('invalid cursor: %s' % after)
+    return _json_response({'items':items, 'next':cursor})
+
 @login_required
 def myrequests(request, template='goflow/myrequests.html'):
-    inst_list = ProcessInstance.objects.filter(user=request.user)
+    inst_list = ProcessInstance.objects.filter(user=request.user, parent_workitem__isnull=True)
     return render_to_response(template, {'instances':inst_list},
                               context_instance=RequestContext(request))
 
 @login_required
+@buffer_events
 def activate(request, id):
     '''
     activates and redirect to the application.
@@ -54,10 +191,32 @@ def activate(request, id):
     '''
     id = int(id)
     workitem = WorkItem.objects.get_safe(id=id, user=request.user)
-    workitem.activate(request.user)
+    try:
+        workitem.activate(request.user)
+    except WorkItemConflict, v:
+        return HttpResponse(str(v), status=409)
+    return _app_response(workitem)
+
+@login_required
+@buffer_events
+def claim(request, process=None):
+    '''
+    activates the next workitem of the user worklist and redirects to the application.
+    
+    parameters:
+    
+    process
+        process title (optional)
+    '''
+    if process:
+        process = Process.objects.get(title=process)
+    workitem = WorkItem.objects.claim_next(request.user, process=process)
+    if workitem is None:
+        return HttpResponseRedirect('..')
     return _app_response(workitem)
 
 @login_required
+@buffer_events
 def complete(request, id):
     '''
     redirect to the application.
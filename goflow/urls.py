@@ -30,8 +30,15 @@ urlpatterns += patterns('goflow.runtime.views',
     (r'^otherswork/instancehistory/$', 'instancehistory'),
     (r'^myrequests/$',                 'myrequests'),
     (r'^myrequests/instancehistory/$', 'instancehistory'),
+    (r'^instancehistory/json/$',       'instancehistory_json'),
     (r'^mywork/$',                     'mywork'),
+    (r'^mywork/json/$',                'worklist_json'),
+    (r'^otherswork/json/$',            'worklist_json'),
+    (r'^myrequests/json/$',            'myrequests_json'),
     (r'^mywork/activate/(?P<id>.*)/$', 'activate'),
     (r'^mywork/complete/(?P<id>.*)/$', 'complete'),
+    (r'^mywork/claim/$',               'claim'),
+    (r'^mywork/claim/(?P<process>.*)/$', 'claim'),
+    (r'^metrics/$',                    'metrics'),
 )
 
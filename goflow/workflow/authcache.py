@@ -0,0 +1,104 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Authorization cache.
+
+Group ids of a user, and the permission codenames granted through each
+of their groups, are kept on the user object for the request and in the
+django cache between requests (settings.WF_AUTH_CACHE_TIMEOUT seconds,
+default 300). Entries are dropped when users, groups or memberships
+change. Activity roles and process flags come from the process graphs
+(see goflow.workflow.graph).
+
+usage::
+
+    roles = get_user_roles(request.user)
+    if roles.group_ids & graph.role_ids(activity):
+        ...
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User, Group, Permission
+from django.db.models import signals
+
+
+class UserRoles(object):
+    """Groups of a user and the permissions granted by each group.
+    """
+    def __init__(self, groups, permissions):
+        # group id -> group name
+        self.groups = dict(groups)
+        self.group_ids = frozenset(self.groups.keys())
+        self.group_names = frozenset(self.groups.values())
+        # codename -> names of the groups granting it
+        self.permissions = {}
+        for name, codename in permissions:
+            self.permissions.setdefault(codename, set()).add(name)
+
+    def has_group_perm(self, group_name, codename):
+        '''True if the user belongs to group_name and this group has the permission.
+        '''
+        return group_name in self.permissions.get(codename, ())
+
+
+def _key(user_id):
+    generation = cache.get('goflow.auth.generation') or 0
+    return 'goflow.auth.%d.%d' % (generation, user_id)
+
+def _timeout():
+    return getattr(settings, 'WF_AUTH_CACHE_TIMEOUT', 300)
+
+
+def get_user_roles(user):
+    '''
+    returns the UserRoles of a user.
+
+    :type user: User
+    :rtype: UserRoles
+    '''
+    roles = getattr(user, '_goflow_roles', None)
+    if roles is not None:
+        return roles
+    key = _key(user.id)
+    roles = cache.get(key)
+    if roles is None:
+        roles = UserRoles(Group.objects.filter(user=user).values_list('id', 'name'),
+                          Permission.objects.filter(group__user=user).values_list(
+                                                    'group__name', 'codename'))
+        cache.set(key, roles, _timeout())
+    user._goflow_roles = roles
+    return roles
+
+
+def invalidate_user(user):
+    '''drops the cached roles of a user (User or id).
+    '''
+    id = getattr(user, 'id', user)
+    cache.delete(_key(id))
+    if isinstance(user, User) and hasattr(user, '_goflow_roles'):
+        del user._goflow_roles
+
+def invalidate_all():
+    '''drops the cached roles of all users.
+    '''
+    cache.set('goflow.auth.generation', (cache.get('goflow.auth.generation') or 0) + 1)
+
+
+def _user_changed(sender, instance, **kwargs):
+    invalidate_user(instance)
+
+def _group_changed(sender, instance, **kwargs):
+    invalidate_all()
+
+def _membership_changed(sender, instance, **kwargs):
+    if isinstance(instance, User):
+        invalidate_user(instance)
+    else:
+        invalidate_all()
+
+signals.post_save.connect(_user_changed, sender=User)
+signals.post_delete.connect(_user_changed, sender=User)
+signals.post_save.connect(_group_changed, sender=Group)
+signals.post_delete.connect(_group_changed, sender=Group)
+signals.m2m_changed.connect(_membership_changed, sender=User.groups.through)
+signals.m2m_changed.connect(_group_changed, sender=Group.permissions.through)
@@ -0,0 +1,144 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Compiled transition conditions.
+
+A transition condition is either a python boolean expression::
+
+    instance.condition=="OK" and wfobject.amount < 100
+
+or a literal compared against instance.condition::
+
+    OK
+    'OK'
+
+Conditions are parsed once, classified and cached by transition id and
+condition text.
+'''
+import ast
+from datetime import datetime, timedelta
+
+from logger import Log; log = Log('goflow.workflow.conditions')
+
+# names available in condition expressions
+NAMES = ('instance', 'workitem', 'self', 'wfobject', 'transition',
+         'datetime', 'timedelta', 'True', 'False', 'None')
+
+# transition id -> Condition
+_conditions = {}
+
+
+class Condition(object):
+    """A parsed transition condition.
+
+    kind is one of:
+
+    - 'always': empty condition, always True
+    - 'literal': self.value is compared against instance.condition
+    - 'expression': compiled python expression
+    """
+    def __init__(self, source):
+        self.source = source
+        self.code = None
+        self.value = None
+        self.uses_wfobject = False
+        if not source or not source.strip():
+            self.kind = 'always'
+            return
+        try:
+            tree = compile(source.strip(), '<condition>', 'eval', ast.PyCF_ONLY_AST)
+        except SyntaxError:
+            self.kind = 'literal'
+            self.value = source
+            return
+        body = tree.body
+        if isinstance(body, ast.Str):
+            self.kind = 'literal'
+            self.value = body.s
+        elif isinstance(body, ast.Name) and body.id not in NAMES:
+            # a bare word: OK, Cancel ...
+            self.kind = 'literal'
+            self.value = source
+        else:
+            self.kind = 'expression'
+            self.code = compile(tree, '<condition>', 'eval')
+            self.uses_wfobject = 'wfobject' in self.code.co_names
+
+    def evaluate(self, workitem, transition=None):
+        '''
+        returns True if the condition is fulfilled for the workitem.
+        '''
+        if self.kind == 'always':
+            return True
+        instance = workitem.instance
+        if self.kind == 'literal':
+            return (instance.condition == self.value)
+        namespace = {'instance':instance, 'workitem':workitem, 'self':workitem,
+                     'transition':transition,
+                     'datetime':datetime, 'timedelta':timedelta}
+        if self.uses_wfobject:
+            namespace['wfobject'] = instance.wfobject()
+        try:
+            result = eval(self.code, namespace)
+        except Exception, v:
+            log.debug('condition [%s]: %s', self.source, v)
+            return (instance.condition == self.source)
+        # boolean expr
+        if type(result) == type(True):
+            return result
+        if isinstance(result, basestring):
+            return (instance.condition == result)
+        return False
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.kind, self.source)
+
+
+def parse_timeout(source):
+    '''
+    returns the delay, in seconds, of a workitem.time_out(delay, unit)
+    call in a condition, or None (several calls: the shortest delay).
+    
+    usage::
+    
+        parse_timeout("workitem.time_out(delay=1, unit='minutes')") # 60
+    '''
+    if not source or 'time_out' not in source:
+        return None
+    try:
+        tree = compile(source.strip(), '<condition>', 'eval', ast.PyCF_ONLY_AST)
+    except SyntaxError:
+        return None
+    delays = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == 'time_out' and isinstance(node.func.value, ast.Name)
+                and node.func.value.id in ('workitem', 'self')):
+            continue
+        try:
+            kwargs = dict(zip(('delay', 'unit'), [ast.literal_eval(a) for a in node.args]))
+            for k in node.keywords:
+                kwargs[k.arg] = ast.literal_eval(k.value)
+            delta = timedelta(**{str(kwargs.get('unit', 'days')):kwargs['delay']})
+        except Exception, v:
+            log.warning('time_out condition [%s]: %s', source, v)
+            continue
+        delays.append(delta.days * 86400 + delta.seconds)
+    if delays:
+        return min(delays)
+    return None
+
+
+def get_condition(transition):
+    '''
+    returns the compiled condition of a transition.
+
+    :type transition: Transition
+    :rtype: Condition
+    '''
+    condition = _conditions.get(transition.id)
+    if condition is None or condition.source != transition.condition:
+        condition = Condition(transition.condition)
+        if transition.id is not None:
+            _conditions[transition.id] = condition
+    return condition
@@ -0,0 +1,230 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Compiled process definitions.
+
+The runtime engine needs the same definition data (outgoing transitions,
+join arity, roles, begin/end activities) on every forward; a ProcessGraph
+loads it once per process and keeps it in memory.
+
+usage::
+
+    graph = get_graph(process)
+    for t in graph.outgoing(activity):
+        ...
+'''
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import signals
+
+from models import Process, Activity, Transition
+from logger import Log; log = Log('goflow.workflow.graph')
+
+# process id -> ProcessGraph
+_graphs = {}
+# process title -> process id
+_titles = {}
+# activity id -> process id
+_activities = {}
+
+
+def _check_delay():
+    '''delay (in seconds) between two checks of Process.date.
+
+    Local saves invalidate graphs immediately; the date check is there
+    for definitions changed by another server process.
+    '''
+    return getattr(settings, 'WF_GRAPH_CHECK_DELAY', 10)
+
+
+class ProcessGraph(object):
+    """Read-only snapshot of a process definition.
+
+    Activities and transitions held by the graph are shared between
+    requests: they must not be modified.
+    """
+    def __init__(self, process):
+        self.process = process
+        self.id = process.id
+        self.title = process.title
+        self.enabled = process.enabled
+        self.date = process.date
+        self.checked = time.time()
+
+        self.activities = {}
+        for a in Activity.objects.filter(process=process).select_related(
+                        'application', 'push_application', 'subflow'):
+            a.process = process
+            self.activities[a.id] = a
+        self.begin = self.activities.get(process.begin_id)
+        self.end = self.activities.get(process.end_id)
+
+        self._outgoing = dict((id, []) for id in self.activities)
+        self._incoming = dict((id, []) for id in self.activities)
+        for t in Transition.objects.filter(process=process).order_by('id'):
+            t.process = process
+            t.input = self.activities[t.input_id]
+            t.output = self.activities[t.output_id]
+            self._outgoing[t.input_id].append(t)
+            self._incoming[t.output_id].append(t)
+
+        self._roles = {}
+        for id, a in self.activities.items():
+            self._roles[id] = list(a.roles.all())
+        self._role_ids = dict((id, frozenset([r.id for r in roles]))
+                              for id, roles in self._roles.items())
+
+    def activity(self, activity):
+        '''returns the cached Activity given an activity or its id.
+        '''
+        return self.activities[getattr(activity, 'id', activity)]
+
+    def outgoing(self, activity):
+        '''transitions leaving the activity.
+        '''
+        return self._outgoing.get(getattr(activity, 'id', activity), [])
+
+    def incoming(self, activity):
+        '''transitions entering the activity.
+        '''
+        return self._incoming.get(getattr(activity, 'id', activity), [])
+
+    def nb_input_transitions(self, activity):
+        '''join arity of the activity.
+        '''
+        return len(self.incoming(activity))
+
+    def timeout(self, activity):
+        '''shortest delay (seconds) of the time_out transitions leaving the activity, or None.
+        '''
+        delays = [t.timeout for t in self.outgoing(activity) if t.timeout is not None]
+        if delays:
+            return min(delays)
+        return None
+
+    def roles(self, activity):
+        '''list of groups (roles) of the activity.
+        '''
+        return self._roles.get(getattr(activity, 'id', activity), [])
+
+    def role_ids(self, activity):
+        '''set of group ids (roles) of the activity.
+        '''
+        return self._role_ids.get(getattr(activity, 'id', activity), frozenset())
+
+    def is_stale(self):
+        '''checks Process.date, at most every settings.WF_GRAPH_CHECK_DELAY seconds.
+        '''
+        now = time.time()
+        if now - self.checked < _check_delay():
+            return False
+        self.checked = now
+        dates = Process.objects.filter(pk=self.id).values_list('date', flat=True)
+        return len(dates) == 0 or dates[0] != self.date
+
+    def __unicode__(self):
+        return self.title
+
+
+def _build(process):
+    graph = ProcessGraph(process)
+    _graphs[graph.id] = graph
+    _titles[graph.title] = graph.id
+    for id in graph.activities:
+        _activities[id] = graph.id
+    log.debug('process graph %s compiled', graph.title)
+    return graph
+
+
+def get_graph(process):
+    '''
+    returns the compiled graph of a process.
+
+    :type process: Process or int
+    :param process: a process or a process id
+    :rtype: ProcessGraph
+    '''
+    if isinstance(process, Process):
+        graph = _graphs.get(process.id)
+        if graph is None or graph.date != process.date:
+            graph = _build(process)
+        return graph
+    graph = _graphs.get(process)
+    if graph is None or graph.is_stale():
+        graph = _build(Process.objects.get(pk=process))
+    return graph
+
+
+def get_graph_by_title(title):
+    '''
+    returns the compiled graph of a process given its title.
+
+    :type title: string
+    :param title: a name of a process. e.g. 'leave'
+    :rtype: ProcessGraph
+    '''
+    id = _titles.get(title)
+    if id is not None:
+        graph = _graphs.get(id)
+        if graph is not None and graph.title == title and not graph.is_stale():
+            return graph
+    return _build(Process.objects.get(title=title))
+
+
+def get_activity_graph(activity):
+    '''
+    returns the compiled graph of the process owning an activity.
+
+    :type activity: Activity or int
+    :param activity: an activity or an activity id
+    :rtype: ProcessGraph
+    '''
+    if isinstance(activity, Activity):
+        return get_graph(activity.process_id)
+    id = _activities.get(activity)
+    if id is None:
+        id = Activity.objects.filter(pk=activity).values_list('process', flat=True)[0]
+    graph = get_graph(id)
+    if activity not in graph.activities:
+        # activity added since compilation
+        graph = _build(Process.objects.get(pk=id))
+    return graph
+
+
+def invalidate(process_id=None):
+    '''drops compiled graphs (all graphs if process_id is None).
+    '''
+    if process_id is None:
+        _graphs.clear()
+        _titles.clear()
+        _activities.clear()
+        return
+    graph = _graphs.pop(process_id, None)
+    if graph:
+        _titles.pop(graph.title, None)
+        for id in graph.activities:
+            _activities.pop(id, None)
+
+
+def _process_changed(sender, instance, **kwargs):
+    invalidate(instance.id)
+
+def _definition_changed(sender, instance, **kwargs):
+    invalidate(instance.process_id)
+    # Process.date is the definition version seen by other server processes
+    Process.objects.filter(pk=instance.process_id).update(date=datetime.now())
+
+def _roles_changed(sender, instance, **kwargs):
+    if isinstance(instance, Activity):
+        _definition_changed(sender, instance)
+    else:
+        invalidate()
+
+signals.post_save.connect(_process_changed, sender=Process)
+signals.post_delete.connect(_process_changed, sender=Process)
+for _model in (Activity, Transition):
+    signals.post_save.connect(_definition_changed, sender=_model)
+    signals.post_delete.connect(_definition_changed, sender=_model)
+signals.m2m_changed.connect(_roles_changed, sender=Activity.roles.through)
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Handler registry of applications and push applications.
+
+The callable behind an Application url (a view, found in the URLconf
+under settings.WF_APPS_PREFIX) or a PushApplication url (a function of
+the pushapps module or of the module settings.WF_PUSH_APPS_PREFIX) is
+looked up on first use and kept in memory; saving or deleting an
+application drops the entries. load() resolves them all in advance: the
+goflow_autoworkers command calls it at startup, a project may call it
+once its URLconf is loaded (not from a urls module: the URLconf would be
+imported recursively).
+
+Handlers may also register themselves::
+
+    @pushapp
+    def route_to_manager(workitem):
+        return workitem.instance.user.get_profile().manager
+
+    @application('sendmail')
+    def sendmail(workitem, **kwargs):
+        ...
+
+usage::
+
+    handler = get_push_handler('route_to_requester')
+    func, kwargs = get_auto_handler('sendmail')
+'''
+from django.conf import settings
+from django.core.urlresolvers import resolve
+from django.db.models import signals
+
+from models import Application, PushApplication
+from logger import Log; log = Log('goflow.workflow.handlers')
+
+# url -> callable, registered by decorators
+_registered_push = {}
+_registered_apps = {}
+# url -> callable
+_push = {}
+# url -> (view, detected as auto)
+_apps = {}
+# url -> (callable, url keyword arguments)
+_autos = {}
+
+
+def pushapp(func=None, name=None):
+    '''
+    decorator registering a push application handler under name
+    (default: the function name).
+    '''
+    def decorator(func):
+        _registered_push[name or func.__name__] = func
+        _push.pop(name or func.__name__, None)
+        return func
+    if func is None:
+        return decorator
+    return decorator(func)
+
+def application(url):
+    '''
+    decorator registering the handler of an auto application url,
+    instead of the view of the URLconf.
+    '''
+    def decorator(func):
+        _registered_apps[url] = func
+        _apps.pop(url, None)
+        _autos.pop(url, None)
+        return func
+    return decorator
+
+
+def _app_path(url):
+    return '%s/%s/' % (settings.WF_APPS_PREFIX, url)
+
+def _find_push(url):
+    if url in _registered_push:
+        return _registered_push[url]
+    # built-in handlers first
+    import pushapps
+    if hasattr(pushapps, url):
+        return getattr(pushapps, url)
+    prefix = settings.WF_PUSH_APPS_PREFIX
+    module = __import__(prefix, {}, {}, [url])
+    return getattr(module, url)
+
+
+def get_push_handler(url):
+    '''
+    returns the function of a push application.
+
+    :type url: str
+    :rtype: function
+    '''
+    handler = _push.get(url)
+    if handler is None:
+        handler = _push[url] = _find_push(url)
+    return handler
+
+def get_app_handler(url):
+    '''
+    returns the view of an application and whether it was detected as an
+    auto application (its url takes no suffix).
+
+    @rtype: (function, bool)
+    '''
+    entry = _apps.get(url)
+    if entry is None:
+        if url in _registered_apps:
+            entry = (_registered_apps[url], True)
+        else:
+            try:
+                func, args, kwargs = resolve(_app_path(url) + '0/')
+                entry = (func, False)
+            except Exception:
+                func, args, kwargs = resolve(_app_path(url))
+                entry = (func, True)
+        _apps[url] = entry
+    return entry
+
+def get_auto_handler(url):
+    '''
+    returns the function of an auto application and the keyword
+    arguments defined in urls.py.
+
+    @rtype: (function, dict)
+    '''
+    entry = _autos.get(url)
+    if entry is None:
+        if url in _registered_apps:
+            entry = (_registered_apps[url], {})
+        else:
+            func, args, kwargs = resolve(_app_path(url))
+            entry = (func, kwargs)
+        _autos[url] = entry
+    return entry
+
+
+def load():
+    '''resolves the handlers of all applications; unresolved urls are
+    logged (and resolved again on use).
+    '''
+    for url in Application.objects.values_list('url', flat=True):
+        try:
+            get_app_handler(url)
+        except Exception, v:
+            log.warning('application %s not resolved: %s', url, v)
+    for url in PushApplication.objects.values_list('url', flat=True):
+        try:
+            get_push_handler(url)
+        except Exception, v:
+            log.warning('push application %s not resolved: %s', url, v)
+
+def invalidate():
+    '''drops all the resolved handlers (registered ones are kept).
+    '''
+    _push.clear()
+    _apps.clear()
+    _autos.clear()
+
+
+def _application_changed(sender, instance, **kwargs):
+    # the url may have changed: previous entries are dropped too
+    invalidate()
+
+for _model in (Application, PushApplication):
+    signals.post_save.connect(_application_changed, sender=_model)
+    signals.post_delete.connect(_application_changed, sender=_model)
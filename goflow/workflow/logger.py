@@ -1,56 +1,202 @@
+'''
+Logging for goflow.
+
+Nothing is configured at import time: the first record emitted through a
+Log configures the root logger (unless the project already did), with
+the file settings.LOGGING_FILE (default workflow.log).
+
+With settings.WF_LOG_ASYNC (default True) the calling thread only puts
+the record in a bounded queue; a listener thread formats it and writes
+the file. Records are dropped, never waited for, when the queue is full.
+
+Engine records carry the ids of their workitem, instance and activity::
+
+    log.info('forwarded to %s', activity.title, extra=log.ids(workitem))
+
+A fraction settings.WF_LOG_DEBUG_SAMPLE (default 1.0: all) of the debug
+records is kept.
+'''
+import atexit
 import logging
-from django.conf import settings
-from django.db.models import get_model
+import random
 import sys
+import threading
+import Queue
 
-try:
-    _file_log = settings.LOGGING_FILE
-    _LOG_FILE_NOTSET = False
-except AttributeError, e:
-    _LOG_FILE_NOTSET = True
-    _file_log = 'workflow.log'
-
-if settings.DEBUG:
-    level=logging.DEBUG
-else:
-    level=logging.INFO
+from django.conf import settings
 
-log_format='%(asctime)s %(levelname)s %(module)s.%(funcName)s: %(message)s'
+log_format = '%(asctime)s %(levelname)s %(module)s.%(funcName)s: %(message)s'
 # python 2.4 ?
 if sys.version_info[:2]==(2,4):
-    log_format='%(asctime)s %(levelname)s %(module)s: %(message)s'
+    log_format = '%(asctime)s %(levelname)s %(module)s: %(message)s'
 # log_format='%(asctime)s %(levelname)s %(name)s.%(funcName)s: %(message)s'
 
-logging.basicConfig(
-    filename=_file_log,
-    level=level, 
-    format=log_format,
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-log = logging.getLogger('goflow.common')
-if _LOG_FILE_NOTSET:
-     log.warning('settings.LOGGING_FILE not set; default is workflow.log')
+ID_FIELDS = ('instance_id', 'workitem_id', 'activity_id')
+
+_lock = threading.Lock()
+_configured = False
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """Appends the ids found in the record (see Log.ids).
+    """
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        ids = ['%s=%s' % (name[:-3], getattr(record, name)) for name in ID_FIELDS
+               if getattr(record, name, None) is not None]
+        if ids:
+            text = '%s [%s]' % (text, ' '.join(ids))
+        return text
+
+
+class DebugSampler(logging.Filter):
+    """Keeps a fraction rate of the debug records.
+    """
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        return random.random() < self.rate
+
+
+class QueueHandler(logging.Handler):
+    """Puts records in a queue, read by a QueueListener.
+
+    The message is rendered in the calling thread (arguments must be
+    cheap values, not model instances); formatting and I/O are left to
+    the listener.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Thread passing the queued records to the real handlers.
+    """
+    _stop = object()
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='goflow-log')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(self._stop)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def configure():
+    '''configures the root logger, once (called by the first Log record).
+    '''
+    global _configured, _listener
+    if _configured:
+        return
+    _lock.acquire()
+    try:
+        if _configured:
+            return
+        _configured = True
+        root = logging.getLogger()
+        if root.handlers:
+            # configured by the project
+            return
+        root.setLevel(settings.DEBUG and logging.DEBUG or logging.INFO)
+        file_log = getattr(settings, 'LOGGING_FILE', None)
+        handler = logging.FileHandler(file_log or 'workflow.log')
+        handler.setFormatter(StructuredFormatter(log_format, "%Y-%m-%d %H:%M:%S"))
+        if getattr(settings, 'WF_LOG_ASYNC', True):
+            queue = Queue.Queue(getattr(settings, 'WF_LOG_QUEUE_SIZE', 10000))
+            _listener = QueueListener(queue, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+            handler = QueueHandler(queue)
+        rate = getattr(settings, 'WF_LOG_DEBUG_SAMPLE', 1.0)
+        if rate < 1.0:
+            handler.addFilter(DebugSampler(rate))
+        root.addHandler(handler)
+    finally:
+        _lock.release()
+    if not file_log:
+        logging.getLogger('goflow.common').warning('settings.LOGGING_FILE not set; default is workflow.log')
 
 
 class Log(object):
     def __init__(self, module):
         self.log = logging.getLogger(module)
-        # self._event = get_model('runtime', 'Event').objects
 
     def __getattr__(self, name):
-        try:
-            return getattr(self.log, name)
-        except AttributeError, e:
-            return getattr(self, name)
+        # debug, info, warning, error ...
+        configure()
+        return getattr(self.log, name)
+
+    def ids(self, workitem=None, instance=None, activity=None):
+        '''
+        returns the extra ids of a record (no query).
+
+        usage::
+
+            log.info('complete', extra=log.ids(workitem))
+        '''
+        extra = {}
+        if workitem is not None:
+            extra['workitem_id'] = workitem.pk
+            extra['instance_id'] = workitem.instance_id
+            extra['activity_id'] = workitem.activity_id
+        if instance is not None:
+            extra['instance_id'] = getattr(instance, 'pk', instance)
+        if activity is not None:
+            extra['activity_id'] = getattr(activity, 'pk', activity)
+        return extra
 
     def __call__(self, *args):
-        if len(args) == 0: 
+        if len(args) == 0:
             return
-        elif len(args) == 1:
-            self.log.info(args[0] )
-        else:
-            self.log.info(u" ".join([unicode(i) for i in args]))
+        configure()
+        if self.log.isEnabledFor(logging.INFO):
+            # rendered by the handler, not here
+            self.log.info(u' '.join([u'%s'] * len(args)), *args)
 
     def event(self, msg, workitem):
-        # self._event.create(name=msg, workitem=workitem)
-        self.log.info(u'EVENT: [%s] %s' % (workitem.__unicode__(), msg))
+        configure()
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info('EVENT: %s', msg, extra=self.ids(workitem))
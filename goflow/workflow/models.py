@@ -3,15 +3,46 @@
 from django.db import models
 from django.contrib.auth.models import Group, User, Permission
 from django.contrib.contenttypes.models import ContentType
-from django.core.urlresolvers import resolve
+from django.core.exceptions import ValidationError
 
 from django.conf import settings
 
 from django import forms
 from decorators import allow_tags
 
+import ast
 from datetime import datetime, timedelta
 from logger import Log; log = Log('goflow.workflow.managers')
+from authcache import get_user_roles
+
+# parameters text -> dict
+_params = {}
+
+def parse_params(text):
+    '''
+    returns the dictionary of an activity parameters field (app_param,
+    pushapp_param), a python literal such as "{'username':'john'}"; the
+    braces may be omitted.
+    
+    Parsed values are cached and shared: they must not be modified.
+    
+    @rtype: dict
+    '''
+    if not text or not text.strip():
+        return {}
+    params = _params.get(text)
+    if params is None:
+        source = text.strip()
+        if not source.startswith('{'):
+            source = '{%s}' % source
+        params = ast.literal_eval(source)
+        if not isinstance(params, dict):
+            raise ValueError('parameters must be a dictionary: %s' % text)
+        for key in params:
+            if not isinstance(key, basestring):
+                raise ValueError('parameter names must be strings: %r' % key)
+        _params[text] = params
+    return params
 
 class Activity(models.Model):
     """Activities represent any kind of action an employee might want to do on an instance.
@@ -50,7 +81,25 @@ class Activity(models.Model):
     def nb_input_transitions(self):
         ''' returns the number of inputing transitions.
         '''
-        return Transition.objects.filter(output=self, process=self.process).count()
+        from graph import get_graph
+        return get_graph(self.process_id).nb_input_transitions(self)
+    
+    def get_app_params(self):
+        '''parameters of the application (app_param field) as a dictionary.
+        '''
+        return parse_params(self.app_param)
+    
+    def get_pushapp_params(self):
+        '''parameters of the push application (pushapp_param field) as a dictionary.
+        '''
+        return parse_params(self.pushapp_param)
+    
+    def clean(self):
+        for name in ('app_param', 'pushapp_param'):
+            try:
+                parse_params(getattr(self, name))
+            except (ValueError, SyntaxError), v:
+                raise ValidationError('%s: %s' % (self._meta.get_field(name).verbose_name, v))
     
     def __unicode__(self):
         return '%s (%s)' % (self.title, self.process.title)
@@ -78,7 +127,8 @@ class ProcessManager(models.Manager):
                 # do something
         
         '''
-        return self.get(title=title).enabled
+        from graph import get_graph_by_title
+        return get_graph_by_title(title).enabled
     
     def check_can_start(self, process_name, user):
         '''
@@ -98,9 +148,7 @@ class ProcessManager(models.Manager):
             raise Exception('process %s disabled.' % process_name)
         
         if user.has_perm("workflow.can_instantiate"):
-            lst = user.groups.filter(name=process_name)
-            if lst.count()==0 or \
-               (lst[0].permissions.filter(codename='can_instantiate').count() == 0):
+            if not get_user_roles(user).has_group_perm(process_name, 'can_instantiate'):
                 raise Exception('permission needed to instantiate process %s.' % process_name)
         else:
             raise Exception('permission needed.')
@@ -233,14 +281,10 @@ class Application(models.Model):
         return path
     
     def get_handler(self):
-        '''returns handler mapped to url.
+        '''returns handler mapped to url (see goflow.workflow.handlers).
         '''
-        try:
-            func, args, kwargs = resolve(self.get_app_url() + '0/')
-            self.detected_as_auto = False
-        except Exception:
-            func, args, kwargs = resolve(self.get_app_url())
-            self.detected_as_auto = True
+        from handlers import get_app_handler
+        func, self.detected_as_auto = get_app_handler(self.url)
         return func
     
     @allow_tags
@@ -315,19 +359,11 @@ class PushApplication(models.Model):
     url = models.CharField(max_length=255, unique=True)
     
     def get_handler(self):
-        '''returns handler mapped to url.
+        '''returns handler mapped to url (see goflow.workflow.handlers).
         '''
+        from handlers import get_push_handler
         try:
-            # search first in pre-built handlers
-            import pushapps
-            if self.url in dir(pushapps):
-                # TODO
-                return eval('pushapps.%s' % self.url)
-            # then search elsewhere
-            prefix = settings.WF_PUSH_APPS_PREFIX
-            # dyn import
-            exec 'import %s' % prefix
-            return eval('%s.%s' % (prefix, self.url))
+            return get_push_handler(self.url)
         except Exception, v:
             log.error('PushApplication.get_handler %s', v)
         return None
@@ -373,6 +409,13 @@ class Transition(models.Model):
     output = models.ForeignKey(Activity, related_name='transition_outputs')
     description = models.CharField(max_length=100, null=True, blank=True)
     precondition = models.SlugField(null=True, blank=True, help_text='object method that return True if transition is posible')
+    timeout = models.IntegerField(null=True, blank=True, editable=False,
+                                  help_text='delay in seconds of a workitem.time_out condition')
+    
+    def __init__(self, *args, **kwargs):
+        models.Model.__init__(self, *args, **kwargs)
+        # input and timeout known by the workitem timers (see goflow.runtime)
+        self._saved_timer = self.pk and (self.input_id, self.timeout) or (None, None)
     
     def is_transition(self):
         ''' used in admin templates.
@@ -382,6 +425,8 @@ class Transition(models.Model):
     def save(self):
         if self.input.process != self.process or self.output.process != self.process:
             raise Exception("a transition and its activities must be linked to the same process")
+        from conditions import parse_timeout
+        self.timeout = parse_timeout(self.condition)
         models.Model.save(self)
     
     def __unicode__(self):
@@ -1,9 +1,15 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
+from django.core.mail import EmailMessage
 from django.template import Context, Template
 from django.template.loader import render_to_string
-def send_mail(workitems=None, user=None, subject='message', template='mail.txt'):
+
+def render_mail(workitems=None, user=None, subject='message', template='mail.txt'):
+    '''
+    returns an EmailMessage to the user; subject is a template string.
+    '''
     # subject
     try:
         subject = settings.EMAIL_SUBJECT_PREFIX + subject
@@ -17,5 +23,7 @@ def send_mail(workitems=None, user=None, subject='message', template='mail.txt')
                                           'user':user,
                                           'url_prefix':'http://%s/' % profile.web_host
                                           })
-    
-    user.email_user(subject, message)
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [user.email])
+
+def send_mail(workitems=None, user=None, subject='message', template='mail.txt'):
+    render_mail(workitems=workitems, user=user, subject=subject, template=template).send()
@@ -19,7 +19,7 @@ def route_to_superuser(workitem, username='admin'):
     user = User.objects.get(username=username)
     if user.is_superuser:
         return user
-    log.warning('this user is not a super-user:', username)
+    log.warning('this user is not a super-user: %s', username)
     return None
 
 def to_current_superuser(workitem, user_pushed):
@@ -0,0 +1,448 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+'''
+Discrete event simulation of process definitions.
+
+A process definition is loaded once (see goflow.workflow.graph), then
+thousands of virtual instances run through it in memory, without any
+database access. The simulation is configured by:
+
+- service times per activity: ('exp', mean), ('const', value),
+  ('uniform', low, high), ('normal', mu, sigma), ('lognormal', mu, sigma),
+  ('triangular', low, high, mode), ('gamma', alpha, beta), ('empirical', [values])
+  or a function of a random.Random
+- staffing: number of people per role; a human activity is served by
+  the pool of its first staffed role (one person by default)
+- branch probabilities of xor splits, by transition name or
+  (input title, output title); uniform by default
+- the interarrival time of instances
+
+Auto activities (autostart or dummy) take no time unless configured and
+use nobody. Conditions and time_out transitions are not evaluated: xor
+splits use the branch probabilities, AND splits fire all their transitions.
+
+usage::
+
+    model = SimulationModel.from_process('leave')
+    sim = Simulator(model, arrival=('exp', 0.5),
+                    service_times={'approval': ('exp', 2.0)},
+                    staffing={'manager': 2},
+                    branch_probabilities={('approval', 'refusal'): 0.1})
+    result = sim.run(instances=10000)
+    print result.cycle_time.p95, result.pools['manager'].utilization
+'''
+import heapq
+import random
+from bisect import bisect_right
+from collections import deque
+
+from graph import get_graph, get_graph_by_title
+
+
+class SimActivity(object):
+    """An activity of a SimulationModel.
+    """
+    def __init__(self, index, title, auto=False, join_mode='xor', split_mode='and',
+                 roles=(), subflow=None):
+        self.index = index
+        self.title = title
+        self.auto = auto
+        self.join_mode = join_mode
+        self.split_mode = split_mode
+        self.roles = tuple(roles)
+        self.subflow = subflow
+        # [(transition name, target activity index)]
+        self.outgoing = []
+        self.n_inputs = 0
+
+
+class SimulationModel(object):
+    """In-memory process definition: activities, transitions, begin and end.
+    """
+    def __init__(self, title):
+        self.title = title
+        self.activities = []
+        self._index = {}
+        self.begin = None
+        self.end = None
+
+    def add_activity(self, title, **kwargs):
+        activity = SimActivity(len(self.activities), title, **kwargs)
+        self.activities.append(activity)
+        self._index[title] = activity
+        return activity
+
+    def add_transition(self, input, output, name=None):
+        input, output = self.activity(input), self.activity(output)
+        input.outgoing.append((name or '%s-%s' % (input.title, output.title), output.index))
+        output.n_inputs += 1
+
+    def activity(self, title):
+        if isinstance(title, SimActivity):
+            return title
+        return self._index[title]
+
+    def from_graph(cls, graph, _models=None):
+        '''
+        builds the model of a ProcessGraph (and of its subflows).
+        '''
+        if _models is None:
+            _models = {}
+        model = _models[graph.id] = cls(graph.title)
+        ids = {}
+        for id, a in sorted(graph.activities.items()):
+            subflow = None
+            if a.kind == 'subflow' and a.subflow_id:
+                subflow = _models.get(a.subflow_id)
+                if subflow is None:
+                    subflow = cls.from_graph(get_graph(a.subflow_id), _models)
+            ids[id] = model.add_activity(a.title, auto=(a.autostart or a.kind == 'dummy'),
+                                         join_mode=a.join_mode, split_mode=a.split_mode,
+                                         roles=[r.name for r in graph.roles(a)], subflow=subflow)
+        for id in ids:
+            for t in graph.outgoing(id):
+                model.add_transition(ids[t.input_id], ids[t.output_id], t.name)
+        model.begin = graph.begin and ids[graph.begin.id]
+        model.end = graph.end and ids[graph.end.id]
+        return model
+    from_graph = classmethod(from_graph)
+
+    def from_process(cls, process):
+        '''
+        builds the model of a process (Process, id or title).
+        '''
+        if isinstance(process, basestring):
+            return cls.from_graph(get_graph_by_title(process))
+        return cls.from_graph(get_graph(process))
+    from_process = classmethod(from_process)
+
+    def models(self):
+        '''this model and its subflow models.'''
+        result, todo = [], [self]
+        while todo:
+            model = todo.pop()
+            if model in result:
+                continue
+            result.append(model)
+            todo.extend([a.subflow for a in model.activities if a.subflow])
+        return result
+
+
+def make_distribution(spec, rnd):
+    '''
+    returns a function drawing values of a distribution spec (see module doc).
+    '''
+    if spec is None:
+        return lambda: 0.0
+    if callable(spec):
+        return lambda: spec(rnd)
+    if isinstance(spec, (int, long, float)):
+        value = float(spec)
+        return lambda: value
+    kind, args = spec[0], spec[1:]
+    if kind == 'const':
+        value = float(args[0])
+        return lambda: value
+    if kind == 'exp':
+        if not args[0]:
+            return lambda: 0.0
+        rate = 1.0 / args[0]
+        expovariate = rnd.expovariate
+        return lambda: expovariate(rate)
+    if kind == 'uniform':
+        low, high = args
+        return lambda: rnd.uniform(low, high)
+    if kind == 'normal':
+        mu, sigma = args
+        return lambda: max(0.0, rnd.normalvariate(mu, sigma))
+    if kind == 'lognormal':
+        mu, sigma = args
+        return lambda: rnd.lognormvariate(mu, sigma)
+    if kind == 'triangular':
+        low, high, mode = args
+        return lambda: rnd.triangular(low, high, mode)
+    if kind == 'gamma':
+        alpha, beta = args
+        return lambda: rnd.gammavariate(alpha, beta)
+    if kind == 'empirical':
+        values = list(args[0])
+        return lambda: rnd.choice(values)
+    raise ValueError('unknown distribution %r' % (spec,))
+
+
+class Distribution(object):
+    """Summary of observed values.
+    """
+    def __init__(self, values):
+        self.values = sorted(values)
+        self.count = len(self.values)
+        if self.count:
+            self.min = self.values[0]
+            self.max = self.values[-1]
+            self.mean = sum(self.values) / self.count
+        else:
+            self.min = self.max = self.mean = None
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        return self.values[min(self.count - 1, int(q * self.count))]
+
+    p50 = property(lambda self: self.quantile(0.5))
+    p95 = property(lambda self: self.quantile(0.95))
+    p99 = property(lambda self: self.quantile(0.99))
+
+
+class Pool(object):
+    """People of a role serving workitems in FIFO order.
+    """
+    def __init__(self, name, servers):
+        self.name = name
+        self.servers = servers
+        self.busy = 0
+        self.queue = deque()
+        self.served = 0
+        self.max_queue = 0
+        # time integrals
+        self.last = 0.0
+        self.busy_area = 0.0
+        self.queue_area = 0.0
+
+    def touch(self, now):
+        elapsed = now - self.last
+        self.busy_area += self.busy * elapsed
+        self.queue_area += len(self.queue) * elapsed
+        self.last = now
+
+
+class PoolStats(object):
+    def __init__(self, pool, duration):
+        self.name = pool.name
+        self.servers = pool.servers
+        self.served = pool.served
+        self.max_queue = pool.max_queue
+        if duration > 0:
+            self.utilization = pool.busy_area / (pool.servers * duration)
+            self.mean_queue = pool.queue_area / duration
+        else:
+            self.utilization = self.mean_queue = 0.0
+
+
+class ActivityResult(object):
+    def __init__(self, title, count, wait, service):
+        self.title = title
+        self.count = count
+        self.mean_wait = count and wait / count or 0.0
+        self.mean_service = count and service / count or 0.0
+
+
+class SimulationResult(object):
+    """Outputs of a run.
+
+    - cycle_time: Distribution of the cycle times of the completed instances
+    - pools: {role name: PoolStats} (utilization, mean_queue, max_queue, served)
+    - activities: {(process title, activity title): ActivityResult} (mean_wait, mean_service)
+    - completed: number of completed instances; unfinished: instances
+      still running (horizon, max_steps) or stuck in the definition
+    - steps: events processed; duration: simulated time
+    """
+    def __init__(self, cycle_times, pools, activities, unfinished, steps, duration):
+        self.cycle_time = Distribution(cycle_times)
+        self.pools = dict((p.name, PoolStats(p, duration)) for p in pools)
+        self.activities = activities
+        self.completed = len(cycle_times)
+        self.unfinished = unfinished
+        self.steps = steps
+        self.duration = duration
+
+
+class _Node(object):
+    """A compiled activity: configuration resolved, targets linked.
+    """
+    __slots__ = ('key', 'service', 'pool', 'choices', 'targets', 'xor', 'join', 'subflow', 'end')
+
+
+class Simulator(object):
+    """Runs virtual instances of a SimulationModel.
+
+    The model is compiled once; each call to run() starts from empty
+    queues and keeps drawing from the same random generator.
+    """
+    def __init__(self, model, arrival=('exp', 1.0), service_times=None, staffing=None,
+                 branch_probabilities=None, default_service=('exp', 1.0), default_staff=1,
+                 seed=None):
+        self.model = model
+        self.rnd = random.Random(seed)
+        self.arrival = make_distribution(arrival, self.rnd)
+        service_times = service_times or {}
+        staffing = staffing or {}
+        branch_probabilities = branch_probabilities or {}
+        # pool name -> number of people
+        self.staffing = {}
+        nodes = {}
+        for m in model.models():
+            for a in m.activities:
+                node = nodes[(m, a.index)] = _Node()
+                node.key = (m.title, a.title)
+                spec = service_times.get(node.key, service_times.get(a.title))
+                if spec is None and not a.auto and not a.subflow:
+                    spec = default_service
+                node.service = make_distribution(spec, self.rnd)
+                node.pool = None
+                if not a.auto and not a.subflow:
+                    staffed = [r for r in a.roles if r in staffing]
+                    node.pool = (staffed or a.roles or ('*',))[0]
+                    self.staffing[node.pool] = staffing.get(node.pool, default_staff)
+                node.xor = (a.split_mode == 'xor')
+                node.join = 0
+                if a.join_mode == 'and' and a.n_inputs > 1:
+                    node.join = a.n_inputs
+                node.end = (a is m.end)
+                node.choices = None
+                if node.xor and len(a.outgoing) > 1:
+                    weights = []
+                    for name, target in a.outgoing:
+                        key = (a.title, m.activities[target].title)
+                        weights.append(branch_probabilities.get(name,
+                                       branch_probabilities.get(key, 1.0)))
+                    total, cumulative = float(sum(weights)), []
+                    for w in weights:
+                        cumulative.append((cumulative and cumulative[-1] or 0.0) + w / total)
+                    node.choices = cumulative
+        for m in model.models():
+            for a in m.activities:
+                node = nodes[(m, a.index)]
+                node.targets = [nodes[(m, target)] for name, target in a.outgoing]
+                node.subflow = a.subflow and nodes[(a.subflow, a.subflow.begin.index)]
+        self.begin = nodes[(model, model.begin.index)]
+
+    def run(self, instances=1000, max_steps=None, horizon=None):
+        '''
+        simulates instances arriving one after another, until they are all
+        completed, max_steps events were processed or the time horizon.
+
+        @rtype: SimulationResult
+        '''
+        heap = []
+        push, pop = heapq.heappush, heapq.heappop
+        rnd = self.rnd.random
+        pools = dict((name, Pool(name, servers)) for name, servers in self.staffing.items())
+        seq = [0]
+        # instance id -> [start time, parent (instance id, node) or None]
+        state = {}
+        joins = {}
+        cycle_times = []
+        stats = {}
+        next_id = [0]
+
+        ARRIVAL, DONE = 0, 1
+
+        def schedule(time, kind, payload):
+            seq[0] += 1
+            push(heap, (time, seq[0], kind, payload))
+
+        def start(now, begin, parent):
+            id = next_id[0]
+            next_id[0] += 1
+            state[id] = (now, parent)
+            enter(now, id, begin)
+
+        def enter(now, id, node):
+            if node.join:
+                key = (id, node)
+                n = joins.get(key, 0) + 1
+                if n < node.join:
+                    joins[key] = n
+                    return
+                del joins[key]
+            if node.subflow is not None:
+                start(now, node.subflow, (id, node))
+                return
+            if node.pool is None:
+                schedule(now + node.service(), DONE, (id, node, now, now))
+                return
+            pool = pools[node.pool]
+            pool.touch(now)
+            if pool.busy < pool.servers:
+                pool.busy += 1
+                schedule(now + node.service(), DONE, (id, node, now, now))
+            else:
+                pool.queue.append((id, node, now))
+                if len(pool.queue) > pool.max_queue:
+                    pool.max_queue = len(pool.queue)
+
+        def finish(now, id, node):
+            if node.end:
+                started, parent = state.pop(id)
+                if parent is None:
+                    cycle_times.append(now - started)
+                else:
+                    finish(now, *parent)
+                return
+            targets = node.targets
+            if node.choices is not None:
+                enter(now, id, targets[min(bisect_right(node.choices, rnd()), len(targets) - 1)])
+            elif node.xor:
+                if targets:
+                    enter(now, id, targets[0])
+            else:
+                for target in targets:
+                    enter(now, id, target)
+
+        now = 0.0
+        arrived = 0
+        steps = 0
+        if instances:
+            schedule(0.0, ARRIVAL, None)
+        while heap:
+            time, s, kind, payload = pop(heap)
+            if horizon is not None and time > horizon:
+                now = horizon
+                break
+            now = time
+            steps += 1
+            if kind == ARRIVAL:
+                arrived += 1
+                if arrived < instances:
+                    schedule(now + self.arrival(), ARRIVAL, None)
+                start(now, self.begin, None)
+            else:
+                id, node, queued, began = payload
+                st = stats.get(node.key)
+                if st is None:
+                    st = stats[node.key] = [0, 0.0, 0.0]
+                st[0] += 1
+                st[1] += began - queued
+                st[2] += now - began
+                if node.pool is not None:
+                    pool = pools[node.pool]
+                    pool.touch(now)
+                    pool.served += 1
+                    if pool.queue:
+                        qid, qnode, qtime = pool.queue.popleft()
+                        schedule(now + qnode.service(), DONE, (qid, qnode, qtime, now))
+                    else:
+                        pool.busy -= 1
+                finish(now, id, node)
+            if max_steps is not None and steps >= max_steps:
+                break
+
+        for pool in pools.values():
+            pool.touch(now)
+        activities = dict((key, ActivityResult(key[1], n, wait, service))
+                          for key, (n, wait, service) in stats.items())
+        unfinished = len([1 for started, parent in state.values() if parent is None])
+        return SimulationResult(cycle_times, pools.values(), activities, unfinished, steps, now)
+
+
+def monte_carlo(model, runs=10, instances=1000, seed=0, **kwargs):
+    '''
+    runs independent simulations (seeds seed, seed+1, ...).
+
+    @rtype: [SimulationResult]
+    '''
+    results = []
+    for i in range(runs):
+        simulator = Simulator(model, seed=seed + i, **kwargs)
+        results.append(simulator.run(instances=instances))
+    return results
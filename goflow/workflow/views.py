@@ -93,14 +93,11 @@ def process_dot(request, id, template='goflow/process.dot'):
 
 def cron(request=None):
     """
-    (**Work In Progress**)
-    TODO: move to instances ?
+    forwards the workitems whose time_out transitions are due
+    (see goflow.runtime.timers).
     """
-    for t in Transition.objects.filter(condition__contains='workitem.timeout'):
-        workitems = WorkItem.objects.filter(
-            activity=t.input).exclude(status='complete')
-        for wi in workitems:
-            wi.forward(timeout_forwarding=True)
+    from goflow.runtime.timers import run_timers
+    run_timers()
     
     if request:
         request.user.message_set.create(message="cron has run.")
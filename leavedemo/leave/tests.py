@@ -1,7 +1,41 @@
 #!/usr/local/bin/python
 # -*- coding: utf-8 -*-
+import imp
+import logging
+import os
+import Queue
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core import mail
 from django.test import TestCase
 from django.test.client import Client
+from django.utils import simplejson
+from django.contrib.auth.models import User, Group
+from django.db.models import signals
+
+from goflow.workflow.models import Process, Activity, Transition
+from goflow.workflow.graph import get_graph, get_graph_by_title
+from goflow.workflow.conditions import Condition, get_condition, parse_timeout
+from goflow.workflow.authcache import get_user_roles
+from goflow.workflow import handlers, pushapps
+from goflow.workflow.models import Application, PushApplication, parse_params
+from django.core.exceptions import ValidationError
+from goflow.workflow.simulation import SimulationModel, Simulator, monte_carlo
+from goflow.workflow.logger import Log, StructuredFormatter, QueueHandler, QueueListener, DebugSampler
+from goflow.runtime.models import ProcessInstance, WorkItem, Event, WorklistEntry, JoinState
+from goflow.runtime.models import AutoTask, TimerLease, Notification, WorkItemConflict
+from goflow.runtime.events import buffered_events, buffer_events, current_buffer
+from goflow.runtime.archive import archive_instances
+from goflow.runtime.outbox import send_notifications
+from goflow.runtime.timers import fire_due_timers
+from goflow.runtime.history import get_instance_history, load_history
+from goflow.runtime.bulk import chunks, select_m2m_rows, insert_m2m_rows
+from goflow.runtime import metrics
+from goflow.runtime.reporting import activity_states, process_states, rebuild_counters
+from goflow.runtime.reporting import update_activity_stats, ActivityStats
+from goflow.apptools.models import DefaultAppModel
+import goflow
 
 class Test(TestCase):
     def test_home_anonymous(self):
@@ -30,4 +64,977 @@ class Test(TestCase):
         response = client.get('/leave/admin/')
         self.failUnlessEqual(response.status_code, 200)
         client.logout()
-  
\ No newline at end of file
+  
+
+
+class EngineTestCase(TestCase):
+    """Builds small processes for the engine tests.
+    """
+    def setUp(self):
+        self.primus = User.objects.get(username='primus')
+        self.secundus = User.objects.get(username='secundus')
+        self.employee = Group.objects.get(name='employee')
+
+    def make_process(self, title, activities, transitions):
+        '''
+        activities: [(title, Activity fields)], the first one is the begin
+        activity; roles default to [employee].
+        transitions: [(input title, output title, condition)]; 'End' is the
+        end activity created by Process.save.
+        
+        returns the process and its activities by title.
+        '''
+        process = Process(title=title, description='')
+        process.save()
+        acts = {'End':process.end}
+        for name, fields in activities:
+            fields = dict(fields)
+            roles = fields.pop('roles', [self.employee])
+            a = Activity.objects.create(title=name, process=process, **fields)
+            for role in roles:
+                a.roles.add(role)
+            acts[name] = a
+        process = Process.objects.get(pk=process.pk)
+        process.begin = acts[activities[0][0]]
+        process.save()
+        for i, (input, output, condition) in enumerate(transitions):
+            Transition(name='%s_%d' % (title, i), process=process, input=acts[input],
+                       output=acts[output], condition=condition).save()
+        return Process.objects.get(pk=process.pk), acts
+
+    def linear(self, title, length=2, **fields):
+        '''process step0 -> step1 ... -> End.'''
+        names = ['step%d' % i for i in range(length)]
+        transitions = zip(names, names[1:] + ['End'], [''] * length)
+        return self.make_process(title, [(name, fields) for name in names], transitions)
+
+    def start(self, process, user=None, **kwargs):
+        return ProcessInstance.objects.start(process.title, user or self.primus,
+                                             DefaultAppModel.objects.create(history=''), **kwargs)
+
+    def run(self, workitem, user=None):
+        '''activates and completes a workitem.'''
+        user = user or self.primus
+        workitem = WorkItem.objects.get(pk=workitem.pk)
+        workitem.activate(user)
+        workitem.complete(user)
+        return workitem
+
+    def login(self, user=None):
+        '''a test client logged in as user (default: primus).'''
+        user = user or self.primus
+        user.set_password('secret')
+        user.save()
+        client = Client()
+        self.assertTrue(client.login(username=user.username, password='secret'))
+        return client
+
+
+class GraphTest(EngineTestCase):
+    def test_graph_cached(self):
+        process, acts = self.linear('t_graph')
+        graph = get_graph(process.id)
+        self.assertTrue(get_graph(process.id) is graph)
+        self.assertTrue(get_graph_by_title('t_graph') is graph)
+        self.assertEqual([t.output_id for t in graph.outgoing(acts['step0'])], [acts['step1'].id])
+        self.assertEqual(graph.nb_input_transitions(acts['End']), 1)
+        self.assertEqual(graph.role_ids(acts['step0']), frozenset([self.employee.id]))
+
+    def test_graph_invalidated(self):
+        process, acts = self.linear('t_graph_change')
+        graph = get_graph(process.id)
+        Transition(name='extra', process=process, input=acts['step0'], output=acts['End']).save()
+        self.assertFalse(get_graph(process.id) is graph)
+        self.assertEqual(len(get_graph(process.id).outgoing(acts['step0'])), 2)
+        # roles are part of the definition
+        secretary = Group.objects.get(name='secretary')
+        acts['step1'].roles.add(secretary)
+        self.assertEqual(get_graph(process.id).role_ids(acts['step1']),
+                         frozenset([self.employee.id, secretary.id]))
+
+
+class ConditionTest(EngineTestCase):
+    def test_kinds(self):
+        self.assertEqual(Condition('').kind, 'always')
+        self.assertEqual(Condition('OK').kind, 'literal')
+        self.assertEqual(Condition("'OK: go'").value, 'OK: go')
+        # not python: compared as is
+        self.assertEqual(Condition('OK: Forward to secretary').value, 'OK: Forward to secretary')
+        self.assertEqual(Condition('instance.condition == "KO"').kind, 'expression')
+        self.assertEqual(parse_timeout("workitem.time_out(delay=1, unit='minutes')"), 60)
+        self.assertEqual(parse_timeout('OK'), None)
+
+    def test_cached(self):
+        process, acts = self.linear('t_cond_cache')
+        t = Transition.objects.get(process=process, input=acts['step0'])
+        self.assertTrue(get_condition(t) is get_condition(t))
+        t.condition = 'OK'
+        self.assertEqual(get_condition(t).kind, 'literal')
+
+    def test_routing(self):
+        process, acts = self.make_process('t_cond',
+                                          [('begin', {'split_mode':'xor'}), ('yes', {}), ('no', {})],
+                                          [('begin', 'yes', 'OK'),
+                                           ('begin', 'no', 'instance.condition == "KO"'),
+                                           ('yes', 'End', ''), ('no', 'End', '')])
+        wi = self.start(process)
+        instance = wi.instance
+        instance.condition = 'KO'
+        instance.save()
+        self.run(wi)
+        self.assertEqual(WorkItem.objects.filter(instance=instance, activity=acts['no']).count(), 1)
+        self.assertEqual(WorkItem.objects.filter(instance=instance, activity=acts['yes']).count(), 0)
+
+
+class StartManyTest(EngineTestCase):
+    def describe(self, id):
+        wi = WorkItem.objects.get(pk=id)
+        return (wi.activity_id, wi.user_id, wi.status, wi.priority,
+                wi.instance.status, wi.instance.old_status, wi.instance.depth,
+                sorted(wi.pull_roles.values_list('id', flat=True)),
+                list(wi.events.values_list('name', flat=True)),
+                sorted(WorklistEntry.objects.filter(workitem=wi).values_list('user', 'role', 'status')))
+
+    def test_parity_with_start(self):
+        process, acts = self.linear('t_many')
+        one = self.start(process).id
+        items = [DefaultAppModel.objects.create(history='') for i in range(3)]
+        ids = ProcessInstance.objects.start_many(process.title, self.primus, items)
+        self.assertEqual(len(ids), 3)
+        for id, item in zip(ids, items):
+            self.assertEqual(self.describe(id), self.describe(one))
+            self.assertEqual(WorkItem.objects.get(pk=id).instance.content_object, item)
+
+    def test_item_given_twice(self):
+        process, acts = self.linear('t_many_twice')
+        item = DefaultAppModel.objects.create(history='')
+        self.assertRaises(Exception, ProcessInstance.objects.start_many,
+                          process.title, self.primus, [item, item])
+        self.assertEqual(ProcessInstance.objects.filter(process=process).count(), 0)
+
+    def test_timers(self):
+        process, acts = self.make_process('t_many_timer', [('step0', {}), ('step1', {})],
+                                          [('step0', 'step1', ''),
+                                           ('step0', 'End', "workitem.time_out(delay=1, unit='minutes')")])
+        one = WorkItem.objects.get(pk=self.start(process).pk)
+        ids = ProcessInstance.objects.start_many(process.title, self.primus,
+                                                 [DefaultAppModel.objects.create(history='')])
+        many = WorkItem.objects.get(pk=ids[0])
+        for wi in (one, many):
+            self.assertTrue(timedelta(seconds=59) <= wi.due_time - wi.date <= timedelta(seconds=61))
+        # the timers follow the definition
+        t = Transition.objects.get(process=process, output=acts['End'], input=acts['step0'])
+        t.condition = "workitem.time_out(delay=2, unit='minutes')"
+        t.save()
+        for wi in WorkItem.objects.filter(pk__in=[one.pk, many.pk]):
+            self.assertEqual(wi.due_time, wi.date + timedelta(minutes=2))
+        # other edits leave the workitems alone
+        sentinel = datetime(2000, 1, 1)
+        WorkItem.objects.filter(pk=one.pk).update(due_time=sentinel)
+        t = Transition.objects.get(pk=t.pk)
+        t.description = 'give up'
+        t.save()
+        self.assertEqual(WorkItem.objects.get(pk=one.pk).due_time, sentinel)
+        # the previous input activity has no timer left
+        t.input = acts['step1']
+        t.save()
+        self.assertEqual(WorkItem.objects.filter(pk__in=[one.pk, many.pk], due_time=None).count(), 2)
+        t.input = acts['step0']
+        t.save()
+        t.condition = ''
+        t.save()
+        self.assertEqual(WorkItem.objects.filter(pk__in=[one.pk, many.pk], due_time=None).count(), 2)
+
+
+class TimerTest(EngineTestCase):
+    def test_condition_false_keeps_timer(self):
+        process, acts = self.make_process('t_timer', [('step0', {}), ('step1', {})],
+                                          [('step0', 'step1', ''),
+                                           ('step0', 'End', "workitem.time_out(delay=1, unit='minutes')"
+                                                            " and instance.condition == 'late'")])
+        ids = [self.start(process).pk for i in range(2)]
+        past = datetime.now() - timedelta(minutes=2)
+        WorkItem.objects.filter(pk__in=ids).update(date=past, due_time=past + timedelta(minutes=1))
+        # one workitem per batch: the kept timers do not loop
+        self.assertEqual(fire_due_timers(batch_size=1), 2)
+        self.assertEqual(WorkItem.objects.filter(pk__in=ids, due_time=None).count(), 0)
+        self.assertEqual(WorkItem.objects.filter(activity=process.end).count(), 0)
+        # retried by the next pass
+        instance = WorkItem.objects.get(pk=ids[0]).instance
+        instance.condition = 'late'
+        instance.save()
+        fire_due_timers()
+        self.assertEqual(WorkItem.objects.get(pk=ids[0]).due_time, None)
+        self.assertEqual(WorkItem.objects.filter(activity=process.end, instance=instance).count(), 1)
+        self.assertNotEqual(WorkItem.objects.get(pk=ids[1]).due_time, None)
+
+
+class EventBufferTest(EngineTestCase):
+    def test_flushed_on_exit(self):
+        process, acts = self.linear('t_events')
+        wi = self.start(process)
+        before = Event.objects.count()
+        context = buffered_events()
+        buffer = context.__enter__()
+        Event.objects.record('one', wi)
+        # nested engine calls join the buffer
+        self.run(wi)
+        self.assertEqual(Event.objects.count(), before)
+        # activated, completed, forwarded and the creation of the next workitem
+        self.assertEqual(len(buffer), 5)
+        context.__exit__(None, None, None)
+        self.assertTrue(current_buffer() is None)
+        self.assertEqual(list(wi.events.order_by('id').values_list('name', flat=True))[-4:],
+                         ['one', 'activated by primus', 'completed by primus', 'forwarded to step1'])
+
+    def test_flushed_on_error(self):
+        process, acts = self.linear('t_events_error')
+        wi = self.start(process)
+        def fail():
+            Event.objects.record('before error', wi)
+            raise ValueError('error')
+        self.assertRaises(ValueError, buffer_events(fail))
+        self.assertTrue(current_buffer() is None)
+        self.assertEqual(wi.events.filter(name='before error').count(), 1)
+
+
+class JoinTest(EngineTestCase):
+    def and_join(self, title):
+        '''begin -> (a, b) -> join -> End'''
+        return self.make_process(title, [('begin', {'split_mode':'and'}), ('a', {}), ('b', {}),
+                                         ('join', {'join_mode':'and'})],
+                                 [('begin', 'a', ''), ('begin', 'b', ''),
+                                  ('a', 'join', ''), ('b', 'join', ''), ('join', 'End', '')])
+
+    def branches(self, process, acts):
+        wi = self.start(process)
+        self.run(wi)
+        instance = wi.instance
+        return (instance, WorkItem.objects.get(instance=instance, activity=acts['a']),
+                WorkItem.objects.get(instance=instance, activity=acts['b']))
+
+    def test_join(self):
+        process, acts = self.and_join('t_join')
+        instance, a, b = self.branches(process, acts)
+        self.run(a)
+        join = WorkItem.objects.get(instance=instance, activity=acts['join'])
+        self.assertEqual(join.status, 'blocked')
+        self.assertEqual(JoinState.objects.get(instance=instance).workitem_id, join.id)
+        self.run(b)
+        join = WorkItem.objects.get(instance=instance, activity=acts['join'])
+        self.assertEqual(join.status, 'inactive')
+        self.assertEqual(join.workitem_from_id, a.id)
+        self.assertEqual(JoinState.objects.filter(instance=instance).count(), 0)
+
+    def shape(self, history):
+        return dict((node.activity, (sorted(node.parents), sorted(node.children)))
+                    for node in history.nodes)
+
+    def test_history(self):
+        process, acts = self.and_join('t_join_history')
+        instance, a, b = self.branches(process, acts)
+        self.run(a)
+        self.run(b)
+        join = WorkItem.objects.get(instance=instance, activity=acts['join'])
+        self.run(join)
+        begin = WorkItem.objects.get(instance=instance, activity=acts['begin'])
+        end = WorkItem.objects.get(instance=instance, activity=process.end)
+        self.assertEqual(list(b.others_workitems_to.all()), [join])
+        self.assertEqual(list(b.others_workitems_from.all()), [])
+        expected = {'begin':([], sorted([a.id, b.id])), 'a':([begin.id], [join.id]),
+                    'b':([begin.id], [join.id]), 'join':(sorted([a.id, b.id]), [end.id]),
+                    'End':([join.id], [])}
+        history = load_history(instance.id)
+        self.assertEqual(self.shape(history), expected)
+        self.assertEqual(sorted(history.edges), sorted([(begin.id, a.id, 'flow'), (begin.id, b.id, 'flow'),
+                                                        (a.id, join.id, 'flow'), (b.id, join.id, 'join'),
+                                                        (join.id, end.id, 'flow')]))
+        self.assertEqual([node.id for node in history.roots()], [begin.id])
+        # reverse row recorded while the field was symmetrical
+        insert_m2m_rows(WorkItem, 'others_workitems_from', [(b.id, join.id)])
+        self.assertEqual(self.shape(load_history(instance.id)), expected)
+
+    def test_arrivals_interleaved(self):
+        process, acts = self.and_join('t_join_race')
+        instance, a, b = self.branches(process, acts)
+        self.run(a)
+        state = JoinState.objects.get(instance=instance)
+        self.assertEqual((state.arrivals, state.expected), (1, 2))
+        # b's update found no state, then a's state was committed before b inserted its own
+        real_filter = JoinState.objects.filter
+        calls = []
+        def late_filter(**kwargs):
+            if not calls:
+                calls.append(kwargs)
+                return real_filter(pk=-1)
+            return real_filter(**kwargs)
+        JoinState.objects.filter = late_filter
+        try:
+            joined = JoinState.objects.arrive(b, acts['join'], 2)
+        finally:
+            del JoinState.objects.filter
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(joined.id, state.workitem_id)
+        # b's workitem was discarded: one join workitem, joined once
+        self.assertEqual(WorkItem.objects.filter(instance=instance, activity=acts['join']).count(), 1)
+        self.assertEqual(JoinState.objects.filter(instance=instance).count(), 0)
+
+    def test_state_deleted(self):
+        process, acts = self.and_join('t_join_deleted')
+        instance, a, b = self.branches(process, acts)
+        self.run(a)
+        first = JoinState.objects.get(instance=instance).workitem_id
+        # the last branch of the previous round deleted the state: b opens a new round
+        JoinState.objects.filter(instance=instance).delete()
+        self.assertEqual(JoinState.objects.arrive(b, acts['join'], 2), None)
+        state = JoinState.objects.get(instance=instance)
+        self.assertEqual(state.arrivals, 1)
+        self.assertNotEqual(state.workitem_id, first)
+
+
+class AutoTaskTest(EngineTestCase):
+    def tasks(self, count):
+        process, acts = self.linear('t_auto')
+        tasks = [AutoTask.objects.enqueue(self.start(process)) for i in range(count)]
+        return acts['step0'], tasks
+
+    def test_claim(self):
+        activity, (first, second) = self.tasks(2)
+        task = AutoTask.objects.claim(worker='w1')
+        self.assertEqual(task.pk, first.pk)
+        self.assertEqual(AutoTask.objects.get(pk=first.pk).status, 'running')
+        self.assertEqual(AutoTask.objects.claim(worker='w2').pk, second.pk)
+        self.assertEqual(AutoTask.objects.claim(worker='w3'), None)
+
+    def test_limit(self):
+        activity, (first, second) = self.tasks(2)
+        limits = {activity.id:1}
+        task = AutoTask.objects.claim(worker='w1', limits=limits)
+        self.assertEqual(task.pk, first.pk)
+        self.assertEqual(AutoTask.objects.claim(worker='w2', limits=limits), None)
+        # the slot, not the count of running tasks, is checked
+        task.status = 'done'
+        task.save()
+        self.assertEqual(AutoTask.objects.claim(worker='w2', limits=limits), None)
+        task.release_slot()
+        self.assertEqual(AutoTask.objects.claim(worker='w2', limits=limits).pk, second.pk)
+
+    def test_slot_taken_by_another_worker(self):
+        activity, (task,) = self.tasks(1)
+        self.assertTrue(TimerLease.objects.acquire('auto.%d.0' % activity.id, 'autotask 0', 60))
+        self.assertEqual(AutoTask.objects.claim(limits={activity.id:1}), None)
+        self.assertEqual(AutoTask.objects.get(pk=task.pk).status, 'queued')
+        self.assertEqual(AutoTask.objects.claim(limits={activity.id:2}).pk, task.pk)
+
+    def test_claim_race(self):
+        activity, (first, second, third) = self.tasks(3)
+        limits = {activity.id:2}
+        manager = AutoTask.objects
+        take = manager._take_slot
+        raced = []
+        def racing_take(task, limit):
+            # w1 claims the task w2 has just read as queued
+            if not raced:
+                raced.append(None)
+                raced[0] = manager.claim(worker='w1', limits=limits)
+            return take(task, limit)
+        manager._take_slot = racing_take
+        try:
+            task = manager.claim(worker='w2', limits=limits)
+        finally:
+            del manager._take_slot
+        self.assertEqual(raced[0].pk, first.pk)
+        # w2 lost first, released its own slot only, and claimed second
+        self.assertEqual(task.pk, second.pk)
+        self.assertEqual(manager.claim(worker='w3', limits=limits), None)
+        self.assertEqual(manager.filter(status='running').count(), 2)
+        self.assertEqual(manager.get(pk=third.pk).status, 'queued')
+
+
+class WorklistIndexTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.refreshed = []
+        self.refreshed_ids = []
+        manager = WorklistEntry.objects
+        self.refresh = manager.refresh
+        def refresh(workitem):
+            self.refresh(workitem)
+            self.refreshed_ids.append(workitem.pk)
+            self.refreshed.append(sorted(manager.filter(workitem=workitem).values_list('user', 'role')))
+        manager.refresh = refresh
+
+    def tearDown(self):
+        del WorklistEntry.objects.refresh
+
+    def test_forward(self):
+        process, acts = self.linear('t_index')
+        wi = self.start(process)
+        del self.refreshed[:]
+        self.run(wi)
+        step1 = WorkItem.objects.get(activity=acts['step1'])
+        self.assertEqual(self.refreshed[-1], [(None, self.employee.id)])
+        # never pullable by anybody, even before the roles were assigned
+        self.assertFalse([entries for entries in self.refreshed if (None, None) in entries])
+        self.assertEqual(WorklistEntry.objects.worklist(self.secundus), [step1])
+
+    def test_unchanged(self):
+        process, acts = self.linear('t_index_unchanged')
+        wi = WorkItem.objects.get(pk=self.start(process).pk)
+        del self.refreshed[:]
+        wi.save()
+        self.assertEqual(self.refreshed, [])
+        wi.priority = 5
+        wi.save()
+        self.assertEqual(len(self.refreshed), 1)
+        self.assertEqual(WorklistEntry.objects.get(workitem=wi).priority, 5)
+
+    def test_and_join(self):
+        process, acts = self.make_process('t_index_join',
+                                          [('begin', {'split_mode':'and'}), ('a', {}), ('b', {}),
+                                           ('join', {'join_mode':'and'})],
+                                          [('begin', 'a', ''), ('begin', 'b', ''),
+                                           ('a', 'join', ''), ('b', 'join', ''), ('join', 'End', '')])
+        instance = self.run(self.start(process)).instance
+        self.run(WorkItem.objects.get(instance=instance, activity=acts['a']))
+        join = WorkItem.objects.get(instance=instance, activity=acts['join'])
+        del self.refreshed[:]
+        del self.refreshed_ids[:]
+        self.run(WorkItem.objects.get(instance=instance, activity=acts['b']))
+        # the unblocked workitem is indexed once, with its pull roles
+        refreshes = [entries for pk, entries in zip(self.refreshed_ids, self.refreshed) if pk == join.id]
+        self.assertEqual(refreshes, [[(None, self.employee.id)]])
+        self.assertEqual(WorklistEntry.objects.worklist(self.secundus), [WorkItem.objects.get(pk=join.id)])
+
+
+class ListSafeTest(EngineTestCase):
+    def test_order_and_cursor(self):
+        process, acts = self.linear('t_list')
+        low, high, low2 = [self.start(process, priority=p) for p in (1, 5, 1)]
+        own = WorkItem.objects.filter(activity__process=process)
+        items = list(WorkItem.objects.list_safe(user=self.primus, queryset=own))
+        self.assertEqual([wi.pk for wi in items], [high.pk, low.pk, low2.pk])
+        self.assertEqual([wi.pk for wi in WorkItem.objects.list_safe(user=self.primus, queryset=own,
+                                                                    after=items[1])], [low2.pk])
+        # a workitem pulled by a role of the user is listed once
+        self.run(low)
+        step1 = WorkItem.objects.get(activity=acts['step1'])
+        self.assertEqual([wi.pk for wi in WorkItem.objects.list_safe(user=self.secundus, queryset=own)],
+                         [step1.pk])
+        self.assertEqual(list(WorkItem.objects.list_safe(user=User.objects.get(username='admin'),
+                                                         queryset=own)), [])
+
+
+class AuthCacheTest(EngineTestCase):
+    def test_cached(self):
+        roles = get_user_roles(self.primus)
+        self.assertTrue(self.employee.id in roles.group_ids)
+        self.assertTrue(get_user_roles(self.primus) is roles)
+        # shared between requests
+        self.assertEqual(get_user_roles(User.objects.get(pk=self.primus.pk)).group_ids, roles.group_ids)
+
+    def test_membership_changed(self):
+        secretary = Group.objects.get(name='secretary')
+        self.assertFalse(secretary.id in get_user_roles(self.primus).group_ids)
+        self.primus.groups.add(secretary)
+        self.assertTrue(secretary.id in get_user_roles(self.primus).group_ids)
+        self.assertTrue(secretary.id in get_user_roles(User.objects.get(pk=self.primus.pk)).group_ids)
+
+    def test_check_user(self):
+        process, acts = self.linear('t_auth')
+        self.run(self.start(process))
+        step1 = WorkItem.objects.get(activity=acts['step1'])
+        self.assertTrue(step1.check_user(self.secundus))
+        self.assertFalse(step1.check_user(User.objects.get(username='admin')))
+
+
+class SubflowTest(EngineTestCase):
+    def test_child_instance(self):
+        child, child_acts = self.linear('t_child', length=1)
+        process, acts = self.make_process('t_parent', [('call', {'kind':'subflow', 'subflow':child}),
+                                                       ('after', {})],
+                                          [('call', 'after', ''), ('after', 'End', '')])
+        wi = self.start(process)
+        sub = wi.start_subflow(self.primus)
+        instance = sub.instance
+        self.assertEqual(instance.process_id, child.id)
+        self.assertEqual(instance.parent_workitem_id, wi.id)
+        self.assertEqual(instance.depth, wi.instance.depth + 1)
+        self.assertEqual(instance.content_object, wi.instance.content_object)
+        self.assertEqual(WorkItem.objects.get(pk=wi.pk).status, 'blocked')
+        # the end of the child instance forwards the parent workitem
+        self.run(sub)
+        self.assertEqual(ProcessInstance.objects.get(pk=instance.pk).status, 'complete')
+        self.assertEqual(WorkItem.objects.get(pk=wi.pk).status, 'complete')
+        after = WorkItem.objects.get(activity=acts['after'])
+        self.assertEqual(after.instance_id, wi.instance_id)
+        self.assertEqual(ProcessInstance.objects.get(pk=wi.instance_id).status, 'running')
+
+
+class ReportingTest(EngineTestCase):
+    def run_flows(self):
+        process, acts = self.linear('t_report')
+        self.run(self.start(process))
+        self.start(process)
+        return process, acts
+
+    def check(self, process, acts):
+        states = activity_states(process)
+        self.assertEqual((states[acts['step0'].id].complete, states[acts['step0'].id].inactive), (1, 1))
+        self.assertEqual((states[acts['step1'].id].inactive, states[acts['step1'].id].total), (1, 1))
+        self.assertEqual(states[process.end.id].total, 0)
+        self.assertEqual(process_states()[process.id].running, 2)
+
+    def test_group_by(self):
+        self.check(*self.run_flows())
+
+    def test_counters(self):
+        enabled = getattr(settings, 'WF_STATUS_COUNTERS', False)
+        settings.WF_STATUS_COUNTERS = True
+        try:
+            rebuild_counters()
+            self.check(*self.run_flows())
+        finally:
+            settings.WF_STATUS_COUNTERS = enabled
+
+
+class ActivityStatsTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.settle = getattr(settings, 'WF_STATS_SETTLE', 60)
+        settings.WF_STATS_SETTLE = -1
+
+    def tearDown(self):
+        settings.WF_STATS_SETTLE = self.settle
+
+    def test_fold(self):
+        process, acts = self.linear('t_stats')
+        for i in range(3):
+            self.run(self.start(process))
+        self.assertEqual(update_activity_stats(), 3)
+        stats = ActivityStats(acts['step0'])
+        self.assertEqual(stats.number, 3)
+        self.assertTrue(0 <= stats.p50 <= stats.time_max)
+        self.assertEqual(update_activity_stats(), 0)
+        self.assertEqual(ActivityStats(acts['step0'], user=self.primus).number, 3)
+
+    def test_late_commit(self):
+        process, acts = self.linear('t_stats_late')
+        first, second = [self.run(self.start(process)) for i in range(2)]
+        # the completion of first is not committed when the stats run
+        late = Event.objects.get(workitem=first, name__startswith='completed by')
+        id, name = late.id, late.name
+        late.delete()
+        update_activity_stats()
+        self.assertEqual(ActivityStats(acts['step0']).number, 1)
+        Event.objects.create(id=id, name=name, workitem=first)
+        update_activity_stats()
+        self.assertEqual(ActivityStats(acts['step0']).number, 2)
+
+
+class ArchiveTest(EngineTestCase):
+    def test_archive(self):
+        process, acts = self.linear('t_archive', length=1)
+        wi = self.start(process)
+        self.run(wi)
+        running = self.start(process)
+        instance_id = wi.instance_id
+        self.assertEqual(ProcessInstance.objects.get(pk=instance_id).status, 'complete')
+        live = get_instance_history(instance_id)
+        self.assertEqual(archive_instances(days=-1), 1)
+        self.assertFalse(ProcessInstance.objects.filter(pk=instance_id).exists())
+        self.assertTrue(ProcessInstance.objects.filter(pk=running.instance_id).exists())
+        history = get_instance_history(instance_id)
+        self.assertTrue(history.archived)
+        self.assertEqual([(n.id, n.activity, n.parents, n.events) for n in history.nodes],
+                         [(n.id, n.activity, n.parents, n.events) for n in live.nodes])
+        self.assertEqual([n.activity for n in history.nodes], ['step0', 'End'])
+
+    def test_in_lists(self):
+        self.assertEqual(chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+        process, acts = self.linear('t_in_lists')
+        wi = self.start(process)
+        # more ids than SQLite accepts in one query
+        rows = select_m2m_rows(WorkItem, 'pull_roles', range(1, wi.id + 1200))
+        self.assertEqual([row for row in rows if row[0] == wi.id], [(wi.id, self.employee.id)])
+
+
+class OutboxTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        process, acts = self.linear('t_outbox')
+        self.urgent = self.start(process, priority=5)
+        self.normal = self.start(process, priority=1)
+        self.user = User.objects.create(username='mailed', email='mailed@example.com')
+
+    def test_digest(self):
+        Notification.objects.enqueue(self.user, self.urgent)
+        Notification.objects.enqueue(self.user, self.normal)
+        self.assertEqual(send_notifications(template='goflow/mail.txt'), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['mailed@example.com'])
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 0)
+
+    def test_delay(self):
+        Notification.objects.enqueue(self.user, self.normal)
+        # notified just now: the entry waits for the delay
+        self.assertEqual(send_notifications(template='goflow/mail.txt'), 0)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 1)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LoggerTest(TestCase):
+    def record(self, msg, *args, **extra):
+        record = logging.LogRecord('goflow.test', logging.INFO, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_ids(self):
+        extra = Log('goflow.test').ids(WorkItem(id=3, instance_id=2, activity_id=1))
+        self.assertEqual(extra, {'workitem_id':3, 'instance_id':2, 'activity_id':1})
+        self.assertEqual(Log('goflow.test').ids(instance=5), {'instance_id':5})
+        text = StructuredFormatter('%(message)s').format(self.record('done', **extra))
+        self.assertEqual(text, 'done [instance=2 workitem=3 activity=1]')
+        self.assertEqual(StructuredFormatter('%(message)s').format(self.record('done')), 'done')
+
+    def test_queue_full(self):
+        handler = QueueHandler(Queue.Queue(1))
+        handler.emit(self.record('one %s', 1))
+        handler.emit(self.record('two'))
+        self.assertEqual(handler.dropped, 1)
+        record = handler.queue.get_nowait()
+        self.assertEqual((record.msg, record.args), ('one 1', None))
+
+    def test_listener(self):
+        queue, target = Queue.Queue(10), ListHandler()
+        listener = QueueListener(queue, target)
+        listener.start()
+        QueueHandler(queue).emit(self.record('queued'))
+        listener.stop()
+        self.assertEqual([r.msg for r in target.records], ['queued'])
+
+    def test_debug_sampler(self):
+        debug = self.record('debug')
+        debug.levelno = logging.DEBUG
+        self.assertFalse(DebugSampler(0).filter(debug))
+        self.assertTrue(DebugSampler(0).filter(self.record('info')))
+
+
+class MetricsTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        metrics.registry.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.enable(None)
+        metrics.registry.reset()
+
+    def test_histogram(self):
+        h = metrics.Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [(1, 2), (5, 3), ('+Inf', 4)])
+        self.assertEqual((h.count, h.sum), (4, 14.5))
+
+    def test_measured(self):
+        process, acts = self.linear('t_metrics')
+        self.run(self.start(process))
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['goflow_complete_total'],
+                         [({'process':'t_metrics', 'activity':'step0', 'result':'ok'}, 1)])
+        text = metrics.exposition()
+        self.assertTrue('# TYPE goflow_complete_total counter' in text)
+        self.assertTrue('goflow_complete_total{activity="step0",process="t_metrics",result="ok"} 1' in text)
+        self.assertTrue('goflow_complete_seconds_count{activity="step0",process="t_metrics"} 1' in text)
+        self.assertTrue('goflow_start_total{process="t_metrics",result="ok"} 1' in text)
+
+    def test_error(self):
+        process, acts = self.linear('t_metrics_error')
+        wi = self.start(process)
+        # not active: complete fails
+        self.assertRaises(Exception, wi.complete, self.primus)
+        self.assertEqual(metrics.snapshot()['counters']['goflow_complete_total'][0][0]['result'], 'error')
+
+    def test_disabled(self):
+        metrics.enable(False)
+        process, acts = self.linear('t_metrics_off')
+        self.run(self.start(process))
+        self.assertEqual(metrics.snapshot(), {'counters':{}, 'histograms':{}})
+
+
+class BenchmarkTest(EngineTestCase):
+    def test_shapes(self):
+        path = os.path.join(os.path.dirname(goflow.__file__), '..', 'scripts', 'benchmark_engine.py')
+        benchmark = imp.load_source('benchmark_engine', path)
+        builder = benchmark.SyntheticProcessBuilder(self.employee, width=2, length=2)
+        for shape in ('linear', 'and', 'xor', 'auto', 'subflow'):
+            result = benchmark.run(shape, 2, builder, self.primus, pages=1)
+            self.assertEqual(result['complete_instances'], 2 + (shape == 'subflow' and 2 or 0), shape)
+            self.assertEqual(result['operations']['start']['count'], 2)
+            self.assertEqual(result['operations']['list_safe']['count'], 1)
+
+
+class SimulationTest(EngineTestCase):
+    def and_model(self):
+        model = SimulationModel('sim')
+        for title in ('begin', 'a', 'b'):
+            model.add_activity(title)
+        model.add_activity('join', join_mode='and')
+        model.add_activity('end', auto=True)
+        for input, output in (('begin', 'a'), ('begin', 'b'), ('a', 'join'), ('b', 'join'),
+                              ('join', 'end')):
+            model.add_transition(input, output)
+        model.begin, model.end = model.activity('begin'), model.activity('end')
+        return model
+
+    def test_and_join(self):
+        sim = Simulator(self.and_model(), arrival=('const', 100), default_staff=2,
+                        service_times={'begin':('const', 1), 'a':('const', 2), 'b':('const', 5),
+                                       'join':('const', 1)})
+        result = sim.run(instances=3)
+        self.assertEqual((result.completed, result.unfinished), (3, 0))
+        self.assertEqual(result.cycle_time.values, [7.0, 7.0, 7.0])
+        self.assertEqual(result.activities[('sim', 'join')].count, 3)
+
+    def test_seeded(self):
+        process, acts = self.linear('t_sim', length=3)
+        model = SimulationModel.from_process('t_sim')
+        self.assertEqual([a.title for a in model.activities if a.roles], ['step0', 'step1', 'step2'])
+        runs = [Simulator(model, seed=7).run(instances=50) for i in range(2)]
+        self.assertEqual(runs[0].cycle_time.values, runs[1].cycle_time.values)
+        self.assertEqual(runs[0].completed, 50)
+        self.assertEqual(len(monte_carlo(model, runs=2, instances=10)), 2)
+
+    def test_branch_probabilities(self):
+        model = SimulationModel('xor')
+        model.add_activity('begin', split_mode='xor')
+        for title in ('yes', 'no'):
+            model.add_activity(title)
+        model.add_activity('end', auto=True)
+        for input, output in (('begin', 'yes'), ('begin', 'no'), ('yes', 'end'), ('no', 'end')):
+            model.add_transition(input, output)
+        model.begin, model.end = model.activity('begin'), model.activity('end')
+        result = Simulator(model, branch_probabilities={('begin', 'no'):0}, seed=1).run(instances=20)
+        self.assertEqual(result.activities[('xor', 'yes')].count, 20)
+        self.assertFalse(('xor', 'no') in result.activities)
+
+
+class ConflictTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.process, self.acts = self.linear('t_conflict')
+        self.wi = self.start(self.process)
+
+    def test_activate_twice(self):
+        first, second = WorkItem.objects.get(pk=self.wi.pk), WorkItem.objects.get(pk=self.wi.pk)
+        first.activate(self.primus)
+        self.assertRaises(WorkItemConflict, second.activate, self.primus)
+        self.assertEqual(WorkItem.objects.get(pk=self.wi.pk).version, first.version)
+        self.assertEqual(Event.objects.filter(workitem=self.wi, name__startswith='activated').count(), 1)
+
+    def test_complete_twice(self):
+        WorkItem.objects.get(pk=self.wi.pk).activate(self.primus)
+        first, second = WorkItem.objects.get(pk=self.wi.pk), WorkItem.objects.get(pk=self.wi.pk)
+        first.complete(self.primus)
+        self.assertRaises(WorkItemConflict, second.complete, self.primus)
+        # forwarded once
+        self.assertEqual(WorkItem.objects.filter(activity=self.acts['step1']).count(), 1)
+
+    def test_activate_view(self):
+        stale = WorkItem.objects.get(pk=self.wi.pk)
+        WorkItem.objects.get(pk=self.wi.pk).activate(self.primus)
+        WorkItem.objects.get_safe = lambda id, **kwargs: stale
+        try:
+            response = self.login().get('/leave/mywork/activate/%d/' % self.wi.pk)
+        finally:
+            del WorkItem.objects.get_safe
+        self.assertEqual(response.status_code, 409)
+
+    def test_signals(self):
+        sent = []
+        def receiver(signal, sender, instance, **kwargs):
+            sent.append((signal, kwargs['raw'], kwargs['using']))
+        signals.pre_save.connect(receiver, sender=WorkItem)
+        signals.post_save.connect(receiver, sender=WorkItem)
+        try:
+            WorkItem.objects.get(pk=self.wi.pk).save(using='default')
+        finally:
+            signals.pre_save.disconnect(receiver, sender=WorkItem)
+            signals.post_save.disconnect(receiver, sender=WorkItem)
+        self.assertEqual(sent, [(signals.pre_save, False, 'default'),
+                                (signals.post_save, False, 'default')])
+
+
+class ClaimTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.process, self.acts = self.linear('t_claim')
+        for priority in (1, 5):
+            self.run(self.start(self.process, priority=priority))
+        self.low, self.high = WorkItem.objects.filter(activity=self.acts['step1']).order_by('priority')
+
+    def test_order(self):
+        first = WorkItem.objects.claim_next(self.secundus, process=self.process)
+        self.assertEqual(first.pk, self.high.pk)
+        self.assertEqual((first.status, first.user_id), ('active', self.secundus.id))
+        second = WorkItem.objects.claim_next(User.objects.get(username='tertius'), process=self.process)
+        self.assertEqual(second.pk, self.low.pk)
+        self.assertEqual(WorkItem.objects.claim_next(self.secundus, process=self.process), None)
+
+    def test_not_allowed_anymore(self):
+        # roles changed since the workitems were indexed
+        self.acts['step1'].roles.remove(self.employee)
+        self.acts['step1'].roles.add(Group.objects.get(name='manager'))
+        self.assertEqual(WorkItem.objects.claim_next(self.secundus, process=self.process), None)
+        self.assertEqual(WorkItem.objects.get(pk=self.high.pk).status, 'inactive')
+        self.assertEqual(WorkItem.objects.claim_next(self.secundus, process=self.process, scan=1), None)
+
+    def claim_failing(self, error):
+        '''claim_next while activating self.high raises error.'''
+        activate = WorkItem.__dict__['activate']
+        high = self.high.pk
+        def failing(workitem, actor):
+            if workitem.pk == high:
+                raise error
+            return activate(workitem, actor)
+        WorkItem.activate = failing
+        try:
+            return WorkItem.objects.claim_next(self.secundus, process=self.process)
+        finally:
+            WorkItem.activate = activate
+
+    def test_lost_race(self):
+        self.assertEqual(self.claim_failing(WorkItemConflict('taken')).pk, self.low.pk)
+
+    def test_error_raised(self):
+        self.assertRaises(ValueError, self.claim_failing, ValueError('database error'))
+        self.assertEqual(WorkItem.objects.get(pk=self.low.pk).status, 'inactive')
+
+
+class HandlersTest(TestCase):
+    def tearDown(self):
+        for name in ('t_route', 't_app'):
+            handlers._registered_push.pop(name, None)
+            handlers._registered_apps.pop(name, None)
+        handlers.invalidate()
+
+    def test_push(self):
+        self.assertTrue(handlers.get_push_handler('route_to_requester') is pushapps.route_to_requester)
+        @handlers.pushapp(name='t_route')
+        def route(workitem):
+            return workitem.instance.user
+        self.assertTrue(handlers.get_push_handler('t_route') is route)
+
+    def test_application(self):
+        @handlers.application('t_app')
+        def app(workitem, **kwargs):
+            return True
+        self.assertEqual(handlers.get_auto_handler('t_app'), (app, {}))
+        self.assertEqual(handlers.get_app_handler('t_app'), (app, True))
+        func, auto = handlers.get_app_handler('checkstatus')
+        self.assertFalse(auto)
+
+    def test_invalidated(self):
+        handlers.get_app_handler('checkstatus')
+        self.assertTrue('checkstatus' in handlers._apps)
+        Application.objects.create(url='t_new')
+        self.assertFalse('checkstatus' in handlers._apps)
+
+    def test_load(self):
+        Application.objects.create(url='t_unresolved')
+        handlers.load()
+        self.assertTrue('checkstatus' in handlers._apps)
+        self.assertFalse('t_unresolved' in handlers._apps)
+
+
+class ParamsTest(EngineTestCase):
+    def test_parse(self):
+        self.assertEqual(parse_params("'username':'john'"), {'username':'john'})
+        self.assertTrue(parse_params("{'a':1}") is parse_params("{'a':1}"))
+        self.assertEqual(parse_params(' '), {})
+        self.assertRaises(ValueError, parse_params, "{1:2}")
+        self.assertRaises(ValueError, parse_params, "__import__('os').getcwd()")
+
+    def test_clean(self):
+        process, acts = self.linear('t_params')
+        activity = acts['step0']
+        activity.app_param = "{'ok':True}"
+        activity.clean()
+        activity.app_param = "open('x')"
+        self.assertRaises(ValidationError, activity.clean)
+
+    def test_push_params(self):
+        route, created = PushApplication.objects.get_or_create(url='route_to_user')
+        process, acts = self.make_process('t_push_params',
+                                          [('step0', {}),
+                                           ('step1', {'push_application':route,
+                                                      'pushapp_param':"'username':'secundus'"})],
+                                          [('step0', 'step1', ''), ('step1', 'End', '')])
+        self.run(self.start(process))
+        self.assertEqual(WorkItem.objects.get(activity=acts['step1']).user, self.secundus)
+
+
+class ListViewsTest(EngineTestCase):
+    def setUp(self):
+        EngineTestCase.setUp(self)
+        self.settle = getattr(settings, 'WF_LIST_SETTLE', 2)
+        settings.WF_LIST_SETTLE = 0
+        # the test server is a single process
+        self.versions = getattr(settings, 'WF_LIST_VERSIONS', None)
+        settings.WF_LIST_VERSIONS = True
+        process, acts = self.linear('t_views')
+        self.ids = [self.start(process, priority=p).id for p in (3, 2, 1)]
+        self.client = self.login()
+
+    def tearDown(self):
+        settings.WF_LIST_SETTLE = self.settle
+        settings.WF_LIST_VERSIONS = self.versions
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        if response.status_code == 200:
+            response.data = simplejson.loads(response.content)
+        return response
+
+    def test_pages(self):
+        first = self.get('/leave/mywork/json/', limit=2)
+        self.assertEqual([item['id'] for item in first.data['items']], self.ids[:2])
+        last = self.get('/leave/mywork/json/', limit=2, after=first.data['next'])
+        self.assertEqual([item['id'] for item in last.data['items']], self.ids[2:])
+        self.assertEqual(last.data['next'], None)
+        # clamped to 1..MAX_PAGE
+        self.assertEqual(len(self.get('/leave/mywork/json/', limit=0).data['items']), 1)
+        self.assertEqual(len(self.get('/leave/mywork/json/', limit=10000).data['items']), 3)
+
+    def test_bad_parameters(self):
+        for url in ('/leave/mywork/json/', '/leave/myrequests/json/'):
+            self.assertEqual(self.get(url, limit='ten').status_code, 400)
+            self.assertEqual(self.get(url, after='nowhere').status_code, 400)
+
+    def test_not_modified(self):
+        response = self.get('/leave/mywork/json/', limit=2)
+        etag = response['ETag']
+        response = self.client.get('/leave/mywork/json/', {'limit':2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # a change of the worklist changes the version
+        self.run(WorkItem.objects.get(pk=self.ids[0]))
+        response = self.client.get('/leave/mywork/json/', {'limit':2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_local_cache(self):
+        # the default locmem:// cache is not shared by the server processes
+        settings.WF_LIST_VERSIONS = None
+        response = self.get('/leave/mywork/json/', limit=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+Engine micro-benchmarks on synthetic processes.
+
+Runs in a fresh test database (in memory with sqlite), builds synthetic
+processes with a ProcessBuilder, starts SIZE instances of each and drives
+them to completion, measuring:
+
+- start, activate, complete, forward, get_destinations: latency and
+  queries per operation
+- list_safe: latency of the first page of a worklist
+- throughput of the start and the completion phases, peak memory
+
+usage::
+
+    python scripts/benchmark_engine.py --sizes 1000,10000 --shapes linear,and --out run.json
+    python scripts/benchmark_engine.py --sizes 1000 --compare run.json
+
+shapes: linear, and (AND split/join), xor (XOR fan), auto (autostart chain),
+subflow.
+'''
+import os
+import sys
+import time
+import resource
+import platform
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'leavedemo.settings')
+
+from django.conf import settings
+from django.utils import simplejson
+
+
+class SyntheticProcessBuilder(object):
+    """Builds the benchmark processes with a ProcessBuilder.
+    """
+    def __init__(self, role, width=10, length=5):
+        self.role = role
+        self.width = width
+        self.length = length
+
+    def _builder(self, title):
+        import process_builder
+        process_builder.DEBUG = False
+        builder = process_builder.ProcessBuilder(title=title)
+        builder.roles['bench'] = self.role
+        builder.activities['end'] = builder.process.end
+        return builder
+
+    def _activity(self, builder, title, **kwargs):
+        kwargs.setdefault('roles', ['bench'])
+        return builder.add_activity(title=title, application=None, **kwargs)
+
+    def _finish(self, builder):
+        builder.setup_all()
+        return builder.process
+
+    def linear(self, title='bench_linear'):
+        b = self._builder(title)
+        previous = 'begin'
+        self._activity(b, previous)
+        for i in range(self.length):
+            self._activity(b, 'step%d' % i)
+            b.add_transition((previous, 'step%d' % i), name='%s_%d' % (title, i))
+            previous = 'step%d' % i
+        b.add_transition((previous, 'end'), name='%s_end' % title)
+        return self._finish(b)
+
+    def and_split(self, title='bench_and'):
+        b = self._builder(title)
+        self._activity(b, 'begin', split_mode='and')
+        self._activity(b, 'join', join_mode='and')
+        for i in range(self.width):
+            self._activity(b, 'branch%d' % i)
+            b.add_transition(('begin', 'branch%d' % i), name='%s_in%d' % (title, i))
+            b.add_transition(('branch%d' % i, 'join'), name='%s_out%d' % (title, i))
+        b.add_transition(('join', 'end'), name='%s_end' % title)
+        return self._finish(b)
+
+    def xor_fan(self, title='bench_xor'):
+        b = self._builder(title)
+        self._activity(b, 'begin', split_mode='xor')
+        for i in range(self.width):
+            self._activity(b, 'branch%d' % i, join_mode='xor')
+            b.add_transition(('begin', 'branch%d' % i), name='%s_in%d' % (title, i),
+                             condition='workitem.id %% %d == %d' % (self.width, i))
+            b.add_transition(('branch%d' % i, 'end'), name='%s_out%d' % (title, i))
+        return self._finish(b)
+
+    def auto_chain(self, title='bench_auto'):
+        b = self._builder(title)
+        previous = 'begin'
+        self._activity(b, previous)
+        for i in range(self.length):
+            self._activity(b, 'auto%d' % i, autostart=True, roles=[])
+            b.add_transition((previous, 'auto%d' % i), name='%s_%d' % (title, i))
+            previous = 'auto%d' % i
+        b.add_transition((previous, 'end'), name='%s_end' % title)
+        return self._finish(b)
+
+    def subflow(self, title='bench_subflow'):
+        child = self.linear(title='%s_child' % title)
+        b = self._builder(title)
+        activity = self._activity(b, 'begin', kind='subflow')
+        activity.subflow = child
+        activity.save()
+        b.add_transition(('begin', 'end'), name='%s_end' % title)
+        return self._finish(b)
+
+    def build(self, shape, title=None):
+        '''builds a process of a shape (linear, and, xor, auto, subflow).'''
+        method = {'linear':self.linear, 'and':self.and_split, 'xor':self.xor_fan,
+                  'auto':self.auto_chain, 'subflow':self.subflow}[shape]
+        if title:
+            return method(title=title)
+        return method()
+
+
+class Recorder(object):
+    """Latencies (seconds) and queries of the measured operations.
+    """
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, op, func, *args, **kwargs):
+        from django.db import connection, reset_queries
+        reset_queries()
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.samples.setdefault(op, []).append((time.time() - start, len(connection.queries)))
+        return result
+
+    def summary(self, op, wall=None):
+        samples = self.samples.get(op, [])
+        latencies = sorted([s for s, q in samples])
+        n = len(latencies)
+        if not n:
+            return None
+        def pct(q):
+            return latencies[min(n - 1, int(q * n))]
+        result = {'count':n, 'total':sum(latencies), 'mean':sum(latencies) / n,
+                  'p50':pct(0.5), 'p95':pct(0.95), 'p99':pct(0.99), 'max':latencies[-1],
+                  'queries_per_op':float(sum([q for s, q in samples])) / n}
+        if wall:
+            result['throughput'] = n / wall
+        return result
+
+
+def peak_memory_kb():
+    '''peak resident memory of the process (kB).'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024
+    return rss
+
+
+def drive(processes, user, recorder, batch=500):
+    '''activates and completes the open workitems of the processes until none is left.'''
+    from goflow.runtime.models import WorkItem
+    done = 0
+    while True:
+        workitems = list(WorkItem.objects.filter(activity__process__in=processes,
+                                                 status='inactive').order_by('id')[:batch])
+        if not workitems:
+            return done
+        for wi in workitems:
+            recorder.measure('activate', wi.activate, user)
+            if wi.activity.kind == 'subflow':
+                recorder.measure('start_subflow', wi.start_subflow, user)
+            else:
+                recorder.measure('complete', wi.complete, user)
+            done += 1
+
+
+def run(shape, size, builder, user, pages=20):
+    from goflow.apptools.models import DefaultAppModel
+    from goflow.runtime.models import ProcessInstance, WorkItem
+    from goflow.runtime import metrics
+
+    # process titles must be unique
+    process = builder.build(shape, title='bench_%s_%d' % (shape, size))
+    processes = [process.id] + list(process.activities.exclude(subflow=None).values_list('subflow', flat=True))
+    recorder = Recorder()
+    metrics.registry.reset()
+    items = [DefaultAppModel.objects.create(history='') for i in range(size)]
+
+    start = time.time()
+    for item in items:
+        recorder.measure('start', ProcessInstance.objects.start, process.title, user, item)
+    start_wall = time.time() - start
+
+    for i in range(pages):
+        recorder.measure('list_safe', lambda: list(WorkItem.objects.list_safe(user=user)[:50]))
+
+    start = time.time()
+    drive(processes, user, recorder)
+    drive_wall = time.time() - start
+
+    results = {}
+    results['start'] = recorder.summary('start', start_wall)
+    for op in ('activate', 'complete', 'start_subflow'):
+        summary = recorder.summary(op, drive_wall)
+        if summary: results[op] = summary
+    results['list_safe'] = recorder.summary('list_safe')
+    # operations nested in complete, from the engine metrics
+    for name, series in metrics.snapshot()['histograms'].items():
+        for op in ('forward', 'get_destinations', 'exec_auto_application'):
+            if name.startswith('goflow_%s_' % op):
+                kind = name[len('goflow_%s_' % op):]
+                entry = results.setdefault(op, {'count':0, 'total':0.0, 'queries':0})
+                for labels, h in series:
+                    if kind == 'seconds':
+                        entry['count'] += h['count']
+                        entry['total'] += h['sum']
+                    elif kind == 'queries':
+                        entry['queries'] += h['sum']
+    for op in ('forward', 'get_destinations', 'exec_auto_application'):
+        entry = results.get(op)
+        if entry and entry['count']:
+            entry['mean'] = entry['total'] / entry['count']
+            entry['queries_per_op'] = entry.pop('queries') / entry['count']
+    complete = ProcessInstance.objects.filter(process__in=processes, status='complete').count()
+    return {'shape':shape, 'size':size, 'operations':results, 'complete_instances':complete,
+            'start_seconds':start_wall, 'drive_seconds':drive_wall, 'peak_memory_kb':peak_memory_kb()}
+
+
+def setup():
+    '''creates the test database and the benchmark user and role.'''
+    settings.DEBUG = True   # connection.queries
+    settings.WF_METRICS = True
+    from django.db import connection
+    from django.contrib.auth.models import User, Group
+    from goflow.runtime import metrics
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    metrics.enable()
+    role, created = Group.objects.get_or_create(name='bench')
+    user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+    user.groups.add(role)
+    User.objects.get_or_create(username=settings.WF_USER_AUTO)
+    return user, role
+
+
+def compare(current, previous):
+    '''prints the ratios current/previous of the mean latencies.'''
+    old = {}
+    for r in previous['results']:
+        for op, s in r['operations'].items():
+            if s and s.get('mean'):
+                old[(r['shape'], r['size'], op)] = s['mean']
+    for r in current['results']:
+        for op, s in sorted(r['operations'].items()):
+            key = (r['shape'], r['size'], op)
+            if s and s.get('mean') and key in old:
+                print '%-8s %7d %-22s %9.3fms -> %9.3fms  x%.2f' % (
+                    key + (old[key] * 1000, s['mean'] * 1000, s['mean'] / old[key]))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+                      help='numbers of instances, comma separated')
+    parser.add_option('--shapes', default='linear,and,xor,auto,subflow',
+                      help='process shapes, comma separated')
+    parser.add_option('--width', type='int', default=10, help='branches of and/xor shapes')
+    parser.add_option('--length', type='int', default=5, help='activities of linear/auto chains')
+    parser.add_option('--out', default=None, help='JSON results file')
+    parser.add_option('--compare', default=None, help='previous JSON results file')
+    options, args = parser.parse_args()
+
+    user, role = setup()
+    builder = SyntheticProcessBuilder(role, width=options.width, length=options.length)
+    results = []
+    for size in [int(s) for s in options.sizes.split(',')]:
+        for shape in options.shapes.split(','):
+            r = run(shape, size, builder, user)
+            results.append(r)
+            ops = r['operations']
+            print '%-8s %7d  start %8.1f/s  complete %8.1f/s  list_safe p95 %.2fms  %d kB' % (
+                shape, size, ops['start'].get('throughput', 0),
+                (ops.get('complete') or ops.get('start_subflow') or {}).get('throughput', 0),
+                ops['list_safe']['p95'] * 1000, r['peak_memory_kb'])
+
+    from django import get_version
+    from sqlite3 import sqlite_version
+    data = {'date':datetime.now().isoformat(), 'python':platform.python_version(),
+            'django':get_version(), 'sqlite':sqlite_version, 'platform':platform.platform(),
+            'width':options.width, 'length':options.length, 'results':results}
+    if options.out:
+        f = open(options.out, 'w')
+        simplejson.dump(data, f, indent=2)
+        f.close()
+    if options.compare:
+        compare(data, simplejson.load(open(options.compare)))
+
+
+if __name__ == '__main__':
+    main()
@@ -104,7 +104,8 @@ class ProcessBuilder(object):
         return process
 
     def create_process_role(self):
-        process_role = Group.objects.create(name=self.process.title)
+        # Process.save creates the group
+        process_role, created = Group.objects.get_or_create(name=self.process.title)
         log('role|group', process_role)
         process_ctype = ContentType.objects.get_for_model(Process)
 